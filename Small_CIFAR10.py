@@ -5,8 +5,6 @@ import torchvision
 from torchvision.datasets import VisionDataset
 root = os.path.expanduser('~/data')
 
-np.random.seed(0)
-
 class Small_CIFAR10(VisionDataset):
 
     def __init__(self, root, train=True, transform=None, target_transform=None):
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Eager vs compiled train-step and eval-forward time for every architecture in models.py.
+
+    python benchmarks/bench_compile.py --models mlp,allcnn,resnet_small --batch-size 128
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import models
+
+_INPUT_SHAPES = {
+    'mlp': (1024,),
+    'ntk_linear': (1024,),
+    'ntk_mlp': (1024,),
+}
+
+
+def example_input(name, batch_size):
+    shape = _INPUT_SHAPES.get(name, (3, 32, 32))
+    return torch.randn(batch_size, *shape)
+
+
+def time_steps(model, x, steps, train=True):
+    model.train(train)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.0)
+    t1 = time.perf_counter()
+    for _ in range(steps):
+        if train:
+            optimizer.zero_grad()
+            model(x).sum().backward()
+            optimizer.step()
+        else:
+            with torch.no_grad():
+                model(x)
+    return (time.perf_counter() - t1) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type=str, default=','.join(models._MODELS))
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--num-classes', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'model':<18}{'mode':<7}{'eager ms':>10}{'compiled ms':>13}{'speedup':>9}{'compile s':>11}")
+    for name in args.models.split(','):
+        kwargs = dict(num_classes=args.num_classes)
+        if name == 'ntk_linear':
+            kwargs = dict(input_dim=1024, output_dim=args.num_classes)
+        x = example_input(name, args.batch_size)
+        eager = models.get_model(name, **kwargs)
+        t1 = time.perf_counter()
+        compiled = models.get_model(name, compile=True, example_input=x, **kwargs)
+        compile_time = time.perf_counter() - t1
+        for train in (True, False):
+            t_eager = time_steps(eager, x, args.steps, train=train)
+            t_compiled = time_steps(compiled, x, args.steps, train=train)
+            print(f"{name:<18}{'train' if train else 'eval':<7}{1e3 * t_eager:>10.2f}{1e3 * t_compiled:>13.2f}"
+                  f"{t_eager / t_compiled:>8.2f}x{compile_time:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Cold import time of the entry points, each measured in a fresh interpreter.
+
+    python benchmarks/bench_startup.py --repeats 5
+    python benchmarks/bench_startup.py --modules main,utils --importtime   # per-module breakdown
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# `main` is imported under another name so its `__main__` block does not run.
+_STATEMENTS = {
+    'torch': 'import torch',
+    'models': 'import models',
+    'datasets_multiclass': 'import datasets_multiclass',
+    'utils': 'import utils',
+    'main': 'import importlib.util as u; s = u.spec_from_file_location("main_", "main.py"); s.loader.exec_module(u.module_from_spec(s))',
+}
+
+
+def time_import(statement, importtime=False):
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', statement]
+    t1 = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=ROOT, capture_output=True, text=True)
+    elapsed = time.perf_counter() - t1
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+    return elapsed, proc.stderr
+
+
+def slowest_imports(importtime_log, top):
+    rows = []
+    for line in importtime_log.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', type=str, default=','.join(_STATEMENTS))
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--importtime', action='store_true', help='Print the slowest imports of each entry point')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    time_import('pass')
+    print(f"{'module':<22}{'min s':>8}{'mean s':>8}")
+    for name in args.modules.split(','):
+        times = [time_import(_STATEMENTS[name])[0] for _ in range(args.repeats)]
+        print(f"{name:<22}{min(times):>8.2f}{sum(times) / len(times):>8.2f}")
+        if args.importtime:
+            _, log = time_import(_STATEMENTS[name], importtime=True)
+            for us, module in slowest_imports(log, args.top):
+                print(f"    {module:<40}{us / 1e6:>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""Certified removal (Guo et al., 2020) for the last linear layer of a model.
+
+The rest of the model is a fixed feature map phi (exactly so for ntk_linear, or for models trained with
+--unfreeze-start at the last layer), and the head weights w minimize the training objective in sum form,
+
+    J(w) = sum_i CE(w phi_i, y_i) + lam / 2 ||w - w_0||^2,    lam = n * weight_decay,
+
+which is the mean loss plus `l2_penalty` of the training loop. The Hessian of J is small (classes x features,
+bias included) and is formed and Cholesky-factored once. Every removal request takes the Newton step
+w += H_r^{-1} sum_{i removed} grad CE_i, with H_r = H - U U^T: each removed sample downdates the Hessian by
+a rank-C term U_i U_i^T. The downdates are applied to solves through the Woodbury identity on the cached
+factor, and folded into a new factor once their total rank exceeds `max_rank`. J_r is lam-strongly convex,
+so ||w - argmin J_r|| <= ||grad J_r(w)|| / lam; the released weights add Gaussian noise calibrated on this
+bound to be (eps, delta)-indistinguishable from the noisy retrained head.
+
+The engine state (features, Hessian, factor and pending downdates) is saved after training and after
+every request, so a request only costs the removal itself:
+
+    engine = CertifiedRemoval(model, model_init, train_set, args)
+    engine.save('checkpoints/<name>_certified.pt')
+    engine = CertifiedRemoval.load('checkpoints/<name>_certified.pt')
+    info = engine.remove([3, 17])                     # milliseconds per request
+    engine.apply(model)                               # noisy head weights
+"""
+import math
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def last_linear(model):
+    return [m for m in model.modules() if isinstance(m, nn.Linear)][-1]
+
+
+def check_fixed_features(model, args):
+    """Raises ValueError unless the layers below the head of `model` are a fixed feature map: ntk_linear,
+    or a model (e.g. mlp) whose --unfreeze-start left only the head trainable. Otherwise the certificate
+    of the head says nothing about the model."""
+    if args.model == 'ntk_linear':
+        return
+    if args.unfreeze_start is not None:
+        named = list(model.named_parameters())
+        start = next((i for i, (n, _) in enumerate(named) if args.unfreeze_start in n), None)
+        head = {id(p) for p in last_linear(model).parameters()}
+        if start is not None and all(id(p) in head for _, p in named[start:]):
+            return
+    raise ValueError(f'Certified removal needs a fixed feature map below the head: ntk_linear or '
+                     f'--unfreeze-start at the last linear layer, got {args.model} (--unfreeze-start {args.unfreeze_start})')
+
+
+class CertifiedRemoval(object):
+
+    # state saved by `save`
+    STATE = ['phi', 'targets', 'alive', 'w', 'w_hessian', 'w0', 'lam', 'eps', 'delta', 'max_rank', 'H', 'L', 'U', 'Y']
+
+    def __init__(self, model, model_init, dataset, args, eps=1., delta=1e-5, max_rank=None, batch_size=1024):
+        check_fixed_features(model, args)
+        self.head = last_linear(model)
+        self.device = self.head.weight.device
+        self.eps, self.delta = eps, delta
+        self.phi, self.targets = self._features(model, dataset, batch_size)
+        self.alive = torch.ones(len(self.targets), dtype=torch.bool, device=self.device)
+        self.w = self._head_weights(self.head)
+        # the Hessian and its downdates are all taken at the trained weights, so H - U U^T >= lam I
+        self.w_hessian = self.w.clone()
+        self.w0 = self._head_weights(last_linear(model_init)).to(self.device)
+        self.num_classes, self.dim = self.w.shape
+        self.lam = len(self.targets) * args.weight_decay
+        self.max_rank = max_rank if max_rank is not None else self.w.numel() // 4
+        self.H = self._hessian(batch_size)
+        self._factor()
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        torch.save({k: getattr(self, k) for k in self.STATE}, tmp)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, device=None):
+        engine = cls.__new__(cls)
+        for k, v in torch.load(path, map_location=device).items():
+            setattr(engine, k, v)
+        engine.device = engine.w.device
+        engine.num_classes, engine.dim = engine.w.shape
+        return engine
+
+    def _head_weights(self, head):
+        w = head.weight.detach()
+        if head.bias is not None:
+            w = torch.cat([w, head.bias.detach()[:, None]], dim=1)
+        return w.clone().double()
+
+    def _features(self, model, dataset, batch_size):
+        """Inputs of the head (with a constant 1 for the bias) and targets of every sample of `dataset`."""
+        model.eval()
+        features, targets = [], []
+        handle = self.head.register_forward_hook(lambda module, input, output: features.append(input[0].detach()))
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+        with torch.no_grad():
+            for data, target in loader:
+                model(data.to(self.device))
+                targets.append(target.to(self.device))
+        handle.remove()
+        phi = torch.cat(features).double()
+        if self.head.bias is not None:
+            phi = torch.cat([phi, torch.ones(len(phi), 1, dtype=phi.dtype, device=phi.device)], dim=1)
+        return phi, torch.cat(targets)
+
+    def _prob(self, index, w=None):
+        return F.softmax(self.phi[index] @ (self.w if w is None else w).T, dim=1)
+
+    def _hessian(self, batch_size):
+        C, d = self.num_classes, self.dim
+        H = torch.zeros(C * d, C * d, dtype=torch.float64, device=self.device)
+        blocks = H.view(C, d, C, d)
+        for start in range(0, len(self.phi), batch_size):
+            index = torch.arange(start, min(start + batch_size, len(self.phi)), device=self.device)
+            phi, prob = self.phi[index], self._prob(index, self.w_hessian)
+            # (diag(p) - p p^T) kron phi phi^T, summed over the batch
+            for c in range(C):
+                blocks[c, :, c, :] += (phi * prob[:, c:c + 1]).T @ phi
+            z = (prob[:, :, None] * phi[:, None, :]).reshape(len(phi), C * d)
+            H -= z.T @ z
+        H += self.lam * torch.eye(C * d, dtype=H.dtype, device=H.device)
+        return H
+
+    def _factor(self):
+        self.L = torch.linalg.cholesky(self.H)
+        self.U = self.H.new_zeros(len(self.H), 0)
+        self.Y = self.H.new_zeros(len(self.H), 0)
+
+    def _downdate(self, index):
+        """Columns U_i with U_i U_i^T the Hessian of the CE of sample i: B kron phi_i, B B^T = diag(p) - p p^T."""
+        prob, phi = self._prob(index, self.w_hessian), self.phi[index]
+        s = prob.sqrt()
+        B = torch.diag_embed(s) - prob[:, :, None] * s[:, None, :]
+        return torch.einsum('mac,md->mcad', B, phi).reshape(len(index) * self.num_classes, -1).T
+
+    def _solve(self, g):
+        """(H - U U^T)^{-1} g by the Woodbury identity on the Cholesky factor of H."""
+        a = torch.cholesky_solve(g[:, None], self.L)
+        if self.U.shape[1] > 0:
+            S = torch.eye(self.U.shape[1], dtype=g.dtype, device=g.device) - self.U.T @ self.Y
+            a = a + self.Y @ torch.linalg.solve(S, self.U.T @ a)
+        return a[:, 0]
+
+    def residual(self):
+        """||grad J_r(w)|| over the samples not removed."""
+        index = self.alive.nonzero()[:, 0]
+        error = self._prob(index) - F.one_hot(self.targets[index], self.num_classes).to(self.w.dtype)
+        return (error.T @ self.phi[index] + self.lam * (self.w - self.w0)).norm().item()
+
+    def sigma(self, residual):
+        return residual / self.lam * math.sqrt(2 * math.log(1.25 / self.delta)) / self.eps
+
+    def remove(self, indexes):
+        """Removes the training positions `indexes` (one request). Returns the gradient residual, the noise
+        scale of the released weights and the time taken."""
+        t0 = time.time()
+        index = torch.as_tensor(indexes, device=self.device)
+        index = index[self.alive[index]]
+        if len(index) > 0:
+            error = self._prob(index) - F.one_hot(self.targets[index], self.num_classes).to(self.w.dtype)
+            g = (error.T @ self.phi[index]).reshape(-1)
+            U = self._downdate(index)
+            if self.U.shape[1] + U.shape[1] > self.max_rank:
+                # fold all pending downdates into a new factor
+                self.H -= self.U @ self.U.T + U @ U.T
+                self._factor()
+            else:
+                self.U = torch.cat([self.U, U], dim=1)
+                self.Y = torch.cat([self.Y, torch.cholesky_solve(U, self.L)], dim=1)
+            self.w += self._solve(g).view_as(self.w)
+            self.alive[index] = False
+        residual = self.residual()
+        return {'removed': len(index), 'residual': residual, 'sigma': self.sigma(residual), 'seconds': time.time() - t0}
+
+    def apply(self, model, seed=None):
+        """Writes the head weights plus the calibrated Gaussian noise into `model`."""
+        generator = torch.Generator(device=self.device)
+        generator.manual_seed(seed if seed is not None else int(np.random.randint(2 ** 31)))
+        noise = torch.randn(self.w.shape, generator=generator, dtype=self.w.dtype, device=self.device)
+        w = self.w + self.sigma(self.residual()) * noise
+        head = last_linear(model)
+        with torch.no_grad():
+            head.weight.copy_(w[:, :head.weight.shape[1]])
+            if head.bias is not None:
+                head.bias.copy_(w[:, -1])
+        return model
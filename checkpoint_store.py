@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""Deduplicating, content-addressed checkpoint store.
+
+A checkpoint is a manifest, manifests/<name>.json, mapping every state_dict key to the SHA-256 of the
+tensor's content (with its dtype and shape). Each distinct tensor is stored once under objects/, so the
+init checkpoint shared by the train and forget runs, or layers frozen by --unfreeze-start, cost nothing
+after their first save. With `base=` (the previous epoch of the run), a changed tensor may instead be
+stored as a delta: the XOR of its bits with the base tensor, byte-shuffled and zlib-compressed. The
+delta is lossless, and since consecutive epochs share sign, exponent and high mantissa bits it typically
+compresses to a fraction of the raw size. Deltas chain at most `max_depth` levels before a full copy.
+
+    store = CheckpointStore('checkpoints/store')
+    store.save(model.state_dict(), f'{name}_{epoch}', base=f'{name}_{epoch-5}')
+    model.load_state_dict(store.load(f'{name}_{epoch}'))
+
+    python checkpoint_store.py import checkpoints/*.pt --delta   # migrate existing .pt files
+    python checkpoint_store.py stats
+    python checkpoint_store.py export <name> out.pt
+    python checkpoint_store.py gc                                # drop objects no manifest references
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import zlib
+from collections.abc import Mapping
+
+import torch
+
+_INT_VIEW = {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+
+def _dtype_name(dtype):
+    return str(dtype).replace('torch.', '')
+
+
+def _to_bytes(tensor):
+    tensor = tensor.detach().cpu().contiguous().reshape(-1)
+    return tensor.view(torch.uint8).numpy().tobytes()
+
+
+def _from_bytes(data, dtype, shape):
+    if len(data) == 0:
+        return torch.empty(shape, dtype=dtype)
+    return torch.frombuffer(bytearray(data), dtype=torch.uint8).view(dtype).reshape(shape)
+
+
+def tensor_hash(tensor, raw=None):
+    h = hashlib.sha256(f'{_dtype_name(tensor.dtype)}{tuple(tensor.shape)}'.encode())
+    h.update(_to_bytes(tensor) if raw is None else raw)
+    return h.hexdigest()
+
+
+def _xor_shuffled(a, b):
+    """XOR of the bit patterns of `a` and `b`, with the bytes grouped by significance."""
+    itemsize = a.element_size()
+    x = torch.bitwise_xor(a.detach().cpu().contiguous().reshape(-1).view(_INT_VIEW[itemsize]),
+                          b.detach().cpu().contiguous().reshape(-1).view(_INT_VIEW[itemsize]))
+    return x.view(torch.uint8).reshape(-1, itemsize).t().contiguous().numpy().tobytes()
+
+
+def _unxor_shuffled(data, base):
+    itemsize = base.element_size()
+    x = torch.frombuffer(bytearray(data), dtype=torch.uint8).reshape(itemsize, -1).t().contiguous()
+    x = torch.bitwise_xor(x.view(_INT_VIEW[itemsize]).reshape(-1), base.contiguous().reshape(-1).view(_INT_VIEW[itemsize]))
+    return x.view(base.dtype).reshape(base.shape)
+
+
+class CheckpointStore(object):
+
+    def __init__(self, root='checkpoints/store', max_depth=8, min_saving=0.2, level=1):
+        self.root = root
+        self.max_depth = max_depth
+        self.min_saving = min_saving
+        self.level = level
+        self._cache = {}
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'manifests'), exist_ok=True)
+
+    def _object(self, digest, kind):
+        return os.path.join(self.root, 'objects', digest[:2], f'{digest}.{kind}')
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.tmp{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _manifest_path(self, name):
+        return os.path.join(self.root, 'manifests', f'{name}.json')
+
+    def manifest(self, name):
+        with open(self._manifest_path(name)) as f:
+            return json.load(f)
+
+    def names(self):
+        return sorted(f[:-len('.json')] for f in os.listdir(os.path.join(self.root, 'manifests')) if f.endswith('.json'))
+
+    def __contains__(self, name):
+        return os.path.isfile(self._manifest_path(name))
+
+    def depth(self, digest):
+        if os.path.isfile(self._object(digest, 'raw')):
+            return 0
+        with open(self._object(digest, 'delta'), 'rb') as f:
+            return json.loads(f.readline())['depth']
+
+    def has(self, digest):
+        return os.path.isfile(self._object(digest, 'raw')) or os.path.isfile(self._object(digest, 'delta'))
+
+    def save(self, state_dict, name, base=None):
+        """Stores `state_dict` as checkpoint `name`; tensors that changed since checkpoint `base` may be
+        stored as deltas. Returns the number of bytes written."""
+        base_entries = self.manifest(base)['tensors'] if base is not None and base in self else {}
+        entries, written = {}, 0
+        for k, v in state_dict.items():
+            if not isinstance(v, torch.Tensor):
+                raise TypeError(f'{k}: only tensors can be stored, got {type(v).__name__}')
+            raw = _to_bytes(v)
+            digest = tensor_hash(v, raw)
+            entries[k] = {'dtype': _dtype_name(v.dtype), 'shape': list(v.shape), 'sha': digest}
+            if self.has(digest):
+                continue
+            b = base_entries.get(k)
+            if b is not None and b['dtype'] == entries[k]['dtype'] and b['shape'] == entries[k]['shape'] \
+                    and v.element_size() in _INT_VIEW and self.depth(b['sha']) < self.max_depth:
+                delta = zlib.compress(_xor_shuffled(v, self.get(b['sha'], b['dtype'], b['shape'])), self.level)
+                if len(delta) < (1 - self.min_saving) * len(raw):
+                    header = json.dumps({'base': b['sha'], 'depth': self.depth(b['sha']) + 1}).encode() + b'\n'
+                    self._write(self._object(digest, 'delta'), header + delta)
+                    written += len(header) + len(delta)
+                    continue
+            self._write(self._object(digest, 'raw'), raw)
+            written += len(raw)
+        manifest = json.dumps({'base': base, 'tensors': entries}, indent=1).encode()
+        self._write(self._manifest_path(name), manifest)
+        return written + len(manifest)
+
+    def get(self, digest, dtype, shape):
+        """The tensor with content hash `digest` (resolving delta chains)."""
+        if digest in self._cache:
+            return self._cache[digest]
+        dtype = getattr(torch, dtype) if isinstance(dtype, str) else dtype
+        if os.path.isfile(self._object(digest, 'raw')):
+            with open(self._object(digest, 'raw'), 'rb') as f:
+                tensor = _from_bytes(f.read(), dtype, shape)
+        else:
+            with open(self._object(digest, 'delta'), 'rb') as f:
+                header = json.loads(f.readline())
+                data = zlib.decompress(f.read())
+            tensor = _unxor_shuffled(data, self.get(header['base'], dtype, shape))
+            # only the end of the chain is kept: the next checkpoint of the run is usually a delta of it
+            self._cache = {digest: tensor}
+        return tensor
+
+    def load(self, name, device=None, keys=None):
+        """A lazy state_dict of checkpoint `name`: tensors are read when accessed."""
+        return LazyStateDict(self, self.manifest(name)['tensors'], device=device, keys=keys)
+
+    def gc(self):
+        """Deletes the objects no manifest references, directly or as the base of a delta."""
+        live, todo = set(), [e['sha'] for n in self.names() for e in self.manifest(n)['tensors'].values()]
+        while todo:
+            digest = todo.pop()
+            if digest in live:
+                continue
+            live.add(digest)
+            if os.path.isfile(self._object(digest, 'delta')):
+                with open(self._object(digest, 'delta'), 'rb') as f:
+                    todo.append(json.loads(f.readline())['base'])
+        freed = 0
+        for d, _, files in os.walk(os.path.join(self.root, 'objects')):
+            for f in files:
+                if f.split('.')[0] not in live:
+                    freed += os.path.getsize(os.path.join(d, f))
+                    os.remove(os.path.join(d, f))
+        return freed
+
+    def disk_usage(self):
+        return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(self.root) for f in files)
+
+
+class LazyStateDict(Mapping):
+    """Read-only state_dict whose tensors are only read from the store when accessed. Pass it to
+    `model.load_state_dict`, or index it to read single entries (e.g. only the classifier)."""
+
+    def __init__(self, store, entries, device=None, keys=None):
+        self.store = store
+        self.entries = entries if keys is None else {k: entries[k] for k in keys}
+        self.device = device
+        self._loaded = {}
+
+    def __getitem__(self, key):
+        if key not in self._loaded:
+            e = self.entries[key]
+            tensor = self.store.get(e['sha'], e['dtype'], e['shape'])
+            # copies: the store keeps the last tensor of a delta chain cached
+            self._loaded[key] = tensor.to(self.device, copy=True) if self.device is not None else tensor.clone()
+        return self._loaded[key]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def load_checkpoint(path, map_location=None, store_root='checkpoints/store'):
+    """state_dict of a `.pt` or `.mmpt` file, or of the checkpoint named `path` in the store at `store_root`."""
+    if os.path.isfile(path):
+        if path.endswith('.mmpt'):
+            from mmap_checkpoint import load_mmap
+            state_dict = load_mmap(path)
+            return state_dict if map_location is None else {k: v.to(map_location) for k, v in state_dict.items()}
+        return torch.load(path, map_location=map_location)
+    name = os.path.splitext(os.path.basename(path))[0]
+    return dict(CheckpointStore(store_root).load(name, device=map_location))
+
+
+def _run_and_epoch(name):
+    m = re.match(r'(.*)_(\d+|init)$', name)
+    return (m.group(1), int(m.group(2)) if m.group(2) != 'init' else -1) if m else (name, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['import', 'export', 'stats', 'gc'])
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('--root', type=str, default='checkpoints/store')
+    parser.add_argument('--delta', action='store_true', default=False,
+                        help='Store each epoch as a delta of the previous epoch of its run')
+    parser.add_argument('--max-depth', type=int, default=8)
+    args = parser.parse_args()
+    store = CheckpointStore(args.root, max_depth=args.max_depth)
+
+    if args.command == 'import':
+        names = {os.path.splitext(os.path.basename(p))[0]: p for p in args.paths}
+        # epochs of a run in order, so that every checkpoint can be a delta of the previous one
+        ordered = sorted(names, key=_run_and_epoch)
+        size_in = size_out = 0
+        prev_run, prev_name = None, None
+        for name in ordered:
+            run, _ = _run_and_epoch(name)
+            base = prev_name if args.delta and run == prev_run else None
+            size_in += os.path.getsize(names[name])
+            size_out += store.save(torch.load(names[name], map_location='cpu'), name, base=base)
+            prev_run, prev_name = run, name
+        print(f'Imported {len(names)} checkpoints: {size_in / 2 ** 20:.1f} MB -> {size_out / 2 ** 20:.1f} MB written')
+    elif args.command == 'export':
+        name, out = args.paths
+        torch.save(dict(store.load(name)), out)
+    elif args.command == 'stats':
+        print(f'{len(store.names())} checkpoints, {store.disk_usage() / 2 ** 20:.1f} MB')
+    elif args.command == 'gc':
+        print(f'Freed {store.gc() / 2 ** 20:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
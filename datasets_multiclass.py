@@ -5,13 +5,6 @@ import copy
 import numpy as np
 
 import torch
-import torchvision
-import torchvision.transforms as transforms
-from lacuna import Lacuna10, Lacuna100, Small_Lacuna10, Small_Binary_Lacuna10, Small_Lacuna5, Small_Lacuna6
-from Small_CIFAR10 import Small_CIFAR10, Small_Binary_CIFAR10, Small_CIFAR5, Small_CIFAR6
-from Small_MNIST import Small_MNIST, Small_Binary_MNIST
-from TinyImageNet import TinyImageNet_pretrain, TinyImageNet_finetune, TinyImageNet_finetune5
-from IPython import embed
 
 
 def manual_seed(seed):
@@ -31,7 +24,69 @@ def _add_dataset(dataset_fn):
     return dataset_fn
 
 
+# (dataset_name, root, seed, dataset_kwargs) -> (train_set, test_set), filled by `register_shared_datasets`.
+# `get_loaders` takes shallow copies and never writes to the cached `.data` arrays. The seed is part of
+# the key since some datasets (small_mnist, small_cifar10) draw their subset with np.random on init.
+_DATASET_CACHE = {}
+
+
+def _dataset_key(dataset_name, root, seed, dataset_kwargs):
+    return dataset_name, root, seed, tuple(sorted(dataset_kwargs.items()))
+
+
+def load_shared_dataset(dataset_name, root=None, seed=1, **dataset_kwargs):
+    """Builds the train and test sets once, seeded as `get_loaders` does, and moves their `.data` into
+    shared memory.
+
+    The returned entry pickles through torch.multiprocessing by shared-memory handle, so
+    worker processes can pass it to `register_shared_datasets` without copying the data.
+    """
+    if root is None:
+        root = os.path.expanduser('~/data')
+    manual_seed(seed)
+    shared = []
+    for dataset in _DATASETS[dataset_name](root, **dataset_kwargs):
+        is_numpy = isinstance(dataset.data, np.ndarray)
+        data = torch.from_numpy(np.ascontiguousarray(dataset.data)) if is_numpy else dataset.data.clone()
+        dataset = copy.copy(dataset)
+        dataset.data = None
+        shared.append((dataset, data.share_memory_(), is_numpy))
+    return _dataset_key(dataset_name, root, seed, dataset_kwargs), shared
+
+
+def register_shared_datasets(entries):
+    """Makes `get_loaders` serve the datasets in `entries` (from `load_shared_dataset`) from shared memory."""
+    for key, shared in entries:
+        sets = []
+        for dataset, data, is_numpy in shared:
+            dataset = copy.copy(dataset)
+            dataset.data = data.numpy() if is_numpy else data
+            sets.append(dataset)
+        _DATASET_CACHE[key] = tuple(sets)
+
+
+class IndexedDataset(torch.utils.data.Dataset):
+    """Yields (data, target, index), where index is the position of the sample in `dataset`.
+    Other attributes (`data`, `targets`, ...) are those of the wrapped dataset."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        data, target = self.dataset[index]
+        return data, target, index
+
+    def __getattr__(self, name):
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+
 def _get_mnist_transforms(augment=True):
+    import torchvision.transforms as transforms
     transform_augment = transforms.Compose([
         transforms.Pad(padding=2),
         transforms.RandomCrop(32, padding=4),
@@ -47,6 +102,7 @@ def _get_mnist_transforms(augment=True):
 
 
 def _get_lacuna_transforms(augment=True):
+    import torchvision.transforms as transforms
     transform_augment = transforms.Compose([
         transforms.RandomCrop(64, padding=4),
         transforms.Resize(size=(32, 32)),
@@ -65,6 +121,7 @@ def _get_lacuna_transforms(augment=True):
 
 
 def _get_cifar_transforms(augment=True):
+    import torchvision.transforms as transforms
     transform_augment = transforms.Compose([
         transforms.Pad(padding=4, fill=(125, 123, 113)),
         transforms.RandomCrop(32, padding=0),
@@ -82,6 +139,7 @@ def _get_cifar_transforms(augment=True):
 
 
 def _get_imagenet_transforms(augment=True):
+    import torchvision.transforms as transforms
     transform_augment = transforms.Compose([
         transforms.RandomCrop(64, padding=4),
         transforms.Resize(size=(32, 32)),
@@ -100,6 +158,7 @@ def _get_imagenet_transforms(augment=True):
 
 
 def _get_mix_transforms(augment=True):
+    import torchvision.transforms as transforms
     transform_augment = transforms.Compose([
         transforms.Resize(size=(32, 32)),
         transforms.RandomCrop(32, padding=4),
@@ -118,6 +177,7 @@ def _get_mix_transforms(augment=True):
 
 @_add_dataset
 def cifar10(root, augment=False):
+    import torchvision
     transform_train, transform_test = _get_cifar_transforms(augment=augment)
     train_set = torchvision.datasets.CIFAR10(root=root, train=True, download=True, transform=transform_train)
     test_set = torchvision.datasets.CIFAR10(root=root, train=False, download=True, transform=transform_test)
@@ -126,6 +186,7 @@ def cifar10(root, augment=False):
 
 @_add_dataset
 def small_cifar5(root, augment=False):
+    from Small_CIFAR10 import Small_CIFAR5
     transform_train, transform_test = _get_cifar_transforms(augment=augment)
     train_set = Small_CIFAR5(root=root, train=True, transform=transform_train)
     test_set = Small_CIFAR5(root=root, train=False, transform=transform_test)
@@ -134,6 +195,7 @@ def small_cifar5(root, augment=False):
 
 @_add_dataset
 def small_cifar6(root, augment=False):
+    from Small_CIFAR10 import Small_CIFAR6
     transform_train, transform_test = _get_cifar_transforms(augment=augment)
     train_set = Small_CIFAR6(root=root, train=True, transform=transform_train)
     test_set = Small_CIFAR6(root=root, train=False, transform=transform_test)
@@ -142,6 +204,7 @@ def small_cifar6(root, augment=False):
 
 @_add_dataset
 def small_cifar10(root, augment=False):
+    from Small_CIFAR10 import Small_CIFAR10
     transform_train, transform_test = _get_cifar_transforms(augment=augment)
     train_set = Small_CIFAR10(root=root, train=True, transform=transform_train)
     test_set = Small_CIFAR10(root=root, train=False, transform=transform_test)
@@ -150,6 +213,7 @@ def small_cifar10(root, augment=False):
 
 @_add_dataset
 def small_binary_cifar10(root, augment=False):
+    from Small_CIFAR10 import Small_Binary_CIFAR10
     transform_train, transform_test = _get_cifar_transforms(augment=augment)
     train_set = Small_Binary_CIFAR10(root=root, train=True, transform=transform_train)
     test_set = Small_Binary_CIFAR10(root=root, train=False, transform=transform_test)
@@ -158,6 +222,7 @@ def small_binary_cifar10(root, augment=False):
 
 @_add_dataset
 def cifar100(root, augment=False):
+    import torchvision
     transform_train, transform_test = _get_cifar_transforms(augment=augment)
     train_set = torchvision.datasets.CIFAR100(root=root, train=True, download=True, transform=transform_train)
     test_set = torchvision.datasets.CIFAR100(root=root, train=False, download=True, transform=transform_test)
@@ -166,6 +231,7 @@ def cifar100(root, augment=False):
 
 @_add_dataset
 def mnist(root, augment=False):
+    import torchvision
     transform_train, transform_test = _get_mnist_transforms(augment=augment)
     train_set = torchvision.datasets.MNIST(root=root, train=True, download=True, transform=transform_train)
     test_set = torchvision.datasets.MNIST(root=root, train=False, download=True, transform=transform_test)
@@ -174,6 +240,7 @@ def mnist(root, augment=False):
 
 @_add_dataset
 def small_mnist(root, augment=False):
+    from Small_MNIST import Small_MNIST
     transform_train, transform_test = _get_mnist_transforms(augment=augment)
     train_set = Small_MNIST(root=root, train=True, transform=transform_train)
     test_set = Small_MNIST(root=root, train=False, transform=transform_test)
@@ -181,6 +248,7 @@ def small_mnist(root, augment=False):
 
 @_add_dataset
 def lacuna100(root, augment=False):
+    from lacuna import Lacuna100
     transform_train, transform_test = _get_lacuna_transforms(augment=augment)
     train_set = Lacuna100(root=root, train=True, transform=transform_train)
     test_set = Lacuna100(root=root, train=False, transform=transform_test)
@@ -189,6 +257,7 @@ def lacuna100(root, augment=False):
 
 @_add_dataset
 def lacuna10(root, augment=False):
+    from lacuna import Lacuna10
     transform_train, transform_test = _get_lacuna_transforms(augment=augment)
     train_set = Lacuna10(root=root, train=True, transform=transform_train)
     test_set = Lacuna10(root=root, train=False, transform=transform_test)
@@ -197,6 +266,7 @@ def lacuna10(root, augment=False):
 
 @_add_dataset
 def small_lacuna5(root, augment=False):
+    from lacuna import Small_Lacuna5
     transform_train, transform_test = _get_lacuna_transforms(augment=augment)
     train_set = Small_Lacuna5(root=root, train=True, transform=transform_train)
     test_set = Small_Lacuna5(root=root, train=False, transform=transform_test)
@@ -205,6 +275,7 @@ def small_lacuna5(root, augment=False):
 
 @_add_dataset
 def small_lacuna6(root, augment=False):
+    from lacuna import Small_Lacuna6
     transform_train, transform_test = _get_lacuna_transforms(augment=augment)
     train_set = Small_Lacuna6(root=root, train=True, transform=transform_train)
     test_set = Small_Lacuna6(root=root, train=False, transform=transform_test)
@@ -213,6 +284,7 @@ def small_lacuna6(root, augment=False):
 
 @_add_dataset
 def small_lacuna10(root, augment=False):
+    from lacuna import Small_Lacuna10
     transform_train, transform_test = _get_lacuna_transforms(augment=augment)
     train_set = Small_Lacuna10(root=root, train=True, transform=transform_train)
     test_set = Small_Lacuna10(root=root, train=False, transform=transform_test)
@@ -221,6 +293,7 @@ def small_lacuna10(root, augment=False):
 
 @_add_dataset
 def small_binary_lacuna10(root, augment=False):
+    from lacuna import Small_Binary_Lacuna10
     transform_train, transform_test = _get_lacuna_transforms(augment=augment)
     train_set = Small_Binary_Lacuna10(root=root, train=True, transform=transform_train)
     test_set = Small_Binary_Lacuna10(root=root, train=False, transform=transform_test)
@@ -229,6 +302,7 @@ def small_binary_lacuna10(root, augment=False):
 
 @_add_dataset
 def tinyimagenet_pretrain(root, augment=False):
+    from TinyImageNet import TinyImageNet_pretrain
     transform_train, transform_test = _get_imagenet_transforms(augment=augment)
     train_set = TinyImageNet_pretrain(root=root, train=True, transform=transform_train)
     test_set = TinyImageNet_pretrain(root=root, train=False, transform=transform_test)
@@ -237,6 +311,7 @@ def tinyimagenet_pretrain(root, augment=False):
 
 @_add_dataset
 def tinyimagenet_finetune(root, augment=False):
+    from TinyImageNet import TinyImageNet_finetune
     transform_train, transform_test = _get_imagenet_transforms(augment=augment)
     train_set = TinyImageNet_finetune(root=root, train=True, transform=transform_train)
     test_set = TinyImageNet_finetune(root=root, train=False, transform=transform_test)
@@ -245,6 +320,7 @@ def tinyimagenet_finetune(root, augment=False):
 
 @_add_dataset
 def tinyimagenet_finetune5(root, augment=False):
+    from TinyImageNet import TinyImageNet_finetune5
     transform_train, transform_test = _get_imagenet_transforms(augment=augment)
     train_set = TinyImageNet_finetune5(root=root, train=True, transform=transform_train)
     test_set = TinyImageNet_finetune5(root=root, train=False, transform=transform_test)
@@ -253,6 +329,8 @@ def tinyimagenet_finetune5(root, augment=False):
 
 @_add_dataset
 def mix10(root, augment=False):
+    import torchvision
+    from lacuna import Lacuna10
     transform_train, transform_test = _get_mix_transforms(augment=augment)
     lacuna_train_set = Lacuna10(root=root, train=True, transform=transform_train)
     lacuna_test_set = Lacuna10(root=root, train=False, transform=transform_test)
@@ -280,6 +358,8 @@ def mix10(root, augment=False):
 
 @_add_dataset
 def mix100(root, augment=False):
+    import torchvision
+    from lacuna import Lacuna100
     transform_train, transform_test = _get_mix_transforms(augment=augment)
     lacuna_train_set = Lacuna100(root=root, train=True, transform=transform_train)
     lacuna_test_set = Lacuna100(root=root, train=False, transform=transform_test)
@@ -377,7 +457,7 @@ def confuse_class(dataset: torch.utils.data.Dataset, class_to_replace: List[int]
 def get_loaders(dataset_name, class_to_replace: List[int] = None, num_indexes_to_replace: int = None,
                 indexes_to_replace: List[int] = None, confuse_mode: bool = False, seed: int = 1,
                 only_mark: bool = False,
-                root: str = None, batch_size=128, shuffle=True, split: str = 'train',
+                root: str = None, batch_size=128, shuffle=True, split: str = 'train', return_index: bool = False,
                 **dataset_kwargs):
     '''
     :param dataset_name: Name of dataset to use
@@ -391,17 +471,25 @@ def get_loaders(dataset_name, class_to_replace: List[int] = None, num_indexes_to
     :param root: Root directory to initialize the dataset
     :param batch_size: Batch size of data loader
     :param shuffle: Whether train data should be randomly shuffled when loading (test data are never shuffled)
+    :param return_index: If True, the loaders yield (data, target, index) with the position of each sample in its
+                         split (see `IndexedDataset`)
     :param dataset_kwargs: Extra arguments to pass to the dataset init.
     :return: The train_loader and test_loader
     '''
     manual_seed(seed)
     if root is None:
         root = os.path.expanduser('~/data')
-    train_set, test_set = _DATASETS[dataset_name](root, **dataset_kwargs)
+    key = _dataset_key(dataset_name, root, seed, dataset_kwargs)
+    if key in _DATASET_CACHE:
+        train_set, test_set = [copy.copy(dataset) for dataset in _DATASET_CACHE[key]]
+    else:
+        train_set, test_set = _DATASETS[dataset_name](root, **dataset_kwargs)
     train_set.targets = np.array(train_set.targets)
     test_set.targets = np.array(test_set.targets)
 
-    valid_set = copy.deepcopy(train_set)
+    # Shallow copies: `.data` and `.targets` are only ever replaced by fresh (fancy-indexed) arrays
+    # below, so the split never needs to duplicate the full dataset.
+    valid_set = copy.copy(train_set)
     rng = np.random.RandomState(seed)
 
     valid_idx = []
@@ -412,7 +500,7 @@ def get_loaders(dataset_name, class_to_replace: List[int] = None, num_indexes_to
 
     train_idx = list(set(range(len(train_set))) - set(valid_idx))
 
-    train_set_copy = copy.deepcopy(train_set)
+    train_set_copy = copy.copy(train_set)
 
     train_set.data = train_set_copy.data[train_idx]
     train_set.targets = train_set_copy.targets[train_idx]
@@ -471,6 +559,9 @@ def get_loaders(dataset_name, class_to_replace: List[int] = None, num_indexes_to
     elif indexes_to_replace is not None:
         replace_indexes(dataset=train_set, indexes=indexes_to_replace, seed=seed - 1, only_mark=only_mark)
 
+    if return_index:
+        train_set, valid_set, test_set = IndexedDataset(train_set), IndexedDataset(valid_set), IndexedDataset(test_set)
+
     loader_args = {'num_workers': 0, 'pin_memory': False}
 
     def _init_fn(worker_id):
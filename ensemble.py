@@ -0,0 +1,104 @@
+import copy
+
+import torch
+from torch.func import stack_module_state, functional_call, vmap
+
+from utils import AverageMeter, set_batchnorm_mode
+
+ENSEMBLE_MODELS = ['mlp', 'smallallcnn', 'resnet_small']
+
+
+class StackedEnsemble(object):
+    """S independent copies of one architecture trained as a single model.
+
+    Parameters and buffers of all copies are stacked along a new leading dimension
+    and the forward pass is vectorized over it with `torch.func.vmap`, so a batch
+    of shape [S, B, ...] runs copy s on slice s. BatchNorm running statistics are
+    stacked as well and are updated per copy.
+    """
+
+    def __init__(self, model_list):
+        self.num_models = len(model_list)
+        self.keys = list(model_list[0].state_dict().keys())
+        self.params, self.buffers = stack_module_state(model_list)
+        self.base = copy.deepcopy(model_list[0]).to('meta')
+
+    def train(self):
+        self.base.train()
+
+    def eval(self):
+        self.base.eval()
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def _forward(self, params, buffers, x):
+        return functional_call(self.base, (params, buffers), (x,))
+
+    def __call__(self, x):
+        return vmap(self._forward, randomness='different')(self.params, self.buffers, x)
+
+    def load_buffers(self, index, model):
+        """Copies the buffers (BatchNorm statistics) of the standalone `model` into copy `index`."""
+        with torch.no_grad():
+            for k, b in model.named_buffers():
+                self.buffers[k][index].copy_(b)
+
+    def state_dict(self, index):
+        """Returns the state_dict of copy `index` in the layout of a standalone model."""
+        tensors = dict(self.params, **self.buffers)
+        return {k: tensors[k][index].detach().clone() for k in self.keys}
+
+
+def stacked_l2_penalty(ensemble, params_init, weight_decay):
+    """Per-copy `l2_penalty`, returned as a tensor of shape [S]."""
+    l2_loss = 0
+    for k, p in ensemble.params.items():
+        if p.requires_grad:
+            l2_loss += (p - params_init[k]).pow(2).flatten(1).sum(1)
+    l2_loss *= (weight_decay / 2.)
+    return l2_loss
+
+
+def run_ensemble_epoch(args, ensemble, params_init, loaders, criterion, optimizer=None, weight_decay=0.0, mode='train'):
+    """One epoch over S loaders in lockstep, one loader (and one shuffling) per copy.
+
+    Returns one AverageMeter per copy. The loss is the sum of the per-copy losses,
+    so every copy receives exactly the gradient of its standalone run.
+    """
+    if mode == 'train':
+        ensemble.train()
+    elif mode == 'test':
+        ensemble.eval()
+    else:
+        raise ValueError("Invalid mode.")
+
+    if args.disable_bn:
+        set_batchnorm_mode(ensemble.base, train=False)
+
+    metrics = [AverageMeter() for _ in range(ensemble.num_models)]
+
+    with torch.set_grad_enabled(mode != 'test'):
+        for batches in zip(*loaders):
+            data = torch.stack([d for d, _ in batches]).to(args.device)
+            target = torch.stack([t for _, t in batches]).to(args.device)
+
+            if 'mnist' in args.dataset:
+                data = data.view(data.shape[0], data.shape[1], -1)
+
+            output = ensemble(data)
+            per_model_loss = torch.stack([criterion(output[s], target[s]) for s in range(ensemble.num_models)])
+            per_model_loss = per_model_loss + stacked_l2_penalty(ensemble, params_init, weight_decay)
+            loss = per_model_loss.sum()
+
+            with torch.no_grad():
+                error = output.argmax(dim=-1).ne(target).float().mean(dim=1)
+            for s, m in enumerate(metrics):
+                m.update(n=data.size(1), loss=per_model_loss[s].item(), error=error[s].item())
+
+            if mode == 'train':
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+    return metrics
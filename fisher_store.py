@@ -0,0 +1,108 @@
+"""Persistent Fisher-diagonal artifacts.
+
+A FisherArtifact holds the Fisher diagonal of a trained model (`unlearning.fisher_diagonal`) and the
+trained weights it was estimated at, each as one flat buffer with a view per parameter, in place of the
+`p.grad2_acc` and `p.data0` attributes the notebooks set on the parameters. `get_mean_var`,
+`fisher_forget` and `fisher_kl` take the artifact as their `fisher`, so once it is on disk every value
+of alpha only costs the noise injection. Artifacts are saved under `root` by the hash of the checkpoint
+content, of the split manifest and of the estimator settings, so the notebooks recompute one only when
+one of them changes.
+
+    fisher = load_or_compute(model, manifest, args)               # retain set of the split
+    fisher0 = load_or_compute(model0, manifest, args)
+    model = unlearning.fisher_forget(model, fisher, args, alpha=1e-6)
+    kl = unlearning.fisher_kl(fisher, fisher0, args, alpha=1e-7)
+"""
+import hashlib
+import json
+import os
+
+import torch
+
+import unlearning
+from checkpoint_store import tensor_hash
+
+
+def state_dict_hash(state_dict):
+    h = hashlib.sha256()
+    for k in sorted(state_dict):
+        h.update(f'{k}:{tensor_hash(state_dict[k])}'.encode())
+    return h.hexdigest()
+
+
+def manifest_hash(manifest):
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+
+def fisher_key(state_dict, manifest, settings):
+    spec = dict(checkpoint=state_dict_hash(state_dict), manifest=manifest_hash(manifest), settings=settings)
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+class FisherArtifact(object):
+    """Fisher diagonal `diag` and trained weights `params` (flat buffers) of the parameters `names`.
+    `fisher[name]` is the Fisher diagonal of a parameter, `fisher.param(name)` its trained weights."""
+
+    def __init__(self, names, shapes, diag, params, meta=None):
+        self.names = list(names)
+        self.shapes = [torch.Size(s) for s in shapes]
+        self.diag = diag
+        self.params = params
+        self.meta = meta or {}
+        numels = [s.numel() for s in self.shapes]
+        self._diag = dict(zip(self.names, (d.view(s) for d, s in zip(diag.split(numels), self.shapes))))
+        self._params = dict(zip(self.names, (p.view(s) for p, s in zip(params.split(numels), self.shapes))))
+
+    @classmethod
+    def from_model(cls, model, fisher, meta=None):
+        """Artifact of the dict `fisher` of `unlearning.fisher_diagonal` and the weights of `model`."""
+        named = [(k, p) for k, p in model.named_parameters() if k in fisher]
+        return cls([k for k, _ in named], [p.shape for _, p in named],
+                   torch.cat([fisher[k].detach().reshape(-1) for k, _ in named]),
+                   torch.cat([p.detach().reshape(-1) for _, p in named]), meta)
+
+    def __getitem__(self, name):
+        return self._diag[name]
+
+    def __contains__(self, name):
+        return name in self._diag
+
+    def keys(self):
+        return list(self.names)
+
+    def param(self, name):
+        return self._params[name]
+
+    def to(self, device):
+        return FisherArtifact(self.names, self.shapes, self.diag.to(device), self.params.to(device), self.meta)
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        torch.save(dict(names=self.names, shapes=[list(s) for s in self.shapes], diag=self.diag.cpu(),
+                        params=self.params.cpu(), meta=self.meta), tmp)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, device=None):
+        state = torch.load(path, map_location=device)
+        return cls(state['names'], state['shapes'], state['diag'], state['params'], state['meta'])
+
+
+def estimate(model, manifest, args, subset='retain', batch_size=128):
+    """Fisher artifact of `model` on the `subset` ('retain', 'forget' or 'train') of the split `manifest`."""
+    train_set, retain_set, forget_set, _ = unlearning.split_datasets(manifest)
+    dataset = dict(train=train_set, retain=retain_set, forget=forget_set)[subset]
+    fisher = unlearning.fisher_diagonal(model, dataset, args, batch_size=batch_size)
+    return FisherArtifact.from_model(model, fisher, meta=dict(subset=subset, batch_size=batch_size, num_samples=len(dataset)))
+
+
+def load_or_compute(model, manifest, args, subset='retain', batch_size=128, root='checkpoints/fisher'):
+    """The Fisher artifact of `model` on `subset` of the split, loaded from `root` if it was saved before."""
+    settings = dict(estimator='fisher_diagonal', subset=subset, batch_size=batch_size)
+    path = os.path.join(root, fisher_key(model.state_dict(), manifest, settings) + '.pt')
+    if os.path.isfile(path):
+        return FisherArtifact.load(path, device=args.device)
+    fisher = estimate(model, manifest, args, subset=subset, batch_size=batch_size)
+    os.makedirs(root, exist_ok=True)
+    fisher.save(path)
+    return fisher
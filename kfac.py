@@ -0,0 +1,145 @@
+"""Kronecker-factored (K-FAC) Fisher information for Fisher forgetting.
+
+For a Linear or Conv2d layer with weights W [out, in] (a conv kernel flattened as by F.unfold, the bias
+as an extra input column of ones), the Fisher of vec(W) is approximated by A kron G (Martens & Grosse,
+2015; Grosse & Martens, 2016 for convolutions): A the second moment of the layer inputs (patches,
+averaged over spatial locations) and G the second moment of the loss gradients w.r.t. the layer
+outputs (summed over locations), with labels sampled from the model. Both factors accumulate over
+batched forward/backward passes through hooks, so estimating them costs about one training epoch.
+
+In the eigenbases A = Q_A diag(a) Q_A^T, G = Q_G diag(g) Q_G^T the Fisher is diagonal with eigenvalues
+g_i a_j; `kfac_forget` draws the Fisher forgetting noise there, W = mu + Q_G (var.sqrt() * eps) Q_A^T,
+with var computed from g_i a_j as `unlearning.get_mean_var` does from the diagonal Fisher.
+
+    fisher = KFACFisher.estimate(model, retain_set, args)
+    model = kfac_forget(model, fisher, args, alpha=1e-6)
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from unlearning import get_mean_var
+
+
+def kfac_modules(model):
+    """{name: module} of the layers K-FAC covers: Linear and ungrouped Conv2d layers of the standard
+    parameterization (the NTK-scaled layers of models.py, with a `scale`, are left out)."""
+    return {name: m for name, m in model.named_modules()
+            if (isinstance(m, nn.Linear) or isinstance(m, nn.Conv2d) and m.groups == 1) and not hasattr(m, 'scale')}
+
+
+def _inputs(module, x):
+    """Layer inputs as rows [samples * locations, in (+1)], and the number of locations."""
+    if isinstance(module, nn.Conv2d):
+        x = F.unfold(x, module.kernel_size, dilation=module.dilation, padding=module.padding, stride=module.stride)
+        locations = x.shape[2]
+        x = x.transpose(1, 2).reshape(-1, x.shape[1])
+    else:
+        x, locations = x.reshape(-1, x.shape[-1]), 1
+    if module.bias is not None:
+        x = torch.cat([x, x.new_ones(len(x), 1)], dim=1)
+    return x, locations
+
+
+def _weight_matrix(module):
+    w = module.weight.detach().reshape(module.weight.shape[0], -1)
+    if module.bias is not None:
+        w = torch.cat([w, module.bias.detach()[:, None]], dim=1)
+    return w
+
+
+class KFACFisher(object):
+
+    def __init__(self, factors):
+        self.factors = factors
+        self._eigen = {}
+
+    @classmethod
+    def estimate(cls, model, dataset, args, batch_size=64, num_samples=None):
+        """K-FAC factors of `model` on `dataset` (its first `num_samples` samples, if given)."""
+        model.eval()
+        modules = kfac_modules(model)
+        A = {name: 0. for name in modules}
+        G = {name: 0. for name in modules}
+
+        def forward_hook(name):
+            def hook(module, input, output):
+                x, locations = _inputs(module, input[0].detach())
+                A[name] = A[name] + x.T @ x / locations
+                if output.requires_grad:
+                    output.register_hook(backward_hook(name, module))
+            return hook
+
+        def backward_hook(name, module):
+            def hook(grad):
+                g = grad.detach()
+                if isinstance(module, nn.Conv2d):
+                    g = g.flatten(2).transpose(1, 2)
+                g = g.reshape(-1, g.shape[-1])
+                G[name] = G[name] + g.T @ g
+            return hook
+
+        handles = [m.register_forward_hook(forward_hook(name)) for name, m in modules.items()]
+        if num_samples is not None and num_samples < len(dataset):
+            dataset = torch.utils.data.Subset(dataset, range(num_samples))
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+        generator = torch.Generator(device=args.device).manual_seed(args.seed)
+        try:
+            for data, _ in loader:
+                output = model(data.to(args.device))
+                # labels drawn from the model: the true Fisher, not the empirical one
+                target = torch.multinomial(F.softmax(output.detach(), dim=1), 1, generator=generator).squeeze(1)
+                model.zero_grad()
+                # summed, so that the output gradients are per-sample
+                F.cross_entropy(output, target, reduction='sum').backward()
+        finally:
+            for handle in handles:
+                handle.remove()
+        model.zero_grad()
+        return cls({name: {'A': A[name] / len(dataset), 'G': G[name] / len(dataset)} for name in modules})
+
+    def eigen(self, name):
+        """(a, Q_A, g, Q_G) of layer `name`, computed once."""
+        if name not in self._eigen:
+            a, Q_A = torch.linalg.eigh(self.factors[name]['A'])
+            g, Q_G = torch.linalg.eigh(self.factors[name]['G'])
+            self._eigen[name] = a.clamp(min=0), Q_A, g.clamp(min=0), Q_G
+        return self._eigen[name]
+
+    def state_dict(self):
+        return {name: {k: v.cpu() for k, v in f.items()} for name, f in self.factors.items()}
+
+    @classmethod
+    def from_state_dict(cls, state_dict, device=None):
+        return cls({name: {k: v.to(device) for k, v in f.items()} for name, f in state_dict.items()})
+
+
+def kfac_forget(model, fisher, args, alpha=1e-6, seed=None, fisher_diag=None):
+    """Fisher forgetting with the noise of every K-FAC layer drawn in its eigenbasis. Other parameters
+    (BatchNorm) get the diagonal noise of `get_mean_var` from `fisher_diag`, or are kept without it."""
+    torch.manual_seed(args.seed if seed is None else seed)
+    modules = kfac_modules(model)
+    covered = set()
+    with torch.no_grad():
+        for name, module in modules.items():
+            a, Q_A, g, Q_G = fisher.eigen(name)
+            mu = _weight_matrix(module)
+            is_classifier = mu.shape[0] == args.num_classes
+            var = (1. / (g[:, None] * a[None, :] + 1e-8)).clamp(max=1e2 if is_classifier else 1e3) * alpha
+            if is_classifier:
+                var *= 10
+            w = mu + Q_G @ (var.sqrt() * torch.randn_like(mu)) @ Q_A.T
+            if is_classifier and args.num_to_forget is None:
+                # as in get_mean_var: the forgotten class is zeroed up to a small noise
+                w[args.forget_class] = 1e-3 ** 0.5 * torch.randn_like(w[args.forget_class])
+            module.weight.copy_(w[:, :module.weight[0].numel()].view_as(module.weight))
+            covered.add(id(module.weight))
+            if module.bias is not None:
+                module.bias.copy_(w[:, -1])
+                covered.add(id(module.bias))
+        if fisher_diag is not None:
+            for k, p in model.named_parameters():
+                if id(p) not in covered:
+                    mu, var = get_mean_var(p, fisher_diag[k], args, alpha=alpha)
+                    p.copy_(mu + var.sqrt() * torch.empty_like(p).normal_())
+    return model
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Append-only ledger of the optimizer steps of a training run (main.py --ledger).
+
+For every step the ledger stores the training positions of the samples in the batch and the parameter
+update of the step, compressed: 'int8' quantizes it in chunks of CHUNK values with one fp32 scale each
+(~1 byte per parameter), 'topk' keeps the largest --ledger-topk fraction of the entries as int32
+positions and fp16 values. The compression error is carried over into the next step (error feedback),
+so the recorded updates sum to the total change of the parameters up to the error of the last step.
+Undoing the steps whose batch held a forget sample is amnesiac unlearning (Graves et al., 2021).
+
+    python ledger.py info checkpoints/<name>.ledger
+    python ledger.py rollback checkpoints/<name>.ledger --checkpoint checkpoints/<name>_30.pt \
+        --manifest split.json --out rolled_back.pt
+
+The file is an 8-byte magic, the 8-byte length of a JSON header (parameter names and shapes,
+compression), then one record per step: '<QQQ' (step, number of indices, payload bytes), the int64
+indices and the payload.
+"""
+import argparse
+import json
+import struct
+import time
+
+import numpy as np
+import torch
+
+MAGIC = b'LEDGER01'
+CHUNK = 4096
+_RECORD = struct.Struct('<QQQ')
+
+
+def _compress(delta, compression, topk):
+    """(payload bytes, decompressed delta) of the flat update `delta`."""
+    if compression == 'int8':
+        padded = torch.cat([delta, delta.new_zeros(-len(delta) % CHUNK)]).view(-1, CHUNK)
+        scale = padded.abs().amax(1, keepdim=True).clamp_min(1e-30) / 127
+        q = (padded / scale).round_().clamp_(-127, 127).to(torch.int8)
+        approx = (q.float() * scale).view(-1)[:len(delta)]
+        return scale.cpu().numpy().astype(np.float32).tobytes() + q.cpu().numpy().tobytes(), approx
+    if compression == 'topk':
+        k = max(1, int(topk * len(delta)))
+        positions = delta.abs().topk(k, sorted=False)[1]
+        values = delta[positions].half()
+        approx = torch.zeros_like(delta)
+        approx[positions] = values.float()
+        return positions.int().cpu().numpy().tobytes() + values.cpu().numpy().tobytes(), approx
+    raise ValueError(f'Unknown ledger compression {compression}')
+
+
+def _decompress(payload, compression, numel):
+    if compression == 'int8':
+        num_chunks = -(-numel // CHUNK)
+        scale = torch.from_numpy(np.frombuffer(payload, dtype=np.float32, count=num_chunks).copy())
+        q = torch.from_numpy(np.frombuffer(payload, dtype=np.int8, offset=4 * num_chunks).copy())
+        return (q.float().view(-1, CHUNK) * scale.view(-1, 1)).view(-1)[:numel]
+    k = len(payload) // 6
+    positions = torch.from_numpy(np.frombuffer(payload, dtype=np.int32, count=k).astype(np.int64))
+    values = torch.from_numpy(np.frombuffer(payload, dtype=np.float16, offset=4 * k).copy())
+    delta = torch.zeros(numel)
+    delta[positions] = values.float()
+    return delta
+
+
+class UpdateLedger(object):
+    """Writes the ledger of the parameters `named_params` to `path`. Call `add` with the dataset indices
+    of every (micro-)batch and `record` after every optimizer step."""
+
+    def __init__(self, path, named_params, compression='int8', topk=0.01):
+        named_params = [(n.replace('_orig_mod.', ''), p) for n, p in named_params]
+        self.names = [n for n, _ in named_params]
+        self.params = [p for _, p in named_params]
+        self.compression = compression
+        self.topk = topk
+        self.last = self._flat()
+        self.residual = torch.zeros_like(self.last)
+        self.indices = []
+        self.steps = 0
+        self.bytes = 0
+        self.seconds = 0.
+        header = json.dumps({'names': self.names, 'shapes': [list(p.shape) for p in self.params],
+                             'compression': compression, 'topk': topk}).encode()
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        self.bytes += len(MAGIC) + 8 + len(header)
+
+    def _flat(self):
+        return torch.cat([p.detach().reshape(-1).float() for p in self.params])
+
+    def add(self, index):
+        self.indices.append(index.detach().cpu())
+
+    def record(self):
+        if not self.indices:
+            raise ValueError('The ledger needs loaders built with return_index=True')
+        t0 = time.time()
+        flat = self._flat()
+        delta = flat - self.last + self.residual
+        self.last = flat
+        payload, approx = _compress(delta, self.compression, self.topk)
+        self.residual = delta - approx
+        indices = torch.cat(self.indices).numpy().astype(np.int64)
+        self.indices = []
+        self.file.write(_RECORD.pack(self.steps, len(indices), len(payload)) + indices.tobytes() + payload)
+        self.bytes += _RECORD.size + indices.nbytes + len(payload)
+        self.steps += 1
+        self.seconds += time.time() - t0
+
+    def close(self):
+        self.file.close()
+
+    def summary(self):
+        return {'steps': self.steps, 'bytes': self.bytes, 'seconds': round(self.seconds, 2),
+                'compression': self.compression}
+
+
+class LedgerReader(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not an update ledger')
+            size, = struct.unpack('<Q', f.read(8))
+            self.header = json.loads(f.read(size))
+            self.start = f.tell()
+        self.numel = sum(int(np.prod(s)) for s in self.header['shapes'])
+
+    def __iter__(self):
+        """(step, indices, payload) of every recorded step."""
+        with open(self.path, 'rb') as f:
+            f.seek(self.start)
+            while True:
+                record = f.read(_RECORD.size)
+                if len(record) < _RECORD.size:
+                    return
+                step, num_indices, size = _RECORD.unpack(record)
+                indices, payload = f.read(8 * num_indices), f.read(size)
+                if len(payload) < size:
+                    # the run was interrupted while writing this record
+                    return
+                yield step, np.frombuffer(indices, dtype=np.int64), payload
+
+    def decompress(self, payload):
+        return _decompress(payload, self.header['compression'], self.numel)
+
+
+def rollback(params, path, indexes):
+    """Subtracts from `params` ({name: tensor}, updated in place) the recorded updates of the steps
+    whose batch held any of the training positions `indexes`. Returns the number of steps undone."""
+    reader = LedgerReader(path)
+    indexes = np.asarray(sorted(indexes), dtype=np.int64)
+    total, steps = torch.zeros(reader.numel), 0
+    for _, batch, payload in reader:
+        if np.isin(batch, indexes).any():
+            total += reader.decompress(payload)
+            steps += 1
+    offset = 0
+    with torch.no_grad():
+        for name, shape in zip(reader.header['names'], reader.header['shapes']):
+            numel = int(np.prod(shape))
+            params[name].sub_(total[offset:offset + numel].view(shape).to(params[name]))
+            offset += numel
+    return steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['info', 'rollback'])
+    parser.add_argument('ledger')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Final checkpoint of the run')
+    parser.add_argument('--manifest', type=str, default=None, help='Split manifest whose forget set is undone')
+    parser.add_argument('--indexes', type=str, default=None, help='Comma separated training positions to undo')
+    parser.add_argument('--out', type=str, default=None)
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        reader = LedgerReader(args.ledger)
+        steps = sum(1 for _ in reader)
+        print(f"{steps} steps of {reader.numel} parameters, {reader.header['compression']} compression")
+    else:
+        from checkpoint_store import load_checkpoint
+        if args.indexes is not None:
+            indexes = [int(i) for i in args.indexes.split(',')]
+        else:
+            with open(args.manifest) as f:
+                indexes = json.load(f)['forget_indexes']
+        state_dict = load_checkpoint(args.checkpoint, map_location='cpu')
+        state_dict = {k: v.clone() for k, v in state_dict.items()}
+        steps = rollback(state_dict, args.ledger, indexes)
+        torch.save(state_dict, args.out)
+        print(f'Undid {steps} steps')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ import os
 import time
 import copy
 import random
+import sys
 from collections import defaultdict
 
 import numpy as np
@@ -12,17 +13,49 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 import torch.optim as optim
-from IPython import embed
+import torch.distributed as dist
 
 import models
 import datasets_multiclass as datasets
 from utils import *
 from logger import Logger
-import wandb
 
 from thirdparty.repdistiller.helper.loops import train_distill, train_distill_hide, train_distill_linear, train_vanilla, train_negrad, train_bcu, train_bcu_distill
 from thirdparty.repdistiller.helper.pretrain import init
-from thirdparty.repdistiller.helper.util import adjust_learning_rate as sgda_adjust_learning_rate
+from thirdparty.repdistiller.helper.util import adjust_learning_rate as sgda_adjust_learning_rate, autocast, get_profiler, \
+    GradAccumulator, scale_learning_rate
+from ensemble import StackedEnsemble, run_ensemble_epoch, ENSEMBLE_MODELS
+from profiler import PhaseProfiler
+from privacy import RDPAccountant, poisson_loader, per_sample_grads, clip_and_noise
+from checkpoint_store import CheckpointStore, load_checkpoint
+from ledger import UpdateLedger
+
+def get_name(args):
+    name = f"{args.dataset}_{args.model}_{str(args.filters).replace('.','_')}"
+    if args.split == 'train':
+        name += f"_forget_{None}"
+    else:
+        name += f"_forget_{args.forget_class}"
+        if args.num_to_forget is not None:
+            name += f"_num_{args.num_to_forget}"
+    if args.unfreeze_start is not None:
+        name += f"_unfreeze_from_{args.unfreeze_start.replace('.','_')}"
+    if args.augment:
+        name += f"_augment"
+    name+=f"_lr_{str(args.lr).replace('.','_')}"
+    name+=f"_bs_{str(args.batch_size)}"
+    name+=f"_ls_{args.lossfn}"
+    name+=f"_wd_{str(args.weight_decay).replace('.','_')}"
+    name+=f"_seed_{str(args.seed)}"
+    return name
+
+def save_checkpoint(args, state_dict, name, suffix, base=None):
+    '''checkpoints/{name}_{suffix}.pt, or with --checkpoint-store a deduplicated checkpoint that
+    may be stored as a delta of checkpoint {name}_{base}.'''
+    if args.checkpoint_store:
+        CheckpointStore().save(state_dict, f"{name}_{suffix}", base=f"{name}_{base}" if base is not None else None)
+    else:
+        torch.save(state_dict, f"checkpoints/{name}_{suffix}.pt")
 
 def adjust_learning_rate(optimizer, epoch):
     if args.step_size is not None:lr = args.lr * 0.1 ** (epoch//args.step_size)
@@ -38,7 +71,7 @@ def l2_penalty(model,model_init,weight_decay):
     l2_loss *= (weight_decay/2.)
     return l2_loss
     
-def run_epoch(args, model, model_init, train_loader, criterion=torch.nn.CrossEntropyLoss(), optimizer=None, scheduler=None, epoch=0, weight_decay=0.0, mode='train', quiet=False):
+def run_epoch(args, model, model_init, train_loader, criterion=torch.nn.CrossEntropyLoss(), optimizer=None, scheduler=None, epoch=0, weight_decay=0.0, mode='train', quiet=False, log=True, recorder=None, ledger=None):
     if mode == 'train':
         model.train()
     elif mode == 'test':
@@ -54,9 +87,11 @@ def run_epoch(args, model, model_init, train_loader, criterion=torch.nn.CrossEnt
     
     mult=0.5 if args.lossfn=='mse' else 1
     metrics = AverageMeter()
+    prof = get_profiler(args)
+    accum = GradAccumulator(optimizer, len(train_loader), args) if mode == 'train' else None
 
     with torch.set_grad_enabled(mode != 'test'):
-        for batch_idx, (data, target) in enumerate(train_loader):
+        for batch_idx, (data, target, *index) in enumerate(prof.iter(train_loader)):
             data, target = data.to(args.device), target.to(args.device)
             
             if args.lossfn=='mse':
@@ -65,29 +100,328 @@ def run_epoch(args, model, model_init, train_loader, criterion=torch.nn.CrossEnt
                 
             if 'mnist' in args.dataset:
                 data=data.view(data.shape[0],-1)
+            prof.lap('h2d')
                 
-            output = model(data)
+            with autocast(args):
+                output = model(data)
+            output = output.float()
+            prof.lap('forward')
             loss = mult*criterion(output, target) + l2_penalty(model,model_init,weight_decay)
             
             if args.l1:
                 l1_loss = sum([p.norm(1) for p in model.parameters()])
                 loss += args.weight_decay * l1_loss
+            prof.lap('loss')
 
             if ~quiet:
                 metrics.update(n=data.size(0), loss=loss.item(), error=get_error(output, target))
+            if recorder is not None and index:
+                recorder.record(epoch, index[0], output, target)
+            if ledger is not None and mode == 'train' and index:
+                ledger.add(index[0])
+            prof.lap('metrics')
             
             if mode == 'train':
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                accum.zero_grad()
+                accum.backward(loss)
+                prof.lap('backward')
+                if accum.step() and ledger is not None:
+                    ledger.record()
+                prof.lap('step')
     
-    log_metrics(mode, metrics, epoch)
-    logger.append('train' if mode=='train' else 'test', epoch=epoch, loss=metrics.avg['loss'], error=metrics.avg['error'], 
-                  lr=optimizer.param_groups[0]['lr'])
-    print('Learning Rate : {}'.format(optimizer.param_groups[0]['lr']))
+    if mode == 'train' and dist.is_available() and dist.is_initialized():
+        prof.reset_clock()
+        all_reduce_metrics(metrics)
+        prof.lap('metric_sync')
+
+    if log:
+        log_metrics(mode, metrics, epoch)
+        logger.append('train' if mode=='train' else 'test', epoch=epoch, loss=metrics.avg['loss'], error=metrics.avg['error'], 
+                      lr=optimizer.param_groups[0]['lr'])
+        print('Learning Rate : {}'.format(optimizer.param_groups[0]['lr']))
     return metrics
-    
-if __name__ == '__main__':
+
+def run_dp_epoch(args, model, model_init, train_loader, criterion, optimizer, accountant, epoch=0, weight_decay=0.0):
+    '''One DP-SGD epoch: per-sample gradients, clipped to --dp-clip and noised with --dp-noise.
+    train_loader must draw Poisson batches (privacy.poisson_loader). The l2 penalty towards
+    model_init does not depend on the data and is added to the private gradient.'''
+    model.train()
+    set_batchnorm_mode(model, train=False)
+    # parameters frozen by --unfreeze-start get no per-sample gradients and do not count towards the clipping norm
+    trainable = {id(p) for g in optimizer.param_groups for p in g['params']}
+    for p in model.parameters():
+        p.requires_grad_(id(p) in trainable)
+    mult=0.5 if args.lossfn=='mse' else 1
+    loss_fn = lambda output, target: mult*criterion(output, target)
+    sample_rate = train_loader.batch_sampler.sample_rate
+    expected_batch_size = sample_rate*len(train_loader.dataset)
+    metrics = AverageMeter()
+    params = [(k, p) for k, p in model.named_parameters() if p.requires_grad]
+    params_init = dict(model_init.named_parameters())
+
+    for batch_idx, (data, target, *_) in enumerate(train_loader):
+        data, target = data.to(args.device), target.to(args.device)
+        if args.lossfn=='mse':
+            target=(2*target-1)
+            target = target.type(torch.cuda.FloatTensor).unsqueeze(1)
+        if 'mnist' in args.dataset:
+            data=data.view(data.shape[0],-1)
+
+        with autocast(args):
+            grads, losses, output = per_sample_grads(model, loss_fn, data, target)
+        private_grads, norms = clip_and_noise(grads, args.dp_clip, args.dp_noise, expected_batch_size)
+
+        optimizer.zero_grad()
+        for k, p in params:
+            p.grad = private_grads[k] + weight_decay*(p.detach()-params_init[k].detach())
+        optimizer.step()
+        metrics.update(n=data.size(0), loss=losses.mean().item(), error=get_error(output, target),
+                       clipped=(norms > args.dp_clip).float().mean().item())
+
+    accountant.step(args.dp_noise, sample_rate, steps=len(train_loader.batch_sampler))
+    epsilon = accountant.get_epsilon(args.dp_delta)
+    log_metrics('train', metrics, epoch)
+    print(f'[{epoch}] privacy: epsilon {epsilon:.3f} at delta {args.dp_delta}')
+    logger.append('train', epoch=epoch, loss=metrics.avg['loss'], error=metrics.avg['error'],
+                  lr=optimizer.param_groups[0]['lr'], clipped=metrics.avg['clipped'])
+    logger.append('privacy', epoch=epoch, epsilon=epsilon, delta=args.dp_delta)
+    return metrics
+
+def amp_comparison(args, model, model_init, loader, criterion, optimizer, epoch, weight_decay, amp_metrics, amp_time):
+    '''Reruns an --amp evaluation in fp32 and logs the bf16 speedup and error delta.'''
+    args.amp = False
+    t1 = time.time()
+    metrics = run_epoch(args, model, model_init, loader, criterion, optimizer, epoch=epoch, weight_decay=weight_decay,
+                        mode='test', log=False)
+    fp32_time = time.time()-t1
+    args.amp = True
+    speedup = fp32_time/max(amp_time, 1e-8)
+    error_delta = amp_metrics.avg['error'] - metrics.avg['error']
+    print(f'[{epoch}] amp: speedup {speedup:.2f}x, error delta vs fp32 {error_delta:+.4f}')
+    logger.append('amp', epoch=epoch, speedup=speedup, error_delta=error_delta,
+                  loss_delta=amp_metrics.avg['loss'] - metrics.avg['loss'])
+    return speedup, error_delta
+
+def recalibrate_bn(args, model, train_loader, seed, num_samples=None):
+    '''bn_recalibrate with the input preprocessing of run_epoch, cached per checkpoint in --bn-cache-dir.'''
+    preprocess = (lambda x: x.view(x.shape[0], -1)) if 'mnist' in args.dataset else None
+    return bn_recalibrate(model, train_loader, num_samples=args.bn_samples if num_samples is None else num_samples,
+                          device=args.device, seed=seed, cache_dir=args.bn_cache_dir, preprocess=preprocess)
+
+def run_ensemble(args):
+    '''Trains one copy of args.model per seed in --ensemble-seeds in a single process.
+    Each copy gets the split and init of its standalone run, its own seeded shuffling,
+    and writes the same per-seed checkpoints and logs.
+    '''
+    if args.model not in ENSEMBLE_MODELS:
+        raise ValueError(f"Ensemble training supports {ENSEMBLE_MODELS}, got {args.model}")
+    if args.lossfn != 'ce' or args.l1:
+        raise ValueError("Ensemble training only supports --lossfn ce with the L2 penalty")
+
+    use_cuda = not args.no_cuda and torch.cuda.is_available()
+    args.device = torch.device("cuda" if use_cuda else "cpu")
+    os.makedirs('checkpoints', exist_ok=True)
+    mkdir('logs')
+
+    seeds = [int(s) for s in args.ensemble_seeds.split(',')]
+    names, loggers, model_list, train_loaders, test_loaders = [], [], [], [], []
+    for seed in seeds:
+        seed_args = copy.copy(args)
+        seed_args.seed = seed
+        manual_seed(seed)
+        train_loader, _, test_loader = datasets.get_loaders(args.dataset, class_to_replace=args.forget_class,
+                                                         num_indexes_to_replace=args.num_to_forget, confuse_mode=args.confuse_mode,
+                                                         batch_size=args.batch_size, split=args.split, seed=seed,
+                                                         root=args.dataroot, augment=args.augment)
+        num_classes = max(train_loader.dataset.targets) + 1 if args.num_classes is None else args.num_classes
+        model = models.get_model(args.model, num_classes=num_classes, filters_percentage=args.filters).to(args.device)
+        if args.resume is not None:
+            classifier_name = 'classifier.' if args.model=='mlp' else 'linear.'
+            state = load_checkpoint(args.resume)
+            state = {k: v for k, v in state.items() if not k.startswith(classifier_name)}
+            model.load_state_dict(state, strict=False)
+
+        generator = torch.Generator().manual_seed(seed)
+        train_loaders.append(torch.utils.data.DataLoader(train_loader.dataset, batch_size=args.batch_size, shuffle=True,
+                                                         generator=generator))
+        test_loaders.append(test_loader)
+        model_list.append(model)
+
+        name = get_name(seed_args) if args.name is None else f"{args.name}_seed_{seed}"
+        names.append(name)
+        logger = Logger(index=name+'_training')
+        logger['args'] = seed_args
+        loggers.append(logger)
+        save_checkpoint(args, model.state_dict(), name, 'init')
+    print(f'Checkpoint names: {names}')
+
+    ensemble = StackedEnsemble(model_list)
+    params_init = {k: p.detach().clone() for k, p in ensemble.params.items()}
+
+    parameters = ensemble.parameters()
+    if args.unfreeze_start is not None:
+        parameters = []
+        layer_index = 1e8
+        for i, (n,p) in enumerate(ensemble.params.items()):
+            if (args.unfreeze_start in n) or (i > layer_index):
+                layer_index = i
+                parameters.append(p)
+
+    weight_decay = args.weight_decay
+    optimizer = optim.SGD(parameters, lr=args.lr, momentum=args.momentum, weight_decay=0.0)
+    criterion = torch.nn.CrossEntropyLoss().to(args.device)
+
+    eval_every = args.eval_every if args.eval_every is not None else 500000
+    train_time = 0
+    last_checkpoint = 'init'
+    for epoch in range(args.epochs):
+        lr = args.lr * 0.1 ** (epoch//args.step_size)
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = lr
+        t1 = time.time()
+        metrics = run_ensemble_epoch(args, ensemble, params_init, train_loaders, criterion, optimizer, weight_decay, mode='train')
+        t2 = time.time()
+        train_time += np.round(t2-t1,2)
+        for seed, logger, m in zip(seeds, loggers, metrics):
+            log_metrics(f'train seed {seed}', m, epoch)
+            logger.append('train', epoch=epoch, loss=m.avg['loss'], error=m.avg['error'], lr=lr)
+        if epoch % eval_every == 0:
+            if not args.disable_bn:
+                # BatchNorm statistics of every copy, recalibrated on its own training set as in the single-model loop
+                for s, (model, loader) in enumerate(zip(model_list, train_loaders)):
+                    model.load_state_dict(ensemble.state_dict(s))
+                    num_samples = args.bn_samples if args.bn_samples > 0 else len(loader.dataset)
+                    recalibrate_bn(args, model, loader, seeds[s], num_samples=num_samples)
+                    ensemble.load_buffers(s, model)
+            metrics = run_ensemble_epoch(args, ensemble, params_init, test_loaders, criterion, weight_decay=weight_decay, mode='test')
+            for seed, logger, m in zip(seeds, loggers, metrics):
+                log_metrics(f'test seed {seed}', m, epoch)
+                logger.append('test', epoch=epoch, loss=m.avg['loss'], error=m.avg['error'], lr=lr)
+        if epoch % args.checkpoint_every == 0 or epoch == args.epochs-1:
+            for s, name in enumerate(names):
+                save_checkpoint(args, ensemble.state_dict(s), name, epoch, base=last_checkpoint)
+            last_checkpoint = epoch
+        print(f'Epoch Time: {np.round(time.time()-t1,2)} sec')
+    print (f'Pure training time: {train_time} sec ({len(seeds)} models)')
+
+def train_distributed(rank, cli_args):
+    '''Data-parallel worker for --world-size > 1, started by torch.multiprocessing.spawn.
+    Every rank trains on its own shard of the training set with batch size
+    batch_size // world_size and gradients are averaged with all-reduce, so every step
+    is an update on a batch of --batch-size. The shards are not padded: the last
+    (fewer than world_size) samples of each shuffled epoch are dropped. BatchNorm is
+    synchronized across ranks on CUDA (SyncBatchNorm); on CPU (gloo) every rank
+    normalizes with the statistics of its own shard, so BN models do not exactly match
+    single-process training. Only rank 0 evaluates, logs and checkpoints; the early
+    stopping decision is broadcast from it.
+    '''
+    global args, logger
+    args = cli_args
+    use_cuda = not args.no_cuda and torch.cuda.is_available()
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(args.dist_port))
+    dist.init_process_group('nccl' if use_cuda else 'gloo', rank=rank, world_size=args.world_size)
+    args.device = torch.device(f"cuda:{rank}" if use_cuda else "cpu")
+    if not use_cuda:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.world_size))
+    manual_seed(args.seed)
+
+    logger = Logger(index=args.name+'_training', always_save=(rank == 0))
+    logger['args'] = args
+
+    train_loader, valid_loader, test_loader = datasets.get_loaders(args.dataset, class_to_replace=args.forget_class,
+                                                     num_indexes_to_replace=args.num_to_forget, confuse_mode=args.confuse_mode,
+                                                     batch_size=args.batch_size, split=args.split, seed=args.seed,
+                                                    root=args.dataroot, augment=args.augment)
+    sampler = torch.utils.data.distributed.DistributedSampler(train_loader.dataset, num_replicas=args.world_size,
+                                                              rank=rank, shuffle=True, seed=args.seed, drop_last=True)
+    shard_loader = torch.utils.data.DataLoader(train_loader.dataset, batch_size=args.batch_size // args.world_size,
+                                               sampler=sampler, num_workers=0, pin_memory=False)
+
+    num_classes = max(train_loader.dataset.targets) + 1 if args.num_classes is None else args.num_classes
+    args.num_classes = num_classes
+    model = models.get_model(args.model, num_classes=num_classes, filters_percentage=args.filters).to(args.device)
+    if args.resume is not None:
+        classifier_name = 'classifier.' if args.model=='mlp' else 'linear.'
+        state = load_checkpoint(args.resume, map_location='cpu')
+        state = {k: v for k, v in state.items() if not k.startswith(classifier_name)}
+        model.load_state_dict(state, strict=False)
+    model_init = copy.deepcopy(model)
+    if rank == 0:
+        save_checkpoint(args, model.state_dict(), args.name, 'init')
+
+    parameters = [p for p in model.parameters()]
+    if args.unfreeze_start is not None:
+        parameters = []
+        layer_index = 1e8
+        for i, (n,p) in enumerate(model.named_parameters()):
+            if (args.unfreeze_start in n) or (i > layer_index):
+                layer_index = i
+                parameters.append(p)
+    frozen = set(map(id, model.parameters())) - set(map(id, parameters))
+    for p in model.parameters():
+        if id(p) in frozen:
+            p.requires_grad_(False)
+    if use_cuda:
+        model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    ddp_model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[rank] if use_cuda else None)
+
+    weight_decay = args.weight_decay if not args.l1 else 0.
+    optimizer = optim.SGD(parameters, lr=args.lr, momentum=args.momentum, weight_decay=0.0)
+    criterion = torch.nn.CrossEntropyLoss().to(args.device) if args.lossfn=='ce' else torch.nn.MSELoss().to(args.device)
+
+    eval_every = args.eval_every if args.eval_every is not None else (1 if args.early_stop else 500000)
+    stopper = EarlyStopping(args.early_stop, args.patience, args.min_delta) if args.early_stop else None
+    stop_reason = 'max_epochs'
+
+    train_time = 0
+    last_checkpoint = 'init'
+    epoch = -1
+    for epoch in range(args.epochs):
+        adjust_learning_rate(optimizer,epoch)
+        sampler.set_epoch(epoch)
+        t1 = time.time()
+        run_epoch(args, ddp_model, model_init, shard_loader, criterion, optimizer, None, epoch, weight_decay, mode='train',
+                  quiet=args.quiet, log=(rank == 0))
+        t2 = time.time()
+        train_time += np.round(t2-t1,2)
+        stop = torch.zeros(1)
+        if rank == 0:
+            if epoch % eval_every == 0:
+                if not args.disable_bn:
+                    if args.bn_samples > 0:
+                        recalibrate_bn(args, model, train_loader, args.seed)
+                    else:
+                        run_epoch(args, model, model_init, train_loader, criterion, optimizer, None, epoch, weight_decay, mode='dry_run')
+                run_epoch(args, model, model_init, test_loader, criterion, optimizer, None, epoch, weight_decay, mode='test')
+                if stopper is not None:
+                    valid_metrics = run_epoch(args, model, model_init, valid_loader, criterion, optimizer, None, epoch,
+                                              weight_decay, mode='test', log=False)
+                    log_metrics('valid', valid_metrics, epoch)
+                    logger.append('valid', epoch=epoch, loss=valid_metrics.avg['loss'], error=valid_metrics.avg['error'])
+                    if stopper.step(valid_metrics, epoch):
+                        stop_reason = stopper.stop_reason
+                        stop[0] = 1
+            if epoch % args.checkpoint_every == 0 or epoch == args.epochs-1 or stop_reason != 'max_epochs':
+                save_checkpoint(args, model.state_dict(), args.name, epoch, base=last_checkpoint)
+                last_checkpoint = epoch
+            print(f'Epoch Time: {np.round(time.time()-t1,2)} sec')
+        # gloo broadcasts CPU tensors; nccl needs them on the rank's device
+        stop = stop.to(args.device)
+        dist.broadcast(stop, src=0)
+        if stop.item():
+            if rank == 0:
+                print(f'Stopping at epoch {epoch}: {stop_reason}')
+            break
+    if rank == 0:
+        logger['stop_reason'] = stop_reason
+        logger['final_epoch'] = epoch
+        logger['train_time'] = train_time
+        logger.save()
+        print (f'Pure training time: {train_time} sec ({args.world_size} processes)')
+    dist.destroy_process_group()
+
+def parse_args(argv=None):
     # Training settings
     parser = argparse.ArgumentParser()
     parser.add_argument('--split', type=str, choices=['train', 'forget'])
@@ -101,6 +435,10 @@ if __name__ == '__main__':
     parser.add_argument('--dataroot', type=str, default='data/')
     parser.add_argument('--disable-bn', action='store_true', default=False,
                         help='Put batchnorm in eval mode and don\'t update the running averages')
+    parser.add_argument('--bn-samples', type=int, default=2048,
+                        help='Training samples used to recalibrate BatchNorm statistics before evaluation (0: full dry-run epoch)')
+    parser.add_argument('--bn-cache-dir', type=str, default='checkpoints/bn_cache',
+                        help='Directory where recalibrated BatchNorm statistics are cached per checkpoint (\'\' to disable)')
     parser.add_argument('--epochs', type=int, default=31, metavar='N',
                         help='number of epochs to train (default: 31)')
     parser.add_argument('--filters', type=float, default=1.0,
@@ -137,8 +475,63 @@ if __name__ == '__main__':
     parser.add_argument('--sgda-learning-rate', type=float, default=0.01, help='learning rate')
     parser.add_argument('--lr_decay_rate', type=float, default=0.1, help='learning rate decay rate')
     parser.add_argument('--print_freq', type=int, default=500, help='print frequency')
+    parser.add_argument('--amp', action='store_true', default=False,
+                        help='Run forward passes under bf16 autocast (weights, penalties and losses stay fp32)')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='Compile the model (torch.compile, falling back to TorchScript and eager)')
+    parser.add_argument('--world-size', type=int, default=1,
+                        help='Number of local data-parallel processes (gloo backend on CPU)')
+    parser.add_argument('--dist-port', type=int, default=29500, help='Port for the process group rendezvous')
+    parser.add_argument('--eval-every', type=int, default=None,
+                        help='Evaluate every N epochs (default: only epoch 0, or every epoch with --early-stop)')
+    parser.add_argument('--checkpoint-every', type=int, default=5, help='Save a checkpoint every N epochs')
+    parser.add_argument('--checkpoint-store', action='store_true', default=False,
+                        help='Save checkpoints to the deduplicating store in checkpoints/store instead of .pt files '
+                             '(later epochs as compressed deltas of the previous checkpoint)')
+    parser.add_argument('--early-stop', type=str, default=None, choices=['loss', 'error'],
+                        help='Stop when this validation metric stops improving')
+    parser.add_argument('--patience', type=int, default=5,
+                        help='Evaluations without improvement before early stopping')
+    parser.add_argument('--min-delta', type=float, default=0.0,
+                        help='Minimum decrease of the validation metric that counts as an improvement')
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='Time data/h2d/forward/loss/backward/step phases and every leaf module; '
+                             'writes logs/<name>_trace.json (chrome://tracing) and prints a summary')
+    parser.add_argument('--dp', action='store_true', default=False,
+                        help='Differentially private training (DP-SGD with Poisson batches; BatchNorm stays in eval mode)')
+    parser.add_argument('--dp-clip', type=float, default=1.0, help='Per-sample gradient L2 clipping norm')
+    parser.add_argument('--dp-noise', type=float, default=1.0, help='Noise multiplier (noise std / clipping norm)')
+    parser.add_argument('--dp-delta', type=float, default=1e-5, help='Delta at which epsilon is reported')
+    parser.add_argument('--micro-batch-size', type=int, default=None,
+                        help='Forward/backward batch size; gradients are accumulated over --batch-size // this '
+                             'micro-batches per optimizer step (default: --batch-size)')
+    parser.add_argument('--lr-scaling', type=str, default='none', choices=['none', 'linear', 'sqrt'],
+                        help='Scale --lr and --sgda-learning-rate from --base-batch-size to --batch-size')
+    parser.add_argument('--base-batch-size', type=int, default=128, help='Batch size the learning rates were tuned for')
+    parser.add_argument('--warmup-epochs', type=float, default=0,
+                        help='Ramp the learning rate linearly from 0 over this many epochs of optimizer steps')
+    parser.add_argument('--record-samples', action='store_true', default=False,
+                        help='Record per-sample loss, margin and correctness of every training epoch '
+                             'in logs/<name>_samples.npz')
+    parser.add_argument('--teacher-cache', action='store_true', default=False,
+                        help='Cache the frozen teacher outputs of the distillation loops by sample index (fp16, '
+                             'memory-mapped when large) in the TeacherCaches of the run, args.teacher_caches; '
+                             'needs loaders yielding indices and no --augment')
+    parser.add_argument('--teacher-cache-dir', type=str, default=None, help='Directory of memory-mapped teacher caches')
+    parser.add_argument('--ledger', action='store_true', default=False,
+                        help='Record the batch indices and compressed parameter update of every optimizer step '
+                             'in checkpoints/<name>.ledger (see ledger.py)')
+    parser.add_argument('--ledger-compression', type=str, default='int8', choices=['int8', 'topk'])
+    parser.add_argument('--ledger-topk', type=float, default=0.01,
+                        help='Fraction of the update entries kept with --ledger-compression topk')
+    parser.add_argument('--num-shards', type=int, default=None,
+                        help='SISA: train one model per disjoint shard of the training set (see sisa.py)')
+    parser.add_argument('--num-slices', type=int, default=1,
+                        help='SISA: slices per shard, each followed by a checkpoint to retrain from')
+    parser.add_argument('--ensemble-seeds', type=str, default=None,
+                        help='Comma separated seeds, e.g. 1,2,3: train one copy per seed in a single vectorized run')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     iterations = args.lr_decay_epochs.split(',')
     args.lr_decay_epochs = list([])
@@ -151,32 +544,59 @@ if __name__ == '__main__':
         args.forget_class = list([])
         for c in clss:
             args.forget_class.append(int(c))
-   
-    manual_seed(args.seed)
-    
+
     if args.step_size==None:args.step_size=args.epochs+1
+    args.bn_cache_dir = args.bn_cache_dir or None
+    args.accum_steps = 1
+    if args.micro_batch_size is not None:
+        if args.batch_size % args.micro_batch_size != 0:
+            parser.error('--batch-size must be a multiple of --micro-batch-size')
+        if args.world_size > 1 or args.ensemble_seeds is not None:
+            parser.error('--micro-batch-size cannot be combined with --world-size or --ensemble-seeds')
+        args.accum_steps = args.batch_size // args.micro_batch_size
+    args.lr = scale_learning_rate(args.lr, args.batch_size, args.base_batch_size, args.lr_scaling)
+    args.sgda_learning_rate = scale_learning_rate(args.sgda_learning_rate, args.batch_size, args.base_batch_size, args.lr_scaling)
+    if args.dp:
+        if args.compile or args.world_size > 1 or args.ensemble_seeds is not None:
+            parser.error('--dp cannot be combined with --compile, --world-size or --ensemble-seeds')
+        if args.record_samples or args.warmup_epochs > 0 or args.micro_batch_size is not None:
+            parser.error('--dp cannot be combined with --record-samples, --warmup-epochs or --micro-batch-size')
+        # BatchNorm running statistics would be computed from the private data without noise
+        args.disable_bn = True
+    if args.ensemble_seeds is not None and (args.amp or args.early_stop or args.record_samples):
+        parser.error('--ensemble-seeds cannot be combined with --amp, --early-stop or --record-samples')
+    if args.world_size > 1 and (args.compile or args.record_samples):
+        parser.error('--world-size > 1 cannot be combined with --compile or --record-samples')
+    if args.ledger and (args.dp or args.world_size > 1 or args.ensemble_seeds is not None):
+        parser.error('--ledger cannot be combined with --dp, --world-size or --ensemble-seeds')
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    manual_seed(args.seed)
     
+    if args.ensemble_seeds is not None:
+        run_ensemble(args)
+        sys.exit(0)
+
+    if args.num_shards is not None:
+        from sisa import run_sisa
+        run_sisa(args)
+        sys.exit(0)
+
     if args.name is None:
-        args.name = f"{args.dataset}_{args.model}_{str(args.filters).replace('.','_')}"
-        if args.split == 'train':
-            args.name += f"_forget_{None}"
-        else:
-            args.name += f"_forget_{args.forget_class}"
-            if args.num_to_forget is not None:
-                args.name += f"_num_{args.num_to_forget}"
-        if args.unfreeze_start is not None:
-            args.name += f"_unfreeze_from_{args.unfreeze_start.replace('.','_')}"
-        if args.augment:
-            args.name += f"_augment"
-        args.name+=f"_lr_{str(args.lr).replace('.','_')}"
-        args.name+=f"_bs_{str(args.batch_size)}"
-        args.name+=f"_ls_{args.lossfn}"
-        args.name+=f"_wd_{str(args.weight_decay).replace('.','_')}"
-        args.name+=f"_seed_{str(args.seed)}"
+        args.name = get_name(args)
     print(f'Checkpoint name: {args.name}')
     
     mkdir('logs')
 
+    if args.world_size > 1:
+        if args.batch_size % args.world_size != 0:
+            raise ValueError("--batch-size must be divisible by --world-size")
+        os.makedirs('checkpoints', exist_ok=True)
+        torch.multiprocessing.spawn(train_distributed, args=(args,), nprocs=args.world_size)
+        sys.exit(0)
+
     logger = Logger(index=args.name+'_training')
     logger['args'] = args
     logger['checkpoint'] = os.path.join('models/', logger.index+'.pth')
@@ -191,19 +611,20 @@ if __name__ == '__main__':
 
     train_loader, valid_loader, test_loader = datasets.get_loaders(args.dataset, class_to_replace=args.forget_class,
                                                      num_indexes_to_replace=args.num_to_forget, confuse_mode=args.confuse_mode,
-                                                     batch_size=args.batch_size, split=args.split, seed=args.seed,
-                                                    root=args.dataroot, augment=args.augment)
+                                                     batch_size=args.batch_size // args.accum_steps, split=args.split, seed=args.seed,
+                                                    root=args.dataroot, augment=args.augment, return_index=args.record_samples or args.ledger)
     
     num_classes = max(train_loader.dataset.targets) + 1 if args.num_classes is None else args.num_classes
     args.num_classes = num_classes
     print(f"Number of Classes: {num_classes}")
     model = models.get_model(args.model, num_classes=num_classes, filters_percentage=args.filters).to(args.device)
+    recorder = SampleRecorder(len(train_loader.dataset), args.epochs) if args.record_samples else None
     
     if args.model=='mlp':classifier_name='classifier.'
     elif 'resnet' in args.model:classifier_name='linear.'
     
     if args.resume is not None:
-        state = torch.load(args.resume)
+        state = load_checkpoint(args.resume)
         print("State", state)
         print("Args", args.resume)
         state = {k: v for k, v in state.items() if not k.startswith(classifier_name)}
@@ -212,7 +633,18 @@ if __name__ == '__main__':
 
     model_init = copy.deepcopy(model)
 
-    torch.save(model.state_dict(), f"checkpoints/{args.name}_init.pt")
+    save_checkpoint(args, model.state_dict(), args.name, 'init')
+
+    if args.compile:
+        example_input = next(iter(train_loader))[0].to(args.device)
+        if 'mnist' in args.dataset:
+            example_input = example_input.view(example_input.shape[0],-1)
+        t1 = time.time()
+        model = models.compile_model(model, example_input=example_input)
+        print(f'Compile Time: {np.round(time.time()-t1,2)} sec')
+
+    if args.profile:
+        args.profiler = PhaseProfiler().attach(model)
     
     parameters = model.parameters()
     if args.unfreeze_start is not None:
@@ -227,19 +659,72 @@ if __name__ == '__main__':
     optimizer = optim.SGD(parameters, lr=args.lr, momentum=args.momentum, weight_decay=0.0)
     criterion = torch.nn.CrossEntropyLoss().to(args.device) if args.lossfn=='ce' else torch.nn.MSELoss().to(args.device)
     scheduler = torch.optim.lr_scheduler.StepLR(optimizer, args.step_size, gamma=0.1, last_epoch=-1)
+    trainable = {id(p) for g in optimizer.param_groups for p in g['params']}
+    ledger = UpdateLedger(f"checkpoints/{args.name}.ledger", [(n, p) for n, p in model.named_parameters() if id(p) in trainable],
+                          args.ledger_compression, args.ledger_topk) if args.ledger else None
+
+    eval_every = args.eval_every if args.eval_every is not None else (1 if args.early_stop else 500000)
+    stopper = EarlyStopping(args.early_stop, args.patience, args.min_delta) if args.early_stop else None
+    stop_reason = 'max_epochs'
+
+    if args.dp:
+        dp_loader = poisson_loader(train_loader, args.batch_size, seed=args.seed)
+        accountant = RDPAccountant()
 
     train_time = 0
+    last_checkpoint = 'init'
+    epoch = -1  # final_epoch of a run with --epochs 0
     for epoch in range(args.epochs):
         adjust_learning_rate(optimizer,epoch)
         t1 = time.time()
-        run_epoch(args, model, model_init, train_loader, criterion, optimizer, scheduler, epoch, weight_decay, mode='train', quiet=args.quiet)
+        if args.dp:
+            run_dp_epoch(args, model, model_init, dp_loader, criterion, optimizer, accountant, epoch, weight_decay)
+        else:
+            run_epoch(args, model, model_init, train_loader, criterion, optimizer, scheduler, epoch, weight_decay, mode='train', quiet=args.quiet,
+                      recorder=recorder, ledger=ledger)
         t2 = time.time()
         train_time += np.round(t2-t1,2)
-        if epoch % 500000 == 0:
+        if epoch % eval_every == 0:
             if not args.disable_bn:
-                run_epoch(args, model, model_init, train_loader, criterion, optimizer, scheduler, epoch, weight_decay, mode='dry_run')
-            run_epoch(args, model, model_init, test_loader, criterion, optimizer, scheduler, epoch, weight_decay, mode='test')
-        if epoch % 5 == 0:
-            torch.save(model.state_dict(), f"checkpoints/{args.name}_{epoch}.pt")
+                if args.bn_samples > 0:
+                    recalibrate_bn(args, model, train_loader, args.seed)
+                else:
+                    run_epoch(args, model, model_init, train_loader, criterion, optimizer, scheduler, epoch, weight_decay, mode='dry_run')
+            t_eval = time.time()
+            test_metrics = run_epoch(args, model, model_init, test_loader, criterion, optimizer, scheduler, epoch, weight_decay, mode='test')
+            if args.amp:
+                amp_comparison(args, model, model_init, test_loader, criterion, optimizer, epoch, weight_decay,
+                               test_metrics, time.time()-t_eval)
+            if stopper is not None:
+                valid_metrics = run_epoch(args, model, model_init, valid_loader, criterion, optimizer, scheduler, epoch, weight_decay,
+                                          mode='test', log=False)
+                log_metrics('valid', valid_metrics, epoch)
+                logger.append('valid', epoch=epoch, loss=valid_metrics.avg['loss'], error=valid_metrics.avg['error'])
+                if stopper.step(valid_metrics, epoch):
+                    stop_reason = stopper.stop_reason
+        if epoch % args.checkpoint_every == 0 or epoch == args.epochs-1 or stop_reason != 'max_epochs':
+            save_checkpoint(args, model.state_dict(), args.name, epoch, base=last_checkpoint)
+            last_checkpoint = epoch
         print(f'Epoch Time: {np.round(time.time()-t1,2)} sec')
+        if stop_reason != 'max_epochs':
+            print(f'Stopping at epoch {epoch}: {stop_reason}')
+            break
+    logger['stop_reason'] = stop_reason
+    logger['final_epoch'] = epoch
+    logger['train_time'] = train_time
+    if args.dp:
+        logger['epsilon'] = accountant.get_epsilon(args.dp_delta)
+    if ledger is not None:
+        ledger.close()
+        logger['ledger'] = dict(ledger.summary(), path=f"checkpoints/{args.name}.ledger")
+        print(f"Ledger: {ledger.steps} steps, {ledger.bytes / 2 ** 20:.1f} MB, {ledger.seconds:.1f} sec "
+              f"({100 * ledger.seconds / max(train_time, 1e-9):.1f}% of training time)")
+    if recorder is not None:
+        logger['sample_history'] = f"logs/{args.name}_samples.npz"
+        recorder.save(logger['sample_history'], epochs=epoch+1)
+    logger.save()
     print (f'Pure training time: {train_time} sec')
+    if args.profile:
+        args.profiler.detach()
+        args.profiler.export_chrome_trace(f"logs/{args.name}_trace.json")
+        print(args.profiler.summary())
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Memory-mappable checkpoint format for read-only evaluation.
+
+A .mmpt file is an 8-byte magic, the 8-byte length of a JSON header ({key: dtype, shape, offset}),
+the header, then the raw bytes of every tensor, each aligned to 64 bytes. Loading maps the file
+copy-on-write and returns tensors that are views into the mapping: nothing is unpickled or copied,
+pages are read from disk (or the page cache) on first access, and only the tensors asked for are
+touched, so `keys=`/`prefix=` loads e.g. only the classifier.
+
+    save_mmap(model.state_dict(), 'checkpoints/run_30.mmpt')
+    load_into(model, 'checkpoints/run_30.mmpt')                  # parameters become views of the file
+    head = load_mmap('checkpoints/run_30.mmpt', prefix='linear.')
+
+    python mmap_checkpoint.py convert checkpoints/*.pt           # writes .mmpt next to every .pt
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+
+import torch
+
+MAGIC = b'MMCKPT01'
+ALIGN = 64
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def save_mmap(state_dict, path):
+    tensors = {k: v.detach().cpu().contiguous() for k, v in state_dict.items()}
+    header, offset = {}, 0
+    for k, v in tensors.items():
+        header[k] = {'dtype': str(v.dtype).replace('torch.', ''), 'shape': list(v.shape), 'offset': offset}
+        offset = _align(offset + v.numel() * v.element_size())
+    header_bytes = json.dumps(header).encode()
+    data_start = _align(len(MAGIC) + 8 + len(header_bytes))
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+        for k, v in tensors.items():
+            f.seek(data_start + header[k]['offset'])
+            f.write(v.reshape(-1).view(torch.uint8).numpy().tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp, path)
+
+
+def read_header(path):
+    """({key: dtype, shape, offset}, offset of the tensor data) of a .mmpt file."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a memory-mappable checkpoint')
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size))
+    return header, _align(len(MAGIC) + 8 + size)
+
+
+def load_mmap(path, keys=None, prefix=None):
+    """state_dict of the tensors of `path` (all, those in `keys`, or those starting with `prefix`)
+    as zero-copy views of a private (copy-on-write) mapping of the file."""
+    header, data_start = read_header(path)
+    if keys is not None:
+        header = {k: header[k] for k in keys}
+    if prefix is not None:
+        header = {k: e for k, e in header.items() if k.startswith(prefix)}
+    with open(path, 'rb') as f:
+        # ACCESS_COPY: the views are writable (as torch expects) but writes never reach the file;
+        # the mapping stays alive as long as a tensor references it
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    state_dict = {}
+    for k, e in header.items():
+        dtype = getattr(torch, e['dtype'])
+        numel = 1
+        for s in e['shape']:
+            numel *= s
+        if numel == 0:
+            state_dict[k] = torch.empty(e['shape'], dtype=dtype)
+            continue
+        state_dict[k] = torch.frombuffer(buffer, dtype=dtype, count=numel, offset=data_start + e['offset']).reshape(e['shape'])
+    return state_dict
+
+
+def load_into(model, path, keys=None, prefix=None, strict=None):
+    """Loads `path` into `model`. On CPU the parameters and buffers are replaced by views of the mapped
+    file (no copy); on GPU the mapped pages are copied straight to the device. Partial loads
+    (`keys`/`prefix`) are non-strict."""
+    state_dict = load_mmap(path, keys=keys, prefix=prefix)
+    if strict is None:
+        strict = keys is None and prefix is None
+    device = next(model.parameters()).device
+    if device.type == 'cpu':
+        return model.load_state_dict(state_dict, strict=strict, assign=True)
+    return model.load_state_dict(state_dict, strict=strict)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['convert', 'info'])
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--store', type=str, default=None,
+                        help='Convert checkpoint names of this checkpoint store instead of .pt files')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        for path in args.paths:
+            if args.store is not None:
+                from checkpoint_store import CheckpointStore
+                state_dict = dict(CheckpointStore(args.store).load(path))
+                out = os.path.join(os.path.dirname(args.store.rstrip('/')), f'{path}.mmpt')
+            else:
+                state_dict = torch.load(path, map_location='cpu')
+                out = os.path.splitext(path)[0] + '.mmpt'
+            save_mmap(state_dict, out)
+            print(out)
+    else:
+        for path in args.paths:
+            header, _ = read_header(path)
+            for k, e in header.items():
+                print(f"{k:<50}{e['dtype']:>10}  {tuple(e['shape'])}")
+
+
+if __name__ == '__main__':
+    main()
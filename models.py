@@ -1,3 +1,7 @@
+import copy
+import warnings
+from collections import namedtuple
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -28,6 +32,7 @@ class LinearNeuralTangentKernel(nn.Linear):
         super(LinearNeuralTangentKernel, self).__init__(in_features, out_features)
         self.reset_parameters()
         self.w_sig = w_sig
+        self.scale = float(w_sig / np.sqrt(in_features))
       
     def reset_parameters(self):
         torch.nn.init.normal_(self.weight, mean=0, std=1)
@@ -35,7 +40,7 @@ class LinearNeuralTangentKernel(nn.Linear):
             torch.nn.init.normal_(self.bias, mean=0, std=1)
 
     def forward(self, input):
-        return F.linear(input, self.w_sig * self.weight/np.sqrt(self.in_features), self.beta * self.bias)
+        return F.linear(input, self.weight * self.scale, self.bias * self.beta)
 
     def extra_repr(self):
         return 'in_features={}, out_features={}, bias={}, beta={}'.format(
@@ -227,6 +232,7 @@ class ConvNeuralTangentKernel(nn.Conv2d):
         self.stride=stride
         self.padding=padding
         self.w_sig = w_sig
+        self.scale = float(w_sig / np.sqrt(in_channels*np.prod(self.kernel_size)))
         self.reset_parameters()
       
     def reset_parameters(self):
@@ -235,8 +241,7 @@ class ConvNeuralTangentKernel(nn.Conv2d):
             torch.nn.init.normal_(self.bias, mean=0, std=0)
             
     def forward(self, input):
-        return F.conv2d(input, self.w_sig*self.weight/np.sqrt(self.in_channels*np.prod(self.kernel_size)),\
-                        self.bias,self.stride,self.padding)
+        return F.conv2d(input, self.weight*self.scale, self.bias,self.stride,self.padding)
      
 class ntk_Conv(nn.Sequential):
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=None, output_padding=0,
@@ -459,6 +464,7 @@ class ConvImprovedStandard(nn.Conv2d):
         self.padding=padding
         self.w_sig = w_sig
         self.s = s
+        self.scale = float(1 / np.sqrt(s))
         self.reset_parameters()
       
     def reset_parameters(self):
@@ -467,7 +473,7 @@ class ConvImprovedStandard(nn.Conv2d):
             torch.nn.init.normal_(self.bias, mean=0, std=0)
             
     def forward(self, input):
-        return F.conv2d(input, self.weight/np.sqrt(self.s),self.bias,self.stride,self.padding)
+        return F.conv2d(input, self.weight*self.scale,self.bias,self.stride,self.padding)
 
 class wide_basicIS(nn.Module):
     def __init__(self, in_planes, planes, dropout_rate, stride=1):
@@ -543,6 +549,7 @@ class ConvNTK(nn.Conv2d):
         self.stride=stride
         self.padding=padding
         self.w_sig = w_sig
+        self.scale = float(w_sig / np.sqrt(in_channels*np.prod(self.kernel_size)))
         self.reset_parameters()
       
     def reset_parameters(self):
@@ -551,8 +558,7 @@ class ConvNTK(nn.Conv2d):
             torch.nn.init.normal_(self.bias, mean=0, std=0)
             
     def forward(self, input):
-        return F.conv2d(input, self.w_sig*self.weight/np.sqrt(self.in_channels*np.prod(self.kernel_size))\
-                        ,self.bias,self.stride,self.padding)
+        return F.conv2d(input, self.weight*self.scale,self.bias,self.stride,self.padding)
 
 class wide_basicNTK(nn.Module):
     def __init__(self, in_planes, planes, dropout_rate, stride=1):
@@ -617,6 +623,61 @@ class Wide_ResNetNTK(nn.Module):
 
         return out
     
+# A step of a model's forward: `forward` maps the previous stage's output to this stage's output, using the
+# parameters under the `modules` prefixes.
+ModelStage = namedtuple('ModelStage', ['name', 'modules', 'forward'])
+
+def _sequential_stages(model, attr):
+    return [ModelStage(f'{attr}.{i}', [f'{attr}.{i}'], m) for i, m in enumerate(getattr(model, attr))]
+
+def _layer_stages(model):
+    return [ModelStage(n, [n], getattr(model, n)) for n in ('layer1', 'layer2', 'layer3', 'layer4') if hasattr(model, n)]
+
+def get_stages(model):
+    """The forward of `model` as a list of ModelStage applied in order. A stage name is a boundary where
+    the model can be split, e.g. to cache the activations of a frozen prefix. Models without a
+    decomposition are a single stage."""
+    if isinstance(model, (AllCNN, SmallAllCNN, ntk_AllCNN)):
+        return _sequential_stages(model, 'features') + _sequential_stages(model, 'classifier')
+    if isinstance(model, MLP):
+        stages = _sequential_stages(model, 'layers')
+        first = stages[0].forward
+        stages[0] = stages[0]._replace(forward=lambda x: first(x.reshape(x.size(0), model.input_size)))
+        return stages
+    if isinstance(model, NTK_MLP):
+        return [ModelStage('fc1', ['fc1'], lambda x: F.relu(model.fc1(x))), ModelStage('fc2', ['fc2'], model.fc2)]
+    if isinstance(model, (ResNet18, ResNet18_small)):
+        pool = 4 if isinstance(model, ResNet18) else 8
+        return [ModelStage('conv1', ['conv1', 'bn1'], lambda x: F.relu(model.bn1(model.conv1(x))))] + _layer_stages(model) + \
+            [ModelStage('linear', ['linear'], lambda x: model.linear(F.avg_pool2d(x, pool).view(x.size(0), -1)))]
+    if isinstance(model, (Wide_ResNet, Wide_ResNetIS, Wide_ResNetNTK)):
+        return [ModelStage('conv1', ['conv1'], model.conv1)] + _layer_stages(model) + \
+            [ModelStage('linear', ['bn1', 'linear'],
+                        lambda x: model.linear(F.avg_pool2d(F.relu(model.bn1(x)), 8).view(x.size(0), -1)))]
+    return [ModelStage('model', [''], model)]
+
+class StagedModel(nn.Module):
+    """`model` split at the stage named `start`: `prefix` runs the stages before it and the forward runs
+    the rest, so that `model(x) == staged(staged.prefix(x))`."""
+    def __init__(self, model, start):
+        super(StagedModel, self).__init__()
+        self.model = model
+        self.stages = get_stages(model)
+        names = [stage.name for stage in self.stages]
+        if start not in names:
+            raise ValueError(f'{start} is not a stage of {type(model).__name__}: {names}')
+        self.start = names.index(start)
+
+    def prefix(self, x):
+        for stage in self.stages[:self.start]:
+            x = stage.forward(x)
+        return x
+
+    def forward(self, x):
+        for stage in self.stages[self.start:]:
+            x = stage.forward(x)
+        return x
+
 _MODELS = {}
 
 def _add_model(model_fn):
@@ -671,5 +732,70 @@ def is_wide_resnet(**kwargs):
 def ntk_wide_resnet(**kwargs):
     return Wide_ResNetNTK(**kwargs)
 
-def get_model(name, **kwargs):
-    return _MODELS[name](**kwargs)
+def compile_model(model, example_input=None):
+    """Compiles `model` in place with torch.compile, falling back to TorchScript and then eager.
+
+    If `example_input` is given, the compiled graphs for train (with backward) and eval mode are
+    built right away on it, so compilation errors fall back here instead of at the first real step
+    and the first epoch is not charged with compile time. Without it, graphs are built on the first
+    calls, and a call that fails to compile runs (and from then on, the model runs) eagerly. Parameters, buffers and grads are left
+    as they were. Create copies (e.g. model_init) before compiling: a deepcopy of a compiled model
+    still calls into the original module.
+    """
+    if hasattr(torch, '_inductor') and hasattr(torch._inductor.config, 'fx_graph_cache'):
+        torch._inductor.config.fx_graph_cache = True
+    try:
+        if hasattr(model, 'compile'):
+            model.compile()
+            compiled = model
+            if example_input is None:
+                _fall_back_on_error(model)
+        else:
+            compiled = torch.compile(model)
+        if example_input is not None:
+            _warm_up(compiled, model, example_input)
+        return compiled
+    except Exception as e:
+        warnings.warn(f"torch.compile failed for {type(model).__name__} ({e}), trying torch.jit.script")
+        if hasattr(model, '_compiled_call_impl'):
+            model._compiled_call_impl = None
+    try:
+        scripted = torch.jit.script(model)
+        if example_input is not None:
+            _warm_up(scripted, model, example_input)
+        return scripted
+    except Exception as e:
+        warnings.warn(f"torch.jit.script failed for {type(model).__name__} ({e}), running eagerly")
+    return model
+
+def _fall_back_on_error(model):
+    """Makes the compiled forward of `model` (compiled in place) fall back to eager on errors."""
+    compiled_call = model._compiled_call_impl
+
+    def call(*args, **kwargs):
+        try:
+            return compiled_call(*args, **kwargs)
+        except Exception as e:
+            warnings.warn(f"torch.compile failed for {type(model).__name__} ({e}), running eagerly")
+            model._compiled_call_impl = None
+            return model._call_impl(*args, **kwargs)
+    model._compiled_call_impl = call
+
+def _warm_up(compiled, model, example_input):
+    state = copy.deepcopy(model.state_dict())
+    training = model.training
+    compiled.train()
+    compiled(example_input).float().sum().backward()
+    compiled.eval()
+    with torch.no_grad():
+        compiled(example_input)
+    for p in model.parameters():
+        p.grad = None
+    model.load_state_dict(state)
+    compiled.train(training)
+
+def get_model(name, compile=False, example_input=None, **kwargs):
+    model = _MODELS[name](**kwargs)
+    if compile:
+        model = compile_model(model, example_input=example_input)
+    return model
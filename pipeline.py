@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+"""Headless version of the unlearning notebooks: training, the unlearning methods and the readouts
+as stages with explicit inputs and outputs.
+
+    python pipeline.py --base "--dataset mnist --model mlp --dataroot data/MNIST/ --weight-decay 0.1 \
+        --epochs 31 --seed 3 --confuse-mode --forget-class 0,1 --num-to-forget 300" --workers 4
+
+    python pipeline.py --base "..." --stages neggrad,table -p ng_alpha=0.9    # only NegGrad and its readout rerun
+
+Every artifact (checkpoints, Fisher diagonals, NTK Jacobian blocks, the split manifest, readouts and the
+evaluation table) is stored once under artifacts/objects/, named by the SHA-256 of its content. A stage
+is identified by the hash of its name, its parameters and the content hashes of its inputs; the outputs
+of a finished stage are recorded in artifacts/stages/<key>.json, so a stage whose inputs and parameters
+are unchanged is skipped. Stages whose inputs are ready run concurrently on a local process pool, with
+the datasets shared read-only through shared memory as in sweep.py. `-p key=value` overrides the method
+hyper-parameters of unlearning.DEFAULTS.
+"""
+import argparse
+import contextlib
+import copy
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import sys
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+import fisher_store
+import kfac
+import models
+import datasets_multiclass as datasets
+import unlearning
+from certified import CertifiedRemoval
+from checkpoint_store import load_checkpoint
+from logger import Logger
+from main import parse_args
+from sweep import ROOT, init_worker, parse_value, run_config, summary_table
+
+Stage = namedtuple('Stage', ['name', 'fn', 'inputs', 'params', 'outputs'])
+
+# Training options every method depends on besides its inputs.
+COMMON_PARAMS = ['model', 'filters', 'weight_decay', 'seed', 'batch_size', 'amp']
+
+
+class ArtifactStore(object):
+    """Content-addressed files: objects/<sha256><ext>, and stage records stages/<key>.json."""
+
+    def __init__(self, root):
+        self.root = root
+        for d in ['objects', 'stages', 'tmp']:
+            os.makedirs(os.path.join(root, d), exist_ok=True)
+
+    def path(self, object_id):
+        return os.path.join(self.root, 'objects', object_id)
+
+    def put(self, src):
+        h = hashlib.sha256()
+        with open(src, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        object_id = h.hexdigest() + os.path.splitext(src)[1]
+        if os.path.isfile(self.path(object_id)):
+            os.remove(src)
+        else:
+            os.replace(src, self.path(object_id))
+        return object_id
+
+    def tmp_dir(self, key):
+        path = os.path.join(self.root, 'tmp', key)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return path
+
+    def record(self, key):
+        try:
+            with open(os.path.join(self.root, 'stages', f'{key}.json')) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not all(os.path.isfile(self.path(o)) for o in record['outputs'].values()):
+            return None
+        return record
+
+    def save_record(self, key, record):
+        tmp = os.path.join(self.root, 'stages', f'{key}.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(record, f, indent=2)
+        os.replace(tmp, os.path.join(self.root, 'stages', f'{key}.json'))
+
+
+def stage_key(stage, input_ids):
+    spec = dict(stage=stage.name, fn=stage.fn.__name__, params=stage.params, inputs=input_ids)
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def _load_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _prepare(opt, inputs):
+    opt = copy.copy(opt)
+    opt.device = torch.device('cuda' if not opt.no_cuda and torch.cuda.is_available() else 'cpu')
+    manifest = _load_manifest(inputs['split'])
+    if opt.num_classes is None:
+        opt.num_classes = manifest['num_classes']
+    torch.manual_seed(opt.seed)
+    return opt, manifest
+
+
+def _loaders(opt, manifest, retain_bs=None):
+    train_set, retain_set, forget_set, test_set = unlearning.split_datasets(manifest)
+    return (unlearning.make_loader(train_set, opt.batch_size, seed=opt.seed),
+            unlearning.make_loader(retain_set, retain_bs or opt.batch_size, seed=opt.seed),
+            unlearning.make_loader(forget_set, opt.forget_bs, seed=opt.seed),
+            unlearning.make_loader(test_set, opt.batch_size, seed=opt.seed, shuffle=False))
+
+
+def _load_model(opt, path):
+    model = models.get_model(opt.model, num_classes=opt.num_classes, filters_percentage=opt.filters).to(opt.device)
+    model.load_state_dict(torch.load(path, map_location=opt.device))
+    return model
+
+
+def _save_model(model, out_dir, name='model'):
+    path = os.path.join(out_dir, f'{name}.pt')
+    torch.save(model.state_dict(), path)
+    return path
+
+
+def _save_json(obj, out_dir, name):
+    path = os.path.join(out_dir, f'{name}.json')
+    with open(path, 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    return path
+
+
+# ---- stages. Each takes (opt, input paths, stage params, output directory) and returns {output: path}.
+
+def train_stage(opt, inputs, params, out_dir):
+    name = f"pipeline_{params['split']}_{os.path.basename(out_dir)[:16]}"
+    result = run_config((name, params['argv']))
+    if result['status'] != 'done':
+        raise RuntimeError(f"main.py {result['status']}, see logs/{name}.out")
+    final_epoch = Logger.load(os.path.join(ROOT, 'logs', f'{name}_training.p'))['final_epoch']
+    outputs = {}
+    for output, suffix in [('model', final_epoch), ('init', 'init')]:
+        outputs[output] = os.path.join(out_dir, f'{output}.pt')
+        path = os.path.join(ROOT, 'checkpoints', f'{name}_{suffix}.pt')
+        if os.path.isfile(path):
+            shutil.copyfile(path, outputs[output])
+        else:
+            # trained with --checkpoint-store
+            torch.save(load_checkpoint(path, store_root=os.path.join(ROOT, 'checkpoints', 'store')), outputs[output])
+    if '--ledger' in params['argv']:
+        outputs['ledger'] = os.path.join(out_dir, 'model.ledger')
+        shutil.move(os.path.join(ROOT, 'checkpoints', f'{name}.ledger'), outputs['ledger'])
+    return outputs
+
+
+def split_stage(opt, inputs, params, out_dir):
+    return {'manifest': _save_json(unlearning.make_split_manifest(opt), out_dir, 'manifest')}
+
+
+def finetune_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    _, retain_loader, _, _ = _loaders(opt, manifest)
+    model = unlearning.finetune(_load_model(opt, inputs['model']), retain_loader, opt, lr=opt.ft_lr, epochs=opt.ft_epochs)
+    return {'model': _save_model(model, out_dir)}
+
+
+def neggrad_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    _, retain_loader, forget_loader, _ = _loaders(opt, manifest)
+    model = unlearning.negative_grad(_load_model(opt, inputs['model']), retain_loader, forget_loader, opt)
+    return {'model': _save_model(model, out_dir)}
+
+
+def cfk_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    _, retain_loader, _, _ = _loaders(opt, manifest)
+    model = unlearning.cf_k(_load_model(opt, inputs['model']), retain_loader, opt)
+    return {'model': _save_model(model, out_dir)}
+
+
+def amnesiac_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    _, retain_loader, _, _ = _loaders(opt, manifest)
+    model = unlearning.amnesiac(_load_model(opt, inputs['model']), inputs['ledger'], manifest['forget_indexes'],
+                                retain_loader, opt)
+    return {'model': _save_model(model, out_dir)}
+
+
+def euk_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    _, retain_loader, _, _ = _loaders(opt, manifest)
+    model = unlearning.eu_k(_load_model(opt, inputs['model']), _load_model(opt, inputs['init']), retain_loader, opt)
+    return {'model': _save_model(model, out_dir)}
+
+
+def fisher_diag_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    fisher = fisher_store.estimate(_load_model(opt, inputs['model']), manifest, opt, subset='retain')
+    path = os.path.join(out_dir, 'fisher.pt')
+    fisher.save(path)
+    return {'fisher': path}
+
+
+def fisher_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    fisher = fisher_store.FisherArtifact.load(inputs['fisher'], device=opt.device)
+    model = unlearning.fisher_forget(_load_model(opt, inputs['model']), fisher, opt, alpha=opt.fisher_alpha)
+    return {'model': _save_model(model, out_dir)}
+
+
+def kfac_factors_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    _, retain_set, _, _ = unlearning.split_datasets(manifest)
+    fisher = kfac.KFACFisher.estimate(_load_model(opt, inputs['model']), retain_set, opt, num_samples=opt.kfac_samples)
+    path = os.path.join(out_dir, 'kfac.pt')
+    torch.save(fisher.state_dict(), path)
+    return {'factors': path}
+
+
+def kfac_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    fisher = kfac.KFACFisher.from_state_dict(torch.load(inputs['factors']), device=opt.device)
+    fisher_diag = fisher_store.FisherArtifact.load(inputs['fisher'], device=opt.device)
+    model = kfac.kfac_forget(_load_model(opt, inputs['model']), fisher, opt, alpha=opt.fisher_alpha, fisher_diag=fisher_diag)
+    return {'model': _save_model(model, out_dir)}
+
+
+def ntk_jacobian_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    _, retain_set, forget_set, _ = unlearning.split_datasets(manifest)
+    G, residual = unlearning.ntk_jacobian(_load_model(opt, inputs['model']),
+                                          retain_set if params['subset'] == 'retain' else forget_set, opt)
+    path = os.path.join(out_dir, 'jacobian.npz')
+    np.savez(path, G=G, residual=residual)
+    return {'jacobian': path}
+
+
+def ntk_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    retain, forget = np.load(inputs['retain']), np.load(inputs['forget'])
+    model, scale = unlearning.ntk_forget(_load_model(opt, inputs['model']), _load_model(opt, inputs['init']),
+                                         retain['G'], retain['residual'], forget['G'], forget['residual'], opt)
+    return {'model': _save_model(model, out_dir), 'scale': _save_json({'predicted_scale': float(scale)}, out_dir, 'scale')}
+
+
+def newton_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    _, retain_loader, forget_loader, _ = _loaders(opt, manifest)
+    model, residuals = unlearning.newton_forget(_load_model(opt, inputs['model']), retain_loader, forget_loader, opt)
+    return {'model': _save_model(model, out_dir), 'residuals': _save_json({'residuals': residuals}, out_dir, 'residuals')}
+
+
+def certified_engine_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    train_set, _, _, _ = unlearning.split_datasets(manifest)
+    engine = CertifiedRemoval(_load_model(opt, inputs['model']), _load_model(opt, inputs['init']), train_set, opt,
+                              eps=opt.certified_eps, delta=opt.certified_delta)
+    path = os.path.join(out_dir, 'engine.pt')
+    engine.save(path)
+    return {'engine': path}
+
+
+def certified_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    # the stage inputs are read-only: the request updates a copy of the engine, which is an output
+    engine_path = os.path.join(out_dir, 'engine.pt')
+    shutil.copyfile(inputs['engine'], engine_path)
+    model, info = unlearning.certified_forget(_load_model(opt, inputs['model']), None, None, manifest['forget_indexes'],
+                                              opt, engine_path=engine_path)
+    return {'model': _save_model(model, out_dir), 'info': _save_json(info, out_dir, 'info'), 'engine': engine_path}
+
+
+def scrub_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    _, retain_loader, forget_loader, _ = _loaders(opt, manifest, retain_bs=opt.retain_bs)
+    model = unlearning.scrub(_load_model(opt, inputs['model']), retain_loader, forget_loader, opt)
+    return {'model': _save_model(model, out_dir)}
+
+
+def readout_stage(opt, inputs, params, out_dir):
+    opt, manifest = _prepare(opt, inputs)
+    loaders = _loaders(opt, manifest)
+    # the forget-set loss of the original model is the re-learn target of every method
+    thresh = unlearning.test(_load_model(opt, inputs['original']), loaders[2], opt)['loss'] + 1e-5
+    readout = unlearning.all_readouts(_load_model(opt, inputs['model']), loaders, opt, thresh=thresh)
+    return {'readout': _save_json(dict(readout, method=params['method']), out_dir, 'readout')}
+
+
+def table_stage(opt, inputs, params, out_dir):
+    rows = []
+    for method in params['methods']:
+        with open(inputs[method]) as f:
+            rows.append(json.load(f))
+    return {'table': _save_json(rows, out_dir, 'table')}
+
+
+METHODS = [
+    # (readout label, stage, output)
+    ('Original', 'original', 'model'), ('Retrain', 'retrain', 'model'), ('Finetune', 'finetune', 'model'),
+    ('NegGrad', 'neggrad', 'model'), ('CF-k', 'cfk', 'model'), ('EU-k', 'euk', 'model'),
+    ('Fisher', 'fisher', 'model'), ('K-FAC', 'kfac', 'model'), ('NTK', 'ntk', 'model'), ('Newton', 'newton', 'model'),
+    ('Certified', 'certified', 'model'), ('Amnesiac', 'amnesiac', 'model'), ('SCRUB', 'scrub', 'model'),
+]
+
+
+def drop_flags(argv, flags):
+    """`argv` without the options `flags` (as `--flag value` or `--flag=value`)."""
+    out, skip = [], False
+    for a in argv:
+        if skip:
+            skip = False
+        elif a in flags:
+            skip = True
+        elif a.split('=', 1)[0] not in flags:
+            out.append(a)
+    return out
+
+
+def build_stages(base_argv, opt):
+    def hp(*keys):
+        return {k: getattr(opt, k) for k in COMMON_PARAMS + list(keys)}
+
+    split, model = {'split': 'split.manifest'}, {'model': 'original.model'}
+    # amnesiac unlearning needs the update ledger of the original run: only with --ledger in --base
+    has_ledger = opt.ledger
+    # get_loaders removes the forget samples whatever the split unless in confuse mode, so the original model
+    # is trained without --forget-class / --num-to-forget as in the notebooks
+    original_argv = base_argv if opt.confuse_mode else drop_flags(base_argv, ['--forget-class', '--num-to-forget'])
+    original_argv = original_argv + ['--split', 'train']
+    methods = [m for m in METHODS if has_ledger or m[1] != 'amnesiac']
+    stages = [
+        Stage('original', train_stage, {}, {'split': 'train', 'argv': original_argv},
+              ['model', 'init'] + (['ledger'] if has_ledger else [])),
+        Stage('retrain', train_stage, {}, {'split': 'forget', 'argv': base_argv + ['--split', 'forget']}, ['model', 'init']),
+        Stage('split', split_stage, {}, {k: getattr(opt, k) for k in ['dataset', 'dataroot', 'seed', 'forget_class',
+                                                                      'num_to_forget', 'confuse_mode']}, ['manifest']),
+        Stage('finetune', finetune_stage, dict(split, **model), hp('ft_lr', 'ft_epochs'), ['model']),
+        Stage('neggrad', neggrad_stage, dict(split, **model), hp('ng_alpha', 'ng_lr', 'ng_epochs', 'forget_bs'), ['model']),
+        Stage('cfk', cfk_stage, dict(split, **model),
+              hp('cfk_lr', 'cfk_epochs', 'fk_lr_decay_epochs', 'feature_cache', 'feature_boundary'), ['model']),
+        Stage('euk', euk_stage, dict(split, init='original.init', **model),
+              hp('euk_lr', 'euk_epochs', 'fk_lr_decay_epochs', 'feature_cache', 'feature_boundary'), ['model']),
+        Stage('fisher_diag', fisher_diag_stage, dict(split, **model), hp(), ['fisher']),
+        Stage('fisher', fisher_stage, dict(split, fisher='fisher_diag.fisher', **model), hp('fisher_alpha'), ['model']),
+        Stage('kfac_factors', kfac_factors_stage, dict(split, **model), hp('kfac_samples'), ['factors']),
+        Stage('kfac', kfac_stage, dict(split, factors='kfac_factors.factors', fisher='fisher_diag.fisher', **model),
+              hp('fisher_alpha'), ['model']),
+        Stage('ntk_jacobian_retain', ntk_jacobian_stage, dict(split, **model), dict(hp(), subset='retain'), ['jacobian']),
+        Stage('ntk_jacobian_forget', ntk_jacobian_stage, dict(split, **model), dict(hp(), subset='forget'), ['jacobian']),
+        Stage('ntk', ntk_stage, dict(split, init='original.init', retain='ntk_jacobian_retain.jacobian',
+                                     forget='ntk_jacobian_forget.jacobian', **model), hp(), ['model', 'scale']),
+        Stage('newton', newton_stage, dict(split, **model),
+              hp('forget_bs', *[k for k in unlearning.DEFAULTS if k.startswith('newton')]), ['model', 'residuals']),
+        Stage('certified_engine', certified_engine_stage, dict(split, init='original.init', **model),
+              hp('certified_eps', 'certified_delta'), ['engine']),
+        Stage('certified', certified_stage, dict(split, engine='certified_engine.engine', **model), hp(),
+              ['model', 'info', 'engine']),
+        Stage('amnesiac', amnesiac_stage, dict(split, ledger='original.ledger', **model),
+              hp('amnesiac_lr', 'amnesiac_epochs'), ['model']),
+        Stage('scrub', scrub_stage, dict(split, **model),
+              hp(*[k for k in unlearning.DEFAULTS if k.startswith('sgda') or k in
+                   ['retain_bs', 'forget_bs', 'optim', 'gamma', 'alpha', 'beta', 'smoothing', 'msteps', 'clip', 'sstart',
+                    'kd_T', 'distill', 'lr_decay_rate', 'swa_beta', 'teacher_cache']]), ['model']),
+    ]
+    if not has_ledger:
+        stages = [s for s in stages if s.name != 'amnesiac']
+    for label, stage, output in methods:
+        stages.append(Stage(f'readout_{stage}', readout_stage,
+                            dict(split, original='original.model', model=f'{stage}.{output}'),
+                            dict(hp('forget_bs', 'readout_epochs', 'readout_lr'), method=label), ['readout']))
+    stages.append(Stage('table', table_stage, {label: f'readout_{stage}.readout' for label, stage, _ in methods},
+                        {'methods': [label for label, _, _ in methods]}, ['table']))
+    return stages
+
+
+def select_stages(stages, names):
+    """`names` and every stage they depend on, in definition order."""
+    by_name = {s.name: s for s in stages}
+    needed, todo = set(), list(names)
+    while todo:
+        name = todo.pop()
+        if name not in by_name:
+            raise ValueError(f'Unknown stage {name}; stages are {", ".join(by_name)}')
+        if name not in needed:
+            needed.add(name)
+            todo += [ref.split('.')[0] for ref in by_name[name].inputs.values()]
+    return [s for s in stages if s.name in needed]
+
+
+def run_stage(job):
+    stage, opt, inputs, out_dir = job
+    os.chdir(ROOT)
+    t1 = time.time()
+    with open(os.path.join(ROOT, 'logs', f'pipeline_{stage.name}.out'), 'w') as out, \
+            contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        try:
+            outputs = stage.fn(opt, inputs, stage.params, out_dir)
+        except Exception:
+            traceback.print_exc()
+            raise
+    return outputs, time.time() - t1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--base', type=str, required=True, help='main.py arguments of the original training run')
+    parser.add_argument('--stages', type=str, default='table',
+                        help='Comma separated stages to bring up to date, with their dependencies (default: everything)')
+    parser.add_argument('-p', '--param', action='append', default=[],
+                        help='key=value, overrides a method hyper-parameter of unlearning.DEFAULTS, repeatable')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Concurrent stages (default: one per GPU, or one per 4 CPU cores)')
+    parser.add_argument('--artifacts', type=str, default='artifacts')
+    parser.add_argument('--no-shared-data', action='store_true', default=False)
+    parser.add_argument('--force', action='store_true', default=False, help='Rerun the selected stages even if cached')
+    parser.add_argument('--dry-run', action='store_true', default=False, help='Only list the stages to run')
+    parser.add_argument('--out', type=str, default='logs/pipeline_table.json')
+    pipe_args = parser.parse_args()
+    os.chdir(ROOT)
+    os.makedirs('logs', exist_ok=True)
+
+    base_argv = shlex.split(pipe_args.base)
+    if '--split' in base_argv or '--name' in base_argv:
+        parser.error('--base sets --split and --name per stage; leave them out')
+    args = parse_args(base_argv + ['--split', 'train'])
+    if args.world_size > 1 or args.ensemble_seeds is not None:
+        parser.error('--world-size and --ensemble-seeds are not supported in the pipeline')
+    overrides = {}
+    for p in pipe_args.param:
+        k, v = p.split('=', 1)
+        if k not in unlearning.DEFAULTS:
+            parser.error(f'Unknown method hyper-parameter {k}')
+        overrides[k] = parse_value(v)
+    opt = unlearning.method_args(args, **overrides)
+
+    store = ArtifactStore(pipe_args.artifacts)
+    stages = select_stages(build_stages(base_argv, opt), pipe_args.stages.split(','))
+    done, pending, running = {}, list(stages), {}
+
+    def resolve(stage):
+        if not all(ref.split('.')[0] in done for ref in stage.inputs.values()):
+            return None
+        return {k: done[ref.split('.')[0]]['outputs'][ref.split('.')[1]] for k, ref in stage.inputs.items()}
+
+    if pipe_args.dry_run:
+        for stage in stages:
+            print(stage.name, stage.inputs, stage.params)
+        return
+
+    num_gpus = torch.cuda.device_count()
+    workers = pipe_args.workers or (num_gpus if num_gpus > 0 else max(1, (os.cpu_count() or 1) // 4))
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    # training reads the augmented sets if --augment, the method stages the plain ones
+    shared = [] if pipe_args.no_shared_data else [
+        datasets.load_shared_dataset(args.dataset, root=args.dataroot, seed=args.seed, augment=augment)
+        for augment in sorted({args.augment, False})]
+
+    t1 = time.time()
+    ctx = mp.get_context('spawn')
+    counter = ctx.Value('i', 0)
+    rows = []
+    with ProcessPoolExecutor(workers, mp_context=ctx, initializer=init_worker,
+                             initargs=(shared, counter, num_threads, num_gpus)) as pool:
+        while pending or running:
+            for stage in list(pending):
+                input_ids = resolve(stage)
+                if input_ids is None:
+                    continue
+                pending.remove(stage)
+                key = stage_key(stage, input_ids)
+                record = None if pipe_args.force else store.record(key)
+                if record is not None:
+                    done[stage.name] = record
+                    rows.append(dict(stage=stage.name, status='cached', key=key[:12]))
+                    print(f'[cached] {stage.name} ({key[:12]})')
+                    continue
+                inputs = {k: os.path.abspath(store.path(o)) for k, o in input_ids.items()}
+                job = (stage, opt, inputs, os.path.abspath(store.tmp_dir(key)))
+                running[pool.submit(run_stage, job)] = (stage, key, input_ids)
+                print(f'[start] {stage.name} ({key[:12]})')
+            if not running:
+                if pending:
+                    raise RuntimeError(f'Unresolvable inputs for {", ".join(s.name for s in pending)}')
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, key, input_ids = running.pop(future)
+                try:
+                    outputs, wall_time = future.result()
+                except Exception as e:
+                    pool.shutdown(cancel_futures=True)
+                    raise RuntimeError(f'Stage {stage.name} failed ({e}), see logs/pipeline_{stage.name}.out')
+                record = dict(stage=stage.name, params=stage.params, inputs=input_ids, wall_time=wall_time,
+                              outputs={k: store.put(outputs[k]) for k in stage.outputs})
+                store.save_record(key, record)
+                shutil.rmtree(os.path.join(store.root, 'tmp', key), ignore_errors=True)
+                done[stage.name] = record
+                rows.append(dict(stage=stage.name, status='done', key=key[:12], wall_time=wall_time))
+                print(f'[done] {stage.name} ({wall_time:.1f} s)')
+                sys.stdout.flush()
+
+    print(summary_table(rows, ['stage', 'status', 'key', 'wall_time']))
+    print(f'Pipeline time: {time.time()-t1:.1f} sec with {workers} workers')
+    if 'table' in done:
+        with open(store.path(done['table']['outputs']['table'])) as f:
+            table = json.load(f)
+        print(summary_table(table, ['method', 'test_error', 'forget_error', 'retain_error', 'retrain_time']))
+        os.makedirs(os.path.dirname(pipe_args.out) or '.', exist_ok=True)
+        shutil.copyfile(store.path(done['table']['outputs']['table']), pipe_args.out)
+
+
+if __name__ == '__main__':
+    main()
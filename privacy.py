@@ -0,0 +1,183 @@
+import math
+
+import numpy as np
+import torch
+from torch.func import functional_call, grad, vmap
+
+DEFAULT_ORDERS = [1 + x / 10. for x in range(1, 100)] + list(range(12, 64)) + [128, 256]
+
+
+def _log_add(a, b):
+    hi, lo = max(a, b), min(a, b)
+    if lo == -np.inf:
+        return hi
+    return hi + math.log1p(math.exp(lo - hi))
+
+
+def _log_sub(a, b):
+    if b == -np.inf:
+        return a
+    if a == b:
+        return -np.inf
+    return a + math.log1p(-math.exp(b - a))
+
+
+def _log_a_int(q, sigma, alpha):
+    log_a = -np.inf
+    for i in range(alpha + 1):
+        log_coef = math.lgamma(alpha + 1) - math.lgamma(i + 1) - math.lgamma(alpha - i + 1)
+        s = log_coef + i * math.log(q) + (alpha - i) * math.log(1 - q) + (i * i - i) / (2 * sigma ** 2)
+        log_a = _log_add(log_a, s)
+    return log_a
+
+
+def _log_erfc(x):
+    return math.log(2) + _log_ndtr(-x * 2 ** .5)
+
+
+def _log_ndtr(x):
+    if x > -20:
+        return math.log(0.5 * math.erfc(-x / 2 ** .5))
+    # asymptotic expansion of log(Phi(x)) for very negative x
+    return -x ** 2 / 2 - math.log(-x) - 0.5 * math.log(2 * math.pi)
+
+
+def _log_a_frac(q, sigma, alpha):
+    log_a0, log_a1 = -np.inf, -np.inf
+    z0 = sigma ** 2 * math.log(1 / q - 1) + .5
+    i, log_coef, sign = 0, 0., 1
+    while True:
+        if i > 0:
+            # binom(alpha, i) = binom(alpha, i - 1) * (alpha - i + 1) / i, kept as sign and log magnitude
+            log_coef += math.log(abs(alpha - i + 1)) - math.log(i)
+            sign *= 1 if alpha - i + 1 > 0 else -1
+        j = alpha - i
+        log_t0 = log_coef + i * math.log(q) + j * math.log(1 - q)
+        log_t1 = log_coef + j * math.log(q) + i * math.log(1 - q)
+        log_e0 = math.log(.5) + _log_erfc((i - z0) / (2 ** .5 * sigma))
+        log_e1 = math.log(.5) + _log_erfc((z0 - j) / (2 ** .5 * sigma))
+        log_s0 = log_t0 + (i * i - i) / (2 * sigma ** 2) + log_e0
+        log_s1 = log_t1 + (j * j - j) / (2 * sigma ** 2) + log_e1
+        if sign > 0:
+            log_a0, log_a1 = _log_add(log_a0, log_s0), _log_add(log_a1, log_s1)
+        else:
+            log_a0, log_a1 = _log_sub(log_a0, log_s0), _log_sub(log_a1, log_s1)
+        i += 1
+        if max(log_s0, log_s1) < -30:
+            break
+    return _log_add(log_a0, log_a1)
+
+
+def _compute_rdp(q, sigma, alpha):
+    if q == 0:
+        return 0.
+    if sigma == 0:
+        return np.inf
+    if q == 1.:
+        return alpha / (2 * sigma ** 2)
+    if float(alpha).is_integer():
+        log_a = _log_a_int(q, sigma, int(alpha))
+    else:
+        log_a = _log_a_frac(q, sigma, alpha)
+    return log_a / (alpha - 1)
+
+
+def compute_rdp(sample_rate, noise_multiplier, steps, orders=DEFAULT_ORDERS):
+    """RDP of `steps` compositions of the Poisson-subsampled Gaussian mechanism at each order
+    (Mironov, Talwar & Zhang, 2019)."""
+    return np.array([_compute_rdp(sample_rate, noise_multiplier, a) for a in orders]) * steps
+
+
+def get_privacy_spent(orders, rdp, delta):
+    """(epsilon, best order) for the RDP curve `rdp`, using the conversion of Balle et al. (2020)."""
+    orders, rdp = np.atleast_1d(orders).astype(float), np.atleast_1d(rdp)
+    eps = rdp - (np.log(delta) + np.log(orders)) / (orders - 1) + np.log((orders - 1) / orders)
+    eps[np.isnan(eps)] = np.inf
+    idx = int(np.argmin(eps))
+    return max(float(eps[idx]), 0.), orders[idx]
+
+
+class RDPAccountant(object):
+    """Tracks the privacy spent by DP-SGD steps.
+
+    Steps sharing (noise_multiplier, sample_rate) are grouped, so `get_epsilon` costs one RDP
+    evaluation per distinct setting, not per step.
+    """
+
+    def __init__(self, orders=DEFAULT_ORDERS):
+        self.orders = orders
+        self.history = []
+
+    def step(self, noise_multiplier, sample_rate, steps=1):
+        if self.history and self.history[-1][:2] == (noise_multiplier, sample_rate):
+            self.history[-1] = (noise_multiplier, sample_rate, self.history[-1][2] + steps)
+        else:
+            self.history.append((noise_multiplier, sample_rate, steps))
+
+    def get_epsilon(self, delta):
+        rdp = sum(compute_rdp(q, sigma, steps, self.orders) for sigma, q, steps in self.history)
+        return get_privacy_spent(self.orders, rdp, delta)[0]
+
+
+class PoissonBatchSampler(object):
+    """Includes every sample independently with probability `sample_rate`, as the RDP analysis
+    of DP-SGD assumes. Batches therefore have a random size with mean `sample_rate * num_samples`.
+    Empty draws are skipped but still count as one of the `steps` privacy-accounted steps."""
+
+    def __init__(self, num_samples, sample_rate, steps=None, generator=None):
+        self.num_samples = num_samples
+        self.sample_rate = sample_rate
+        self.steps = steps if steps is not None else int(round(1 / sample_rate))
+        self.generator = generator
+
+    def __len__(self):
+        return self.steps
+
+    def __iter__(self):
+        for _ in range(self.steps):
+            mask = torch.rand(self.num_samples, generator=self.generator) < self.sample_rate
+            if mask.any():
+                yield mask.nonzero().flatten().tolist()
+
+
+def poisson_loader(data_loader, batch_size, seed=None):
+    """A copy of `data_loader` that draws Poisson batches with expected size `batch_size`."""
+    dataset = data_loader.dataset
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+    sampler = PoissonBatchSampler(len(dataset), batch_size / len(dataset), generator=generator)
+    return torch.utils.data.DataLoader(dataset, batch_sampler=sampler, num_workers=data_loader.num_workers,
+                                       pin_memory=data_loader.pin_memory)
+
+
+def per_sample_grads(model, loss_fn, data, target):
+    """Gradients of `loss_fn(output, target)` for every sample of the batch, vectorized with
+    `torch.func.vmap`. Returns ({name: [B, *param.shape]}, per-sample losses, outputs).
+
+    Batch statistics would mix samples, so BatchNorm layers must be in eval mode.
+    """
+    params = {k: p.detach() for k, p in model.named_parameters() if p.requires_grad}
+    frozen = {k: p.detach() for k, p in model.named_parameters() if not p.requires_grad}
+    frozen.update(dict(model.named_buffers()))
+
+    def sample_loss(params, x, y):
+        output = functional_call(model, (params, frozen), (x.unsqueeze(0),)).float()
+        loss = loss_fn(output, y.unsqueeze(0))
+        return loss, (loss.detach(), output.squeeze(0).detach())
+
+    grads, (losses, outputs) = vmap(grad(sample_loss, has_aux=True), in_dims=(None, 0, 0),
+                                    randomness='different')(params, data, target)
+    return grads, losses, outputs
+
+
+def clip_and_noise(grads, max_grad_norm, noise_multiplier, batch_size, generator=None):
+    """Clips every per-sample gradient to L2 norm `max_grad_norm`, sums them, adds
+    N(0, (noise_multiplier * max_grad_norm)^2) noise and divides by the expected batch size.
+    Returns the private gradients and the per-sample norms before clipping."""
+    norms = torch.stack([g.flatten(1).pow(2).sum(1) for g in grads.values()]).sum(0).sqrt()
+    scale = (max_grad_norm / (norms + 1e-6)).clamp(max=1.)
+    private = {}
+    for k, g in grads.items():
+        summed = torch.einsum('b,b...->...', scale, g)
+        noise = torch.randn(summed.shape, generator=generator, device=summed.device) * noise_multiplier * max_grad_norm
+        private[k] = (summed + noise) / batch_size
+    return private, norms
@@ -0,0 +1,144 @@
+import json
+import os
+import time
+from collections import defaultdict
+
+import torch
+
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PhaseProfiler(object):
+    """Opt-in wall-clock profiler for the training and unlearning loops.
+
+    The loops call `lap(name)` at phase boundaries: the time since the previous
+    boundary is charged to `name`. `iter(loader)` charges the time spent waiting on
+    the loader to 'data'. `attach(model)` adds forward/backward hooks to every leaf
+    module and records per-module times. Peak memory per phase is the CUDA peak
+    allocation when running on GPU and the largest resident set size seen at the
+    end of the phase on CPU.
+
+    Attach it to the options object (`args.profiler = PhaseProfiler()`), which the
+    loops look up with `get_profiler(opt)`, then `export_chrome_trace(path)` for
+    chrome://tracing / Perfetto and `summary()` for a text table.
+    """
+
+    def __init__(self):
+        self.cuda = torch.cuda.is_available()
+        self.events = []
+        self.total = defaultdict(float)
+        self.count = defaultdict(int)
+        self.peak_memory = defaultdict(int)
+        self.module_total = defaultdict(float)
+        self.handles = []
+        self._origin = time.perf_counter()
+        self._last = self._origin
+        self._open = {}
+
+    def __getstate__(self):
+        # args (and so the profiler) is pickled with the training log on every append; keep the
+        # totals but not the hook handles or the per-event trace.
+        state = dict(self.__dict__)
+        state.update(events=[], handles=[], _open={})
+        return state
+
+    def _now(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _record(self, name, start, end, tid=0, cat='phase'):
+        self.events.append({'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                            'ts': 1e6 * (start - self._origin), 'dur': 1e6 * (end - start)})
+
+    def reset_clock(self):
+        self._last = self._now()
+
+    def lap(self, name):
+        now = self._now()
+        self._record(name, self._last, now)
+        self.total[name] += now - self._last
+        self.count[name] += 1
+        if self.cuda:
+            memory = torch.cuda.max_memory_allocated()
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            memory = _rss_bytes()
+        self.peak_memory[name] = max(self.peak_memory[name], memory)
+        self._last = now
+
+    def iter(self, iterable, name='data'):
+        self.reset_clock()
+        for item in iterable:
+            self.lap(name)
+            yield item
+            self.reset_clock()
+
+    def attach(self, model, prefix=''):
+        for module_name, module in model.named_modules():
+            if len(list(module.children())) > 0:
+                continue
+            key = f'{prefix}{module_name or type(module).__name__}'
+            self.handles.append(module.register_forward_pre_hook(self._start_hook(key, 'forward')))
+            self.handles.append(module.register_forward_hook(self._forward_hook(key)))
+        return self
+
+    def detach(self):
+        for h in self.handles:
+            h.remove()
+        self.handles = []
+
+    def _start_hook(self, key, direction):
+        def hook(module, *args):
+            self._open[(key, direction)] = self._now()
+        return hook
+
+    def _end(self, key, direction, tid):
+        start = self._open.pop((key, direction), None)
+        if start is not None:
+            end = self._now()
+            self._record(key, start, end, tid=tid, cat=direction)
+            self.module_total[(key, direction)] += end - start
+
+    def _forward_hook(self, key):
+        # Backward time of a module is measured between the gradient reaching its output and
+        # the gradient of its input. Tensor hooks are used instead of module backward hooks,
+        # which break on outputs that are later modified in place (e.g. `out += shortcut`).
+        def start_backward(grad):
+            self._open[(key, 'backward')] = self._now()
+
+        def end_backward(grad):
+            self._end(key, 'backward', tid=2)
+
+        def hook(module, inputs, output):
+            self._end(key, 'forward', tid=1)
+            if torch.is_grad_enabled() and isinstance(output, torch.Tensor) and output.requires_grad:
+                output.register_hook(start_backward)
+                if len(inputs) > 0 and isinstance(inputs[0], torch.Tensor) and inputs[0].requires_grad:
+                    inputs[0].register_hook(end_backward)
+        return hook
+
+    def export_chrome_trace(self, path):
+        names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': n}}
+                 for tid, n in [(0, 'phases'), (1, 'module forward'), (2, 'module backward')]]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': names + self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self, top_modules=10):
+        total = sum(self.total.values())
+        lines = [f"{'phase':<12}{'calls':>8}{'total s':>10}{'mean ms':>10}{'share':>8}{'peak MB':>10}"]
+        for name, t in sorted(self.total.items(), key=lambda x: -x[1]):
+            lines.append(f"{name:<12}{self.count[name]:>8}{t:>10.3f}{1e3 * t / self.count[name]:>10.2f}"
+                         f"{100 * t / max(total, 1e-12):>7.1f}%{self.peak_memory[name] / 2 ** 20:>10.1f}")
+        if self.module_total:
+            lines.append(f"{'module':<40}{'direction':>10}{'total s':>10}")
+            for (key, direction), t in sorted(self.module_total.items(), key=lambda x: -x[1])[:top_modules]:
+                lines.append(f"{key:<40}{direction:>10}{t:>10.3f}")
+        return '\n'.join(lines)
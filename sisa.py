@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Sharded, isolated, sliced and aggregated (SISA) training with exact unlearning (Bourtoule et al., 2021).
+
+The training split is partitioned into --num-shards disjoint shards of --num-slices slices each; the
+positions are kept in the split manifest (unlearning.shard_manifest), saved as checkpoints/<name>_sisa.json.
+One constituent model is trained per shard: on its first slice, then on the first two, ..., with a
+checkpoint after every slice. Predictions average the softmax outputs of the constituents. Forgetting a
+sample retrains only the constituent of its shard, from the checkpoint of the last slice before it.
+
+    python main.py --dataset small_cifar10 --model allcnn --epochs 30 --num-shards 5 --num-slices 3
+    python sisa.py forget --base "<same main.py flags>"                  # the forget set of the split
+    python sisa.py forget --base "<same main.py flags>" --indexes 3,17
+    python sisa.py eval --base "<same main.py flags>"
+
+Every slice gets a fresh optimizer and a loader seeded by (shard, slice), so retraining from a slice
+checkpoint gives the model that training from scratch without the forgotten samples would give.
+"""
+import argparse
+import copy
+import json
+import math
+import os
+import shlex
+
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+import models
+import unlearning
+from checkpoint_store import load_checkpoint
+from main import get_name, parse_args, run_epoch, save_checkpoint
+from utils import AverageMeter, get_error, log_metrics, manual_seed, mkdir
+
+
+def sisa_name(args):
+    return (args.name or get_name(args)) + '_sisa'
+
+
+def manifest_path(args):
+    return f'checkpoints/{sisa_name(args)}.json'
+
+
+def save_manifest(args, manifest):
+    with open(manifest_path(args), 'w') as f:
+        json.dump(manifest, f)
+
+
+def load_manifest(args):
+    with open(manifest_path(args)) as f:
+        return json.load(f)
+
+
+def _constituent(args, manifest, shard, suffix=None):
+    model = models.get_model(args.model, num_classes=manifest['num_classes'], filters_percentage=args.filters).to(args.device)
+    if suffix is not None:
+        model.load_state_dict(load_checkpoint(f'checkpoints/{sisa_name(args)}_shard{shard}_{suffix}.pt',
+                                              map_location=args.device))
+    return model
+
+
+def train_shard(args, manifest, train_set, shard, start_slice=0):
+    """Trains the constituent of `shard` from the checkpoint of slice `start_slice - 1` (its init for 0)
+    over the remaining slices, checkpointing after each."""
+    name = f'{sisa_name(args)}_shard{shard}'
+    if start_slice == 0:
+        manual_seed(args.seed + shard)
+        model = _constituent(args, manifest, shard)
+        save_checkpoint(args, model.state_dict(), name, 'init')
+    model = _constituent(args, manifest, shard, 'init')
+    model_init = copy.deepcopy(model)
+    if start_slice > 0:
+        model.load_state_dict(load_checkpoint(f'checkpoints/{name}_slice{start_slice - 1}.pt', map_location=args.device))
+    criterion = torch.nn.CrossEntropyLoss().to(args.device)
+    slices = manifest['shards'][shard]
+    epochs_per_slice = math.ceil(args.epochs / len(slices))
+    for s in range(start_slice, len(slices)):
+        indexes = [i for slice_ in slices[:s + 1] for i in slice_]
+        generator = torch.Generator().manual_seed(args.seed + 1000 * shard + s)
+        loader = torch.utils.data.DataLoader(torch.utils.data.Subset(train_set, indexes), batch_size=args.batch_size,
+                                             shuffle=True, generator=generator)
+        optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=0.0)
+        for epoch in range(s * epochs_per_slice, (s + 1) * epochs_per_slice):
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = args.lr * 0.1 ** (epoch // args.step_size) if args.step_size is not None else args.lr
+            metrics = run_epoch(args, model, model_init, loader, criterion, optimizer, epoch=epoch,
+                                weight_decay=args.weight_decay, mode='train', log=False)
+        log_metrics(f'train shard {shard} slice {s}', metrics, epoch)
+        save_checkpoint(args, model.state_dict(), name, f'slice{s}', base=f'slice{s - 1}' if s > 0 else 'init')
+    return model
+
+
+def run_sisa(args):
+    """Trains all constituents (main.py --num-shards)."""
+    args.device = torch.device('cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu')
+    os.makedirs('checkpoints', exist_ok=True)
+    mkdir('logs')
+    manifest = unlearning.make_split_manifest(args)
+    save_manifest(args, manifest)
+    train_set = unlearning.split_datasets(manifest, augment=args.augment)[0]
+    for shard in range(len(manifest['shards'])):
+        train_shard(args, manifest, train_set, shard)
+    print(f'Checkpoint names: {sisa_name(args)}_shard<k>_slice<s>, manifest: {manifest_path(args)}')
+
+
+def forget(args, indexes):
+    """Exact unlearning of the training positions `indexes`: retrains the shards that contain them and
+    saves the updated manifest. Returns {shard: first retrained slice}."""
+    manifest, affected = unlearning.remove_from_shards(load_manifest(args), indexes)
+    train_set = unlearning.split_datasets(manifest, augment=args.augment)[0]
+    for shard, start_slice in sorted(affected.items()):
+        print(f'Retraining shard {shard} from slice {start_slice}')
+        train_shard(args, manifest, train_set, shard, start_slice)
+    save_manifest(args, manifest)
+    return affected
+
+
+def load_constituents(args, manifest):
+    return [_constituent(args, manifest, k, f'slice{len(slices) - 1}').eval() for k, slices in enumerate(manifest['shards'])]
+
+
+def predict(constituents, data):
+    """Aggregate prediction: the mean of the constituents' softmax outputs."""
+    with torch.no_grad():
+        return torch.stack([F.softmax(model(data), dim=1) for model in constituents]).mean(0)
+
+
+def evaluate(args, constituents, loader):
+    metrics = AverageMeter()
+    for data, target, *_ in loader:
+        data, target = data.to(args.device), target.to(args.device)
+        if 'mnist' in args.dataset:
+            data = data.view(data.shape[0], -1)
+        metrics.update(n=data.size(0), error=get_error(predict(constituents, data), target))
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['forget', 'eval'])
+    parser.add_argument('--base', type=str, required=True, help='main.py flags of the sharded training run')
+    parser.add_argument('--indexes', type=str, default=None,
+                        help='Comma separated training positions to forget (default: the forget set of the split)')
+    opt = parser.parse_args()
+    args = parse_args(shlex.split(opt.base))
+    args.device = torch.device('cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu')
+
+    if opt.command == 'forget':
+        manifest = load_manifest(args)
+        indexes = [int(i) for i in opt.indexes.split(',')] if opt.indexes else manifest['forget_indexes']
+        affected = forget(args, indexes)
+        print(f'Forgot {len(indexes)} samples, retrained {len(affected)} of {len(manifest["shards"])} shards')
+
+    manifest = load_manifest(args)
+    _, retain_set, forget_set, test_set = unlearning.split_datasets(manifest)
+    constituents = load_constituents(args, manifest)
+    for split, dataset in [('retain', retain_set), ('forget', forget_set), ('test', test_set)]:
+        loader = unlearning.make_loader(dataset, args.batch_size, seed=args.seed, shuffle=False)
+        log_metrics(split, evaluate(args, constituents, loader), len(manifest['removed']))
+
+
+if __name__ == '__main__':
+    main()
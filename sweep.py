@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Runs a grid of main.py configurations on a local process pool.
+
+    python sweep.py --base "--epochs 30 --dataset small_cifar10" \
+        -p model=allcnn,resnet_small -p lr=0.1,0.01 -p weight-decay=5e-4 -p seed=1,2,3 \
+        -p "forget-class=5" -p split=train,forget
+
+    python sweep.py --grid nightly.json --workers 8
+
+A grid file is {"base": {"epochs": 30, ...}, "grid": {"lr": [0.1, 0.01], ...}}, keys are main.py
+flags without the leading dashes and `true` marks a store_true flag. Every configuration runs
+main.py in a pool worker, with stdout/stderr in logs/<name>.out. Configurations whose training
+log already records a finished run (or whose last checkpoint exists) are skipped. The datasets
+of the grid are loaded once and shared read-only with the workers through shared memory.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import runpy
+import shlex
+import sys
+import time
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+import datasets_multiclass as datasets
+from checkpoint_store import CheckpointStore
+from logger import Logger
+from main import get_name, parse_args
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def to_argv(config):
+    argv = []
+    for k, v in config.items():
+        if v is True:
+            argv.append(f'--{k}')
+        elif v is not False and v is not None:
+            argv += [f'--{k}', str(v)]
+    return argv
+
+
+def expand_grid(base, grid):
+    keys = list(grid)
+    return [dict(base, **dict(zip(keys, values))) for values in itertools.product(*[grid[k] for k in keys])]
+
+
+def parse_value(v):
+    try:
+        return json.loads(v)
+    except ValueError:
+        return v
+
+
+def is_finished(name, args):
+    log_file = os.path.join(ROOT, 'logs', f'{name}_training.p')
+    if os.path.isfile(log_file):
+        try:
+            if 'stop_reason' in Logger.load(log_file)._dict:
+                return True
+        except Exception:
+            pass
+    if args.checkpoint_store:
+        return f'{name}_{args.epochs-1}' in CheckpointStore(os.path.join(ROOT, 'checkpoints', 'store'))
+    return os.path.isfile(os.path.join(ROOT, 'checkpoints', f'{name}_{args.epochs-1}.pt'))
+
+
+def read_results(name):
+    try:
+        logger = Logger.load(os.path.join(ROOT, 'logs', f'{name}_training.p'))
+    except ValueError:
+        return {}
+    results = {k: logger._dict.get(k) for k in ['stop_reason', 'final_epoch', 'train_time']}
+    for mode in ['test', 'valid']:
+        entries = logger.get(mode)
+        if entries:
+            results[f'{mode}_loss'] = entries[-1]['loss']
+            results[f'{mode}_error'] = entries[-1]['error']
+    return results
+
+
+_WORKER = {}
+
+
+def init_worker(shared_datasets, counter, num_threads, num_gpus):
+    with counter.get_lock():
+        worker_id = counter.value
+        counter.value += 1
+    if num_gpus > 0:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(worker_id % num_gpus)
+    torch.set_num_threads(num_threads)
+    datasets.register_shared_datasets(shared_datasets)
+    _WORKER['id'] = worker_id
+
+
+def run_config(job):
+    name, argv = job
+    os.chdir(ROOT)
+    os.makedirs('logs', exist_ok=True)
+    status, t1 = 'done', time.time()
+    with open(os.path.join('logs', f'{name}.out'), 'w') as out, \
+            contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        sys.argv = ['main.py'] + argv + ['--name', name]
+        try:
+            runpy.run_path('main.py', run_name='__main__')
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                status = f'exit {e.code}'
+        except Exception:
+            traceback.print_exc()
+            status = 'failed'
+    return dict(name=name, status=status, worker=_WORKER.get('id'), wall_time=time.time()-t1, **read_results(name))
+
+
+def summary_table(rows, columns):
+    widths = [max(len(c), *[len(_fmt(r.get(c))) for r in rows]) for c in columns]
+    lines = ['  '.join(c.ljust(w) for c, w in zip(columns, widths))]
+    for r in rows:
+        lines.append('  '.join(_fmt(r.get(c)).ljust(w) for c, w in zip(columns, widths)))
+    return '\n'.join(lines)
+
+
+def _fmt(v):
+    if isinstance(v, float):
+        return f'{v:.4g}'
+    return '-' if v is None else str(v)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--grid', type=str, default=None, help='JSON file with "base" and "grid" entries')
+    parser.add_argument('-p', '--param', action='append', default=[],
+                        help='flag=v1,v2,... (main.py flag without dashes), repeatable')
+    parser.add_argument('--base', type=str, default='', help='main.py arguments shared by every configuration')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Pool size (default: one per GPU, or one per 4 CPU cores)')
+    parser.add_argument('--no-shared-data', action='store_true', default=False,
+                        help='Let every run load its own dataset instead of the shared-memory copy')
+    parser.add_argument('--force', action='store_true', default=False, help='Rerun finished configurations')
+    parser.add_argument('--dry-run', action='store_true', default=False, help='Only list the configurations')
+    parser.add_argument('--out', type=str, default='logs/sweep_summary.json')
+    sweep_args = parser.parse_args()
+    os.chdir(ROOT)
+
+    base, grid = {}, {}
+    if sweep_args.grid is not None:
+        with open(sweep_args.grid) as f:
+            spec = json.load(f)
+        base, grid = spec.get('base', {}), spec.get('grid', {})
+    for p in sweep_args.param:
+        k, v = p.split('=', 1)
+        grid[k] = [parse_value(x) for x in v.split(',')] if not v.startswith('[') else json.loads(v)
+
+    jobs, rows = [], []
+    for config in expand_grid(base, grid):
+        argv = shlex.split(sweep_args.base) + to_argv(config)
+        args = parse_args(argv)
+        if args.world_size > 1:
+            raise ValueError('--world-size > 1 needs its own processes and cannot run inside a sweep worker')
+        name = args.name if args.name is not None else get_name(args)
+        if not sweep_args.force and is_finished(name, args):
+            rows.append(dict(name=name, status='skipped', **read_results(name)))
+            continue
+        jobs.append(((name, argv), args))
+    print(f'{len(jobs)} configurations to run, {len(rows)} already finished')
+    if sweep_args.dry_run:
+        for (name, argv), _ in jobs:
+            print(name, ' '.join(argv))
+        return
+
+    num_gpus = torch.cuda.device_count()
+    workers = sweep_args.workers or (num_gpus if num_gpus > 0 else max(1, (os.cpu_count() or 1) // 4))
+    workers = max(1, min(workers, len(jobs)))
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+
+    shared = []
+    if not sweep_args.no_shared_data:
+        keys = {(a.dataset, a.dataroot, a.seed, a.augment) for _, a in jobs}
+        for dataset, root, seed, augment in sorted(keys):
+            shared.append(datasets.load_shared_dataset(dataset, root=root, seed=seed, augment=augment))
+
+    t1 = time.time()
+    ctx = mp.get_context('spawn')
+    counter = ctx.Value('i', 0)
+    with ctx.Pool(workers, initializer=init_worker, initargs=(shared, counter, num_threads, num_gpus),
+                  maxtasksperchild=None) as pool:
+        for result in pool.imap_unordered(run_config, [job for job, _ in jobs]):
+            print(f"[{result['status']}] {result['name']} ({result['wall_time']:.1f} s)")
+            rows.append(result)
+            sys.stdout.flush()
+
+    columns = ['name', 'status', 'wall_time', 'train_time', 'final_epoch', 'stop_reason',
+               'test_loss', 'test_error', 'valid_error']
+    print(summary_table(rows, columns))
+    print(f'Sweep time: {time.time()-t1:.1f} sec with {workers} workers')
+    os.makedirs(os.path.dirname(sweep_args.out) or '.', exist_ok=True)
+    with open(sweep_args.out, 'w') as f:
+        json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
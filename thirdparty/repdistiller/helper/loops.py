@@ -6,7 +6,8 @@ import torch
 from torch import nn
 from itertools import cycle
 
-from .util import AverageMeter, accuracy, param_dist
+from .util import AverageMeter, accuracy, param_dist, autocast, get_profiler, GradAccumulator, get_teacher_cache, \
+    teacher_outputs, neggrad_loss
 
 
 def train_negrad(epoch, train_loader, delete_loader, model, criterion, optimizer, alpha, opt, quiet=False):
@@ -14,13 +15,15 @@ def train_negrad(epoch, train_loader, delete_loader, model, criterion, optimizer
     model.train()
 
     batch_time = AverageMeter()
+    prof = get_profiler(opt)
+    accum = GradAccumulator(optimizer, len(train_loader), opt)
     data_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
     top5 = AverageMeter()
 
     end = time.time()
-    for idx, ((input, target), (del_input, del_target)) in enumerate(zip(train_loader, cycle(delete_loader))):
+    for idx, ((input, target), (del_input, del_target)) in enumerate(prof.iter(zip(train_loader, cycle(delete_loader)))):
         #del_input, del_target = next(cycle(delete_loader))
         data_time.update(time.time() - end)
 
@@ -32,13 +35,11 @@ def train_negrad(epoch, train_loader, delete_loader, model, criterion, optimizer
             del_input = del_input.cuda()
             del_target = del_target.cuda()
 
-        # ===================forward=====================
-        output = model(input)
-        del_output = model(del_input)
-        r_loss = criterion(output, target)
-        del_loss = criterion(del_output, del_target)
+        prof.lap('h2d')
 
-        loss = alpha*r_loss - (1-alpha)*del_loss
+        # ===================forward=====================
+        loss, output = neggrad_loss(model, criterion, input, target, del_input, del_target, alpha, opt)
+        prof.lap('forward')
 
         if not quiet:
             acc1, acc5 = accuracy(output, target, topk=(1, 5))
@@ -46,10 +47,14 @@ def train_negrad(epoch, train_loader, delete_loader, model, criterion, optimizer
             top1.update(acc1[0], input.size(0))
             top5.update(acc5[0], input.size(0))
 
+        prof.lap('metrics')
+
         # ===================backward=====================
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        accum.zero_grad()
+        accum.backward(loss)
+        prof.lap('backward')
+        accum.step()
+        prof.lap('step')
 
         # ===================meters=====================
         batch_time.update(time.time() - end)
@@ -80,13 +85,15 @@ def train_vanilla(epoch, train_loader, model, criterion, optimizer, opt, quiet=F
     model.train()
 
     batch_time = AverageMeter()
+    prof = get_profiler(opt)
+    accum = GradAccumulator(optimizer, len(train_loader), opt)
     data_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
     top5 = AverageMeter()
 
     end = time.time()
-    for idx, (input, target) in enumerate(train_loader):
+    for idx, (input, target) in enumerate(prof.iter(train_loader)):
         data_time.update(time.time() - end)
 
         input = input.float()
@@ -94,20 +101,31 @@ def train_vanilla(epoch, train_loader, model, criterion, optimizer, opt, quiet=F
             input = input.cuda()
             target = target.cuda()
 
+        prof.lap('h2d')
+
         # ===================forward=====================
-        output = model(input)
+        with autocast(opt):
+            output = model(input)
+        output = output.float()
+        prof.lap('forward')
         loss = criterion(output, target)
 
+        prof.lap('loss')
+
         if not quiet:
             acc1, acc5 = accuracy(output, target, topk=(1, 5))
             losses.update(loss.item(), input.size(0))
             top1.update(acc1[0], input.size(0))
             top5.update(acc5[0], input.size(0))
 
+        prof.lap('metrics')
+
         # ===================backward=====================
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        accum.zero_grad()
+        accum.backward(loss)
+        prof.lap('backward')
+        accum.step()
+        prof.lap('step')
 
         # ===================meters=====================
         batch_time.update(time.time() - end)
@@ -151,18 +169,23 @@ def train_distill(epoch, train_loader, module_list, swa_model, criterion_list, o
     model_t = module_list[-1]
 
     batch_time = AverageMeter()
+    prof = get_profiler(opt)
+    accum = GradAccumulator(optimizer, len(train_loader), opt)
     data_time = AverageMeter()
     losses = AverageMeter()
     kd_losses = AverageMeter()
     top1 = AverageMeter()
 
 
+    cache = get_teacher_cache(opt, model_t, train_loader)
+
     end = time.time()
-    for idx, data in enumerate(train_loader):
+    for idx, data in enumerate(prof.iter(train_loader)):
         if opt.distill in ['crd']:
             input, target, index, contrast_idx = data
         else:
-            input, target = data
+            input, target, *index = data
+            index = index[0] if index else None
         data_time.update(time.time() - end)
 
         input = input.float()
@@ -173,13 +196,18 @@ def train_distill(epoch, train_loader, module_list, swa_model, criterion_list, o
                 contrast_idx = contrast_idx.cuda()
                 index = index.cuda()
 
+        prof.lap('h2d')
+
         # ===================forward=====================
         #feat_s, logit_s = model_s(input, is_feat=True, preact=False)
-        logit_s = model_s(input)
-        with torch.no_grad():
-            #feat_t, logit_t = model_t(input, is_feat=True, preact=preact)
-            #feat_t = [f.detach() for f in feat_t]
-            logit_t = model_t(input)
+        with autocast(opt):
+            logit_s = model_s(input)
+            with torch.no_grad():
+                #feat_t, logit_t = model_t(input, is_feat=True, preact=preact)
+                #feat_t = [f.detach() for f in feat_t]
+                logit_t, = teacher_outputs(cache, lambda x: (model_t(x),), input, index)
+        logit_s, logit_t = logit_s.float(), logit_t.float()
+        prof.lap('forward')
 
 
         # cls + kl div
@@ -245,6 +273,8 @@ def train_distill(epoch, train_loader, module_list, swa_model, criterion_list, o
 
         loss = loss + param_dist(model_s, swa_model, opt.smoothing)
 
+        prof.lap('loss')
+
         if split == "minimize" and not quiet:
             acc1, _ = accuracy(logit_s, target, topk=(1,1))
             losses.update(loss.item(), input.size(0))
@@ -258,11 +288,15 @@ def train_distill(epoch, train_loader, module_list, swa_model, criterion_list, o
             kd_losses.update(loss.item(), input.size(0))
 
 
+        prof.lap('metrics')
+
         # ===================backward=====================
-        optimizer.zero_grad()
-        loss.backward()
+        accum.zero_grad()
+        accum.backward(loss)
+        prof.lap('backward')
         #nn.utils.clip_grad_value_(model_s.parameters(), clip)
-        optimizer.step()
+        accum.step()
+        prof.lap('step')
 
         # ===================meters=====================
         batch_time.update(time.time() - end)
@@ -307,6 +341,7 @@ def train_distill_hide(epoch, train_dataset, test_dataset, module_list, swa_mode
     model_t = module_list[-1]
 
     batch_time = AverageMeter()
+    prof = get_profiler(opt)
     data_time = AverageMeter()
     losses = AverageMeter()
     kd_losses = AverageMeter()
@@ -317,7 +352,8 @@ def train_distill_hide(epoch, train_dataset, test_dataset, module_list, swa_mode
     idx = -1
     train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=16,num_workers=0,pin_memory=True,shuffle=True)
     test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=16,num_workers=0,pin_memory=True,shuffle=True)
-    for data, data_t in zip(train_loader,cycle(test_loader)):
+    accum = GradAccumulator(optimizer, len(train_loader), opt)
+    for data, data_t in prof.iter(zip(train_loader,cycle(test_loader))):
         idx += 1
         if opt.distill in ['crd']:
             input, target, index, contrast_idx = data
@@ -346,15 +382,20 @@ def train_distill_hide(epoch, train_dataset, test_dataset, module_list, swa_mode
                 contrast_idx = contrast_idx.cuda()
                 index = index.cuda()
 
+        prof.lap('h2d')
+
         # ===================forward=====================
         #feat_s, logit_s = model_s(input, is_feat=True, preact=False)
-        logit_s = model_s(input)
-        logit_s_t = model_s(input_t)
-        with torch.no_grad():
-            #feat_t, logit_t = model_t(input, is_feat=True, preact=preact)
-            #feat_t = [f.detach() for f in feat_t]
-            logit_t = model_t(input)
-            logit_t_t = model_t(input_t)
+        with autocast(opt):
+            logit_s = model_s(input)
+            logit_s_t = model_s(input_t)
+            with torch.no_grad():
+                #feat_t, logit_t = model_t(input, is_feat=True, preact=preact)
+                #feat_t = [f.detach() for f in feat_t]
+                logit_t = model_t(input)
+                logit_t_t = model_t(input_t)
+        logit_s, logit_t_t = logit_s.float(), logit_t_t.float()
+        prof.lap('forward')
 
 
         loss_div = criterion_div(logit_s, logit_t_t)
@@ -416,15 +457,21 @@ def train_distill_hide(epoch, train_dataset, test_dataset, module_list, swa_mode
         loss = loss_div#+ param_dist(model_s, swa_model, opt.smoothing)
 
 
+        prof.lap('loss')
+
         kd_losses.update(loss.item(), input.size(0))
 
 
 
+        prof.lap('metrics')
+
         # ===================backward=====================
-        optimizer.zero_grad()
-        loss.backward()
+        accum.zero_grad()
+        accum.backward(loss)
+        prof.lap('backward')
         #nn.utils.clip_grad_value_(model_s.parameters(), clip)
-        optimizer.step()
+        accum.step()
+        prof.lap('step')
 
         # ===================meters=====================
         batch_time.update(time.time() - end)
@@ -455,19 +502,26 @@ def train_distill_linear(epoch, train_loader, delete_loader, module_list, swa_mo
     model_t = module_list[-1]
 
     batch_time = AverageMeter()
+    prof = get_profiler(opt)
+    accum = GradAccumulator(optimizer, len(train_loader), opt)
     data_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
     top5 = AverageMeter()
 
+    # only the teacher logits are cached, so only for 'kd' where its features are unused
+    cache = get_teacher_cache(opt, model_t, train_loader) if opt.distill == 'kd' else None
+    cache_del = get_teacher_cache(opt, model_t, delete_loader) if opt.distill == 'kd' else None
+
     end = time.time()
-    for idx, (data, data_del) in enumerate(zip(train_loader, cycle(delete_loader))):
+    for idx, (data, data_del) in enumerate(prof.iter(zip(train_loader, cycle(delete_loader)))):
         if opt.distill in ['crd']:
             input, target, index, contrast_idx = data
             input_del, target_del, index_del, contrast_idx_del = data_del
         else:
-            input, target = data
-            input_del, target_del = data_del
+            input, target, *index = data
+            input_del, target_del, *index_del = data_del
+            index, index_del = index[0] if index else None, index_del[0] if index_del else None
 
         data_time.update(time.time() - end)
 
@@ -485,17 +539,28 @@ def train_distill_linear(epoch, train_loader, delete_loader, module_list, swa_mo
                 contrast_idx_del = contrast_idx_del.cuda()
                 index_del = index_del.cuda()
 
+        prof.lap('h2d')
+
         # ===================forward=====================
         preact = False
         if opt.distill in ['abound']:
             preact = True
-        feat_s, logit_s = model_s(input, is_feat=True, preact=preact)
-        feat_s_del, logit_s_del = model_s(input_del, is_feat=True, preact=preact)
-        with torch.no_grad():
-            feat_t, logit_t = model_t(input, is_feat=True, preact=preact)
-            feat_t = [f.detach() for f in feat_t]
-            feat_t_del, logit_t_del = model_t(input_del, is_feat=True, preact=preact)
-            feat_t_del = [f.detach() for f in feat_t_del]
+        with autocast(opt):
+            feat_s, logit_s = model_s(input, is_feat=True, preact=preact)
+            feat_s_del, logit_s_del = model_s(input_del, is_feat=True, preact=preact)
+            if cache is not None and index is not None and index_del is not None:
+                logit_t, = teacher_outputs(cache, lambda x: (model_t(x, is_feat=True, preact=preact)[1],), input, index)
+                logit_t_del, = teacher_outputs(cache_del, lambda x: (model_t(x, is_feat=True, preact=preact)[1],),
+                                               input_del, index_del)
+            else:
+                with torch.no_grad():
+                    feat_t, logit_t = model_t(input, is_feat=True, preact=preact)
+                    feat_t = [f.detach() for f in feat_t]
+                    feat_t_del, logit_t_del = model_t(input_del, is_feat=True, preact=preact)
+                    feat_t_del = [f.detach() for f in feat_t_del]
+        logit_s, logit_s_del = logit_s.float(), logit_s_del.float()
+        logit_t, logit_t_del = logit_t.float(), logit_t_del.float()
+        prof.lap('forward')
 
         # cls + kl div
         loss_cls = criterion_cls(logit_s, target)
@@ -569,16 +634,22 @@ def train_distill_linear(epoch, train_loader, delete_loader, module_list, swa_mo
 
 
 
+        prof.lap('loss')
+
         acc1, acc5 = accuracy(logit_s, target, topk=(1, 5))
         losses.update(loss.item(), input.size(0))
         top1.update(acc1[0], input.size(0))
         top5.update(acc5[0], input.size(0))
 
 
+        prof.lap('metrics')
+
         # ===================backward=====================
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        accum.zero_grad()
+        accum.backward(loss)
+        prof.lap('backward')
+        accum.step()
+        prof.lap('step')
 
         # ===================meters=====================
         batch_time.update(time.time() - end)
@@ -623,21 +694,26 @@ def train_bad_teacher(epoch, train_loader, delete_loader, module_list, criterion
     model_s = module_list[0]
     model_gt = module_list[1]
     model_bt = module_list[2]
+    # the good teacher is only distilled on the retain batches, the bad teacher on the forget batches
+    gt_cache, bt_cache_del = get_teacher_cache(opt, model_gt, train_loader), get_teacher_cache(opt, model_bt, delete_loader)
 
     batch_time = AverageMeter()
+    prof = get_profiler(opt)
+    accum = GradAccumulator(optimizer, len(train_loader), opt)
     data_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
     top5 = AverageMeter()
 
     end = time.time()
-    for idx, (data, data_del) in enumerate(zip(train_loader, cycle(delete_loader))):
+    for idx, (data, data_del) in enumerate(prof.iter(zip(train_loader, cycle(delete_loader)))):
         if opt.distill in ['crd']:
             input, target, index, contrast_idx = data
             input_del, target_del, index_del, contrast_idx_del = data_del
         else:
-            input, target = data
-            input_del, target_del = data_del
+            input, target, *index = data
+            input_del, target_del, *index_del = data_del
+            index, index_del = index[0] if index else None, index_del[0] if index_del else None
 
         data_time.update(time.time() - end)
 
@@ -655,18 +731,20 @@ def train_bad_teacher(epoch, train_loader, delete_loader, module_list, criterion
                 contrast_idx_del = contrast_idx_del.cuda()
                 index_del = index_del.cuda()
 
+        prof.lap('h2d')
+
         # ===================forward=====================
         preact = False
         if opt.distill in ['abound']:
             preact = True
-        logit_s = model_s(input)
-        logit_s_del = model_s(input_del)
-        with torch.no_grad():
-            logit_gt = model_gt(input)
-            logit_gt_del = model_gt(input_del)
-
-            logit_bt = model_bt(input)
-            logit_bt_del = model_bt(input_del)
+        with autocast(opt):
+            logit_s = model_s(input)
+            logit_s_del = model_s(input_del)
+            logit_gt, = teacher_outputs(gt_cache, lambda x: (model_gt(x),), input, index)
+            logit_bt_del, = teacher_outputs(bt_cache_del, lambda x: (model_bt(x),), input_del, index_del)
+        logit_s, logit_s_del = logit_s.float(), logit_s_del.float()
+        logit_gt, logit_bt_del = logit_gt.float(), logit_bt_del.float()
+        prof.lap('forward')
 
         # cls + kl div
         loss_cls = criterion_cls(logit_s, target)
@@ -739,16 +817,22 @@ def train_bad_teacher(epoch, train_loader, delete_loader, module_list, criterion
         loss = opt.alpha*loss_div + opt.beta*loss_div_del
 
 
+        prof.lap('loss')
+
         acc1, acc5 = accuracy(logit_s, target, topk=(1, 5))
         losses.update(loss.item(), input.size(0))
         top1.update(acc1[0], input.size(0))
         top5.update(acc5[0], input.size(0))
 
 
+        prof.lap('metrics')
+
         # ===================backward=====================
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        accum.zero_grad()
+        accum.backward(loss)
+        prof.lap('backward')
+        accum.step()
+        prof.lap('step')
 
         # ===================meters=====================
         batch_time.update(time.time() - end)
@@ -787,6 +871,8 @@ def train_bcu(epoch, train_loader, delete_loader, module_list, criterion_list, o
     model_t = module_list[-1]
 
     batch_time = AverageMeter()
+    prof = get_profiler(opt)
+    accum = GradAccumulator(optimizer, len(train_loader), opt)
     data_time = AverageMeter()
     losses = AverageMeter()
     bcu_losses = AverageMeter()
@@ -794,10 +880,18 @@ def train_bcu(epoch, train_loader, delete_loader, module_list, criterion_list, o
     top5 = AverageMeter()
     bcu_accuracy = AverageMeter()
 
+    def teacher_fn(x):
+        feat, logit = model_t(x, is_feat=True)
+        return feat[-1], logit
+
+    # the BCU losses only use the last teacher feature and the logits
+    cache, cache_del = get_teacher_cache(opt, model_t, train_loader), get_teacher_cache(opt, model_t, delete_loader)
+
     end = time.time()
     idx = 0
     
-    for (input, target), (del_input, del_target) in zip(train_loader, cycle(delete_loader)):
+    for (input, target, *index), (del_input, del_target, *del_index) in prof.iter(zip(train_loader, cycle(delete_loader))):
+        index, del_index = index[0] if index else None, del_index[0] if del_index else None
         #for counter, (del_input, del_target) in enumerate(delete_loader):
             #del_input, del_target = next(cycle(delete_loader))
         data_time.update(time.time() - end)
@@ -810,17 +904,23 @@ def train_bcu(epoch, train_loader, delete_loader, module_list, criterion_list, o
             target = target.cuda()
             del_target = del_target.cuda()
 
+        prof.lap('h2d')
+
         # ===================forward=====================
-        feat_t_r, logit_t_r = model_t(input, is_feat=True)
-        feat_t_d, logit_t_d = model_t(del_input, is_feat=True)
-        feat_s_r, logit_s_r = model_s(input, is_feat=True)
-        feat_s_d, logit_s_d = model_s(del_input, is_feat=True)
+        with autocast(opt):
+            f_t_r, logit_t_r = teacher_outputs(cache, teacher_fn, input, index)
+            f_t_d, logit_t_d = teacher_outputs(cache_del, teacher_fn, del_input, del_index)
+            feat_s_r, logit_s_r = model_s(input, is_feat=True)
+            feat_s_d, logit_s_d = model_s(del_input, is_feat=True)
+        logit_t_r, logit_t_d = logit_t_r.float(), logit_t_d.float()
+        logit_s_r, logit_s_d = logit_s_r.float(), logit_s_d.float()
+        prof.lap('forward')
 
 
-        f_s_r = feat_s_r[-1]
-        f_s_d = feat_s_d[-1]
-        f_t_r = feat_t_r[-1]
-        f_t_d = feat_t_d[-1]
+        f_s_r = feat_s_r[-1].float()
+        f_s_d = feat_s_d[-1].float()
+        f_t_r = f_t_r.float()
+        f_t_d = f_t_d.float()
 
         if opt.bcu_vec == "logits":
             loss1 = criterion_list[0](logit_s_r, target)
@@ -830,6 +930,8 @@ def train_bcu(epoch, train_loader, delete_loader, module_list, criterion_list, o
             loss2, bcu_acc = criterion_list[1](f_s_r, f_s_d, f_t_r, f_t_d)
 
 
+        prof.lap('loss')
+
         bin_cls_optimizer.zero_grad()
         loss2.backward(retain_graph=True)
         bin_cls_optimizer.step()
@@ -843,10 +945,14 @@ def train_bcu(epoch, train_loader, delete_loader, module_list, criterion_list, o
         top5.update(acc5[0], input.size(0))
         bcu_accuracy.update(bcu_acc, input.size(0))
 
+        prof.lap('metrics')
+
         # ===================backward=====================
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        accum.zero_grad()
+        accum.backward(loss)
+        prof.lap('backward')
+        accum.step()
+        prof.lap('step')
 
         # ===================meters=====================
         batch_time.update(time.time() - end)
@@ -896,6 +1002,8 @@ def train_bcu_distill(epoch, train_loader, delete_loader, module_list, criterion
     criterion_bcu = criterion_list[-1]
 
     batch_time = AverageMeter()
+    prof = get_profiler(opt)
+    accum = GradAccumulator(optimizer, len(train_loader), opt)
     data_time = AverageMeter()
     losses = AverageMeter()
     bcu_losses = AverageMeter()
@@ -903,10 +1011,18 @@ def train_bcu_distill(epoch, train_loader, delete_loader, module_list, criterion
     top5 = AverageMeter()
     bcu_accuracy = AverageMeter()
 
+    def teacher_fn(x):
+        feat, logit = model_t(x, is_feat=True)
+        return feat[-1], logit
+
+    # the BCU losses only use the last teacher feature and the logits
+    cache, cache_del = get_teacher_cache(opt, model_t, train_loader), get_teacher_cache(opt, model_t, delete_loader)
+
     end = time.time()
     idx = 0
     
-    for (input, target), (del_input, del_target) in zip(train_loader, cycle(delete_loader)):
+    for (input, target, *index), (del_input, del_target, *del_index) in prof.iter(zip(train_loader, cycle(delete_loader))):
+        index, del_index = index[0] if index else None, del_index[0] if del_index else None
         #for counter, (del_input, del_target) in enumerate(delete_loader):
             #del_input, del_target = next(cycle(delete_loader))
         data_time.update(time.time() - end)
@@ -919,17 +1035,23 @@ def train_bcu_distill(epoch, train_loader, delete_loader, module_list, criterion
             target = target.cuda()
             del_target = del_target.cuda()
 
+        prof.lap('h2d')
+
         # ===================forward=====================
-        feat_t_r, logit_t_r = model_t(input, is_feat=True)
-        feat_t_d, logit_t_d = model_t(del_input, is_feat=True)
-        feat_s_r, logit_s_r = model_s(input, is_feat=True)
-        feat_s_d, logit_s_d = model_s(del_input, is_feat=True)
+        with autocast(opt):
+            f_t_r, logit_t_r = teacher_outputs(cache, teacher_fn, input, index)
+            f_t_d, logit_t_d = teacher_outputs(cache_del, teacher_fn, del_input, del_index)
+            feat_s_r, logit_s_r = model_s(input, is_feat=True)
+            feat_s_d, logit_s_d = model_s(del_input, is_feat=True)
+        logit_t_r, logit_t_d = logit_t_r.float(), logit_t_d.float()
+        logit_s_r, logit_s_d = logit_s_r.float(), logit_s_d.float()
+        prof.lap('forward')
 
 
-        f_s_r = feat_s_r[-1]
-        f_s_d = feat_s_d[-1]
-        f_t_r = feat_t_r[-1]
-        f_t_d = feat_t_d[-1]
+        f_s_r = feat_s_r[-1].float()
+        f_s_d = feat_s_d[-1].float()
+        f_t_r = f_t_r.float()
+        f_t_d = f_t_d.float()
 
         if opt.bcu_vec == "logits":
             loss_cls = criterion_cls(logit_s_r, target)
@@ -940,6 +1062,8 @@ def train_bcu_distill(epoch, train_loader, delete_loader, module_list, criterion
 
         loss_div = criterion_div(logit_s_r, logit_t_r)
 
+        prof.lap('loss')
+
         bin_cls_optimizer.zero_grad()
         loss_bc.backward(retain_graph=True)
         bin_cls_optimizer.step()
@@ -954,10 +1078,14 @@ def train_bcu_distill(epoch, train_loader, delete_loader, module_list, criterion
         top5.update(acc5[0], input.size(0))
         bcu_accuracy.update(bcu_acc, input.size(0))
 
+        prof.lap('metrics')
+
         # ===================backward=====================
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        accum.zero_grad()
+        accum.backward(loss)
+        prof.lap('backward')
+        accum.step()
+        prof.lap('step')
 
         # ===================meters=====================
         batch_time.update(time.time() - end)
@@ -991,6 +1119,7 @@ def train_bcu_distill(epoch, train_loader, delete_loader, module_list, criterion
 def validate(val_loader, model, criterion, opt, quiet=False):
     """validation"""
     batch_time = AverageMeter()
+    prof = get_profiler(opt)
     losses = AverageMeter()
     top1 = AverageMeter()
     top5 = AverageMeter()
@@ -1000,23 +1129,32 @@ def validate(val_loader, model, criterion, opt, quiet=False):
 
     with torch.no_grad():
         end = time.time()
-        for idx, (input, target) in enumerate(val_loader):
+        for idx, (input, target) in enumerate(prof.iter(val_loader)):
 
             input = input.float()
             if torch.cuda.is_available():
                 input = input.cuda()
                 target = target.cuda()
 
+            prof.lap('h2d')
+
             # compute output
-            output = model(input)
+            with autocast(opt):
+                output = model(input)
+            output = output.float()
+            prof.lap('forward')
             loss = criterion(output, target)
 
+            prof.lap('loss')
+
             # measure accuracy and record loss
             acc1, acc5 = accuracy(output, target, topk=(1, 5))
             losses.update(loss.item(), input.size(0))
             top1.update(acc1[0], input.size(0))
             top5.update(acc5[0], input.size(0))
 
+            prof.lap('metrics')
+
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
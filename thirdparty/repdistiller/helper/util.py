@@ -1,10 +1,267 @@
 from __future__ import print_function
 
+import copy
+
 import torch
 import numpy as np
 
+def autocast(opt):
+    """bf16 autocast for the forward pass when opt.amp is set, a no-op otherwise.
+    Parameters stay in fp32; losses are computed on the logits cast back to fp32."""
+    if hasattr(opt, 'device'):
+        device_type = torch.device(opt.device).type
+    else:
+        device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=getattr(opt, 'amp', False))
+
+class _NullProfiler(object):
+    """Stand-in for profiler.PhaseProfiler when profiling is off."""
+    def lap(self, name):
+        pass
+
+    def reset_clock(self):
+        pass
+
+    def iter(self, iterable, name='data'):
+        return iterable
+
+_NULL_PROFILER = _NullProfiler()
+
+def get_profiler(opt):
+    """The PhaseProfiler attached as opt.profiler, or a no-op one."""
+    profiler = getattr(opt, 'profiler', None)
+    return profiler if profiler is not None else _NULL_PROFILER
+
+class GradAccumulator(object):
+    """Drop-in for the optimizer's zero_grad/backward/step in a training loop with
+    gradient accumulation and warm-up.
+
+    The optimizer steps once every opt.accum_steps loader batches (micro-batches) on the mean
+    of their gradients; a shorter last group is averaged over its own size. For the first
+    opt.warmup_epochs epochs of optimizer steps the learning rate ramps linearly up to the
+    value the schedule set at the start of the epoch. opt.optimizer_steps counts the steps
+    taken so far, across epochs. With the defaults (1 and 0) it is a plain optimizer step.
+    """
+    def __init__(self, optimizer, num_batches, opt):
+        self.optimizer = optimizer
+        self.num_batches = num_batches
+        self.opt = opt
+        self.accum_steps = max(1, getattr(opt, 'accum_steps', 1))
+        self.warmup_steps = getattr(opt, 'warmup_epochs', 0) * -(-num_batches // self.accum_steps)
+        self.scheduled_lr = [g['lr'] for g in optimizer.param_groups]
+        self.idx = 0
+
+    def _group(self):
+        start = self.idx - self.idx % self.accum_steps
+        return start, min(self.accum_steps, self.num_batches - start)
+
+    def zero_grad(self):
+        if self.idx % self.accum_steps == 0:
+            self.optimizer.zero_grad()
+
+    def backward(self, loss, **kwargs):
+        (loss / self._group()[1]).backward(**kwargs)
+
+    def step(self):
+        """Steps the optimizer if this micro-batch completes a group; returns whether it did."""
+        start, group_size = self._group()
+        self.idx += 1
+        if self.idx != start + group_size:
+            return False
+        steps = getattr(self.opt, 'optimizer_steps', 0)
+        if steps < self.warmup_steps:
+            for g, lr in zip(self.optimizer.param_groups, self.scheduled_lr):
+                g['lr'] = lr * (steps + 1) / self.warmup_steps
+        elif self.warmup_steps > 0:
+            for g, lr in zip(self.optimizer.param_groups, self.scheduled_lr):
+                g['lr'] = lr
+        self.optimizer.step()
+        self.opt.optimizer_steps = steps + 1
+        return True
+
+def scale_learning_rate(lr, batch_size, base_batch_size, rule):
+    """Learning rate for batch_size given one tuned at base_batch_size: 'linear'
+    (Goyal et al., 2017), 'sqrt' (Krizhevsky, 2014) or 'none'."""
+    if rule == 'linear':
+        return lr * batch_size / base_batch_size
+    if rule == 'sqrt':
+        return lr * (batch_size / base_batch_size) ** 0.5
+    return lr
+
+def batch_statistics(model):
+    """Whether a forward of `model` depends on the whole batch: some BatchNorm normalizes with batch
+    statistics (training mode, or no running statistics)."""
+    return any(isinstance(m, torch.nn.modules.batchnorm._BatchNorm) and (m.training or not m.track_running_stats)
+               for m in model.modules())
+
+def neggrad_loss(model, criterion, input_r, target_r, input_f, target_f, alpha, opt=None):
+    """NegGrad loss alpha * criterion(retain) - (1 - alpha) * criterion(forget), and the retain outputs.
+    Unless the model uses batch statistics, both batches go through a single forward (and so a
+    single backward); with BatchNorm in training mode each batch keeps its own forward and statistics."""
+    if batch_statistics(model):
+        with autocast(opt):
+            output_r, output_f = model(input_r), model(input_f)
+        output_r, output_f = output_r.float(), output_f.float()
+    else:
+        with autocast(opt):
+            output = model(torch.cat([input_r, input_f]))
+        output_r, output_f = output.float().split([input_r.size(0), input_f.size(0)])
+    return alpha * criterion(output_r, target_r) - (1 - alpha) * criterion(output_f, target_f), output_r
+
+class TeacherCache(object):
+    """Outputs of a frozen teacher on one dataset, keyed by dataset index.
+
+    `cache(fn, input, index)` returns fn(input), a tuple of tensors, and stores it the first time
+    every sample of the batch is seen; later batches are served from the cache. Outputs are kept
+    in `dtype` (fp16 by default), in memory up to `max_memory` bytes and in a memory-mapped
+    temporary file beyond that. Only valid while the teacher's weights and the inputs of every
+    index stay fixed (eval mode, no augmentation).
+    """
+    def __init__(self, dataset, dtype=torch.float16, max_memory=2 ** 30, cache_dir=None):
+        self.dataset = dataset
+        self.num_samples = len(dataset)
+        self.dtype = dtype
+        self.max_memory = max_memory
+        self.cache_dir = cache_dir
+        self.arrays = None
+        self.filled = torch.zeros(self.num_samples, dtype=torch.bool)
+
+    def _allocate(self, outputs):
+        shapes = [(self.num_samples,) + tuple(o.shape[1:]) for o in outputs]
+        itemsize = torch.tensor([], dtype=self.dtype).element_size()
+        if sum(int(np.prod(s)) for s in shapes) * itemsize <= self.max_memory:
+            return [torch.empty(s, dtype=self.dtype) for s in shapes]
+        import tempfile
+        np_dtype = torch.empty(0, dtype=self.dtype).numpy().dtype
+        arrays = []
+        for s in shapes:
+            f = tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.teacher')
+            arrays.append(torch.from_numpy(np.memmap(f, dtype=np_dtype, mode='w+', shape=s)))
+            arrays[-1]._tmpfile = f
+        return arrays
+
+    def __call__(self, fn, input, index):
+        index = index.cpu()
+        if self.arrays is not None and bool(self.filled[index].all()):
+            return tuple(a[index].to(input.device, non_blocking=True).float() for a in self.arrays)
+        with torch.no_grad():
+            outputs = fn(input)
+        if self.arrays is None:
+            self.arrays = self._allocate(outputs)
+        for a, o in zip(self.arrays, outputs):
+            a[index] = o.detach().to('cpu', self.dtype)
+        self.filled[index] = True
+        # the stored (rounded) values, so that every epoch distills towards the same teacher outputs
+        return tuple(a[index].to(input.device, non_blocking=True).float() for a in self.arrays)
+
+class TeacherCaches(object):
+    """The TeacherCaches of one distillation run, by (teacher, dataset). The caller creates one per
+    run and passes it to the loops as opt.teacher_caches; the caches go away with it. Teachers and
+    datasets are held (and compared) by reference, so a later model can never get their entries."""
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.entries = []
+
+    def get(self, model, dataset):
+        for m, d, cache in self.entries:
+            if m is model and d is dataset:
+                return cache
+        self.entries.append((model, dataset, TeacherCache(dataset, cache_dir=self.cache_dir)))
+        return self.entries[-1][2]
+
+def get_teacher_cache(opt, model, data_loader):
+    """The TeacherCache of `model` on the dataset of `data_loader` in opt.teacher_caches when
+    opt.teacher_cache is set and the inputs are deterministic (no opt.augment), else None. The loader
+    must yield the sample indices (datasets_multiclass.IndexedDataset) for the cache to be used."""
+    caches = getattr(opt, 'teacher_caches', None)
+    if not getattr(opt, 'teacher_cache', False) or getattr(opt, 'augment', False) or caches is None:
+        return None
+    return caches.get(model, data_loader.dataset)
+
+def teacher_outputs(cache, fn, input, index):
+    """fn(input), a tuple of teacher outputs computed without gradients, served from `cache` when
+    there is one and the batch carries sample indices."""
+    if cache is None or index is None:
+        with torch.no_grad():
+            return fn(input)
+    return cache(fn, input, index)
+
+class FlatParams(object):
+    """Makes the parameters of `model` views of one contiguous buffer, `flat`, so that whole-model
+    vector operations are single kernels. The Parameter objects are kept (optimizers built before or
+    after still work); the model must not be moved to another device or dtype afterwards."""
+    def __init__(self, model):
+        self.params = list(model.parameters())
+        self.numels = [p.numel() for p in self.params]
+        self.flat = torch.cat([p.detach().reshape(-1) for p in self.params])
+        offset = 0
+        for p, n in zip(self.params, self.numels):
+            p.data = self.flat[offset:offset + n].view_as(p)
+            offset += n
+        self.segments = torch.repeat_interleave(torch.arange(len(self.params), device=self.flat.device),
+                                                torch.tensor(self.numels, device=self.flat.device))
+        model._flat_params = self
+
+    def split(self, vector):
+        """`vector` (same layout as `flat`) as a tuple of views shaped like the parameters."""
+        return tuple(v.view_as(p) for v, p in zip(vector.split(self.numels), self.params))
+
+def flatten_parameters(model):
+    """The FlatParams of `model`, flattening its parameters the first time."""
+    flat_params = getattr(model, '_flat_params', None)
+    if flat_params is None or flat_params.params[0] is not next(model.parameters()) \
+            or flat_params.params[0].data_ptr() != flat_params.flat.data_ptr():
+        flat_params = FlatParams(model)
+    return flat_params
+
+class FlatAveragedModel(torch.nn.Module):
+    """Exponential moving average of `model` (torch.optim.swa_utils.AveragedModel with avg_fn
+    (1 - beta) * averaged + beta * current) kept on flat buffers: an update is one lerp_."""
+    def __init__(self, model, beta):
+        super(FlatAveragedModel, self).__init__()
+        self.source = flatten_parameters(model)
+        self.module = copy.deepcopy(model)
+        self.averaged = FlatParams(self.module)
+        for p in self.module.parameters():
+            p.requires_grad_(False)
+        self.beta = beta
+        self.register_buffer('n_averaged', torch.tensor(0, dtype=torch.long))
+
+    def forward(self, *args, **kwargs):
+        return self.module(*args, **kwargs)
+
+    def update_parameters(self, model):
+        source = flatten_parameters(model)
+        with torch.no_grad():
+            if self.n_averaged == 0:
+                self.averaged.flat.copy_(source.flat)
+            else:
+                self.averaged.flat.lerp_(source.flat, self.beta)
+        self.n_averaged += 1
+
+class _FlatParamDist(torch.autograd.Function):
+    """sum_i ||p_i - q_i||_F over the parameter tensors of two flat models, with the gradient
+    (p_i - q_i) / ||p_i - q_i||_F w.r.t. the p_i computed on the flat buffer."""
+    @staticmethod
+    def forward(ctx, source, target, *params):
+        diff = source.flat - target.flat
+        norms = torch.zeros(len(source.numels), dtype=diff.dtype, device=diff.device)
+        norms.index_add_(0, source.segments, diff * diff).sqrt_()
+        ctx.source = source
+        ctx.save_for_backward(diff, norms)
+        return norms.sum()
+
+    @staticmethod
+    def backward(ctx, grad):
+        diff, norms = ctx.saved_tensors
+        # a zero norm has a zero difference: clamping gives torch.norm's zero subgradient
+        grad_flat = diff * (grad / norms.clamp_min(torch.finfo(norms.dtype).tiny))[ctx.source.segments]
+        return (None, None) + ctx.source.split(grad_flat)
+
 def param_dist(model, swa_model, p):
     #This is from https://github.com/ojus1/SmoothedGradientDescentAscent/blob/main/SGDA.py
+    if isinstance(swa_model, FlatAveragedModel) and getattr(model, '_flat_params', None) is swa_model.source:
+        return p * _FlatParamDist.apply(swa_model.source, swa_model.averaged, *swa_model.source.params)
     dist = 0.
     for p1, p2 in zip(model.parameters(), swa_model.parameters()):
         dist += torch.norm(p1 - p2, p='fro')
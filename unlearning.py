@@ -0,0 +1,601 @@
+"""Unlearning methods and readouts of the notebooks, as functions of (model, loaders, args).
+
+The split of the training set into retain and forget samples is described by a manifest
+(`make_split_manifest`), a small JSON-serializable dict that `split_datasets` turns back into
+datasets, so that every stage of `pipeline.py` works on exactly the same split.
+"""
+import copy
+import os
+import tempfile
+from itertools import count, cycle
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.func import functional_call, grad, jacrev, jvp, vmap
+
+import datasets_multiclass as datasets
+from models import StagedModel, get_stages
+from utils import AverageMeter, get_error, log_metrics
+from privacy import per_sample_grads
+from ledger import rollback
+from certified import CertifiedRemoval
+from thirdparty.repdistiller.distiller_zoo import DistillKL
+from thirdparty.repdistiller.helper.loops import train_distill
+from thirdparty.repdistiller.helper.util import adjust_learning_rate as sgda_adjust_learning_rate, TeacherCaches, \
+    FlatAveragedModel, autocast, neggrad_loss
+
+# Hyper-parameters of the methods, as set in the notebooks.
+DEFAULTS = dict(
+    retain_bs=32, forget_bs=64,
+    ft_lr=0.01, ft_epochs=10,
+    ng_alpha=0.95, ng_lr=0.01, ng_epochs=10,
+    amnesiac_lr=0.01, amnesiac_epochs=1,
+    cfk_lr=0.01, cfk_epochs=10, euk_lr=0.01, euk_epochs=30, fk_lr_decay_epochs=[10, 15, 20],
+    feature_cache=True, feature_boundary=None,
+    fisher_alpha=1e-6,
+    newton_solver='cg', newton_iters=50, newton_tol=1e-3, newton_hessian_samples=5000, newton_lissa_depth=1000,
+    newton_lissa_scale=25.,
+    certified_eps=1., certified_delta=1e-5,
+    kfac_samples=None,
+    optim='adam', gamma=1, alpha=0.5, beta=0, smoothing=0.5, msteps=3, clip=0.2, sstart=10, kd_T=2,
+    distill='kd', sgda_epochs=10, sgda_learning_rate=0.0005, sgda_lr_decay_epochs=[5, 8, 9], lr_decay_rate=0.1,
+    sgda_weight_decay=0.1, sgda_momentum=0.9, swa_beta=0.1, teacher_cache=True,
+    readout_epochs=100, readout_lr=0.1,
+)
+
+
+def method_args(args, **overrides):
+    """A copy of the training `args` with the method hyper-parameters (DEFAULTS, then `overrides`) set."""
+    opt = copy.copy(args)
+    for k, v in dict(DEFAULTS, **overrides).items():
+        setattr(opt, k, v)
+    return opt
+
+
+def make_split_manifest(args):
+    """The forget set of the run described by `args`, as positions in the training split."""
+    marked_loader, _, _ = datasets.get_loaders(args.dataset, class_to_replace=args.forget_class,
+                                               num_indexes_to_replace=args.num_to_forget, confuse_mode=args.confuse_mode,
+                                               split='forget', only_mark=True, batch_size=1, seed=args.seed,
+                                               root=args.dataroot, augment=False, shuffle=False)
+    targets = np.asarray(marked_loader.dataset.targets)
+    num_classes = int(np.where(targets < 0, -targets - 1, targets).max()) + 1
+    manifest = dict(dataset=args.dataset, dataroot=args.dataroot, seed=args.seed, forget_class=args.forget_class,
+                    num_to_forget=args.num_to_forget, confuse_mode=args.confuse_mode, num_classes=num_classes,
+                    num_train=len(targets), forget_indexes=np.flatnonzero(targets < 0).tolist())
+    if getattr(args, 'num_shards', None) is not None:
+        manifest = shard_manifest(manifest, args.num_shards, args.num_slices)
+    return manifest
+
+
+def shard_manifest(manifest, num_shards, num_slices=1):
+    """`manifest` with the training split partitioned at random into `num_shards` disjoint shards, each cut
+    into `num_slices` slices (`shards[k][s]` is a list of positions), for SISA training (sisa.py).
+    `removed` lists the positions unlearned since."""
+    order = np.random.RandomState(manifest['seed']).permutation(manifest['num_train'])
+    shards = [[slice_.tolist() for slice_ in np.array_split(shard, num_slices)] for shard in np.array_split(order, num_shards)]
+    return dict(manifest, shards=shards, removed=[])
+
+
+def remove_from_shards(manifest, indexes):
+    """(manifest without `indexes` in its shards, {shard: first slice that changed})."""
+    indexes = set(indexes)
+    shards, affected = [], {}
+    for k, slices in enumerate(manifest['shards']):
+        for s, slice_ in enumerate(slices):
+            if k not in affected and indexes.intersection(slice_):
+                affected[k] = s
+        shards.append([[i for i in slice_ if i not in indexes] for slice_ in slices])
+    removed = sorted(set(manifest['removed']) | indexes)
+    return dict(manifest, shards=shards, removed=removed), affected
+
+
+def split_datasets(manifest, augment=False):
+    """(train, retain, forget, test) datasets of a split manifest. Forget targets are the labels the
+    samples were trained with (after confusion, if any)."""
+    marked_loader, _, test_loader = datasets.get_loaders(manifest['dataset'], class_to_replace=manifest['forget_class'],
+                                                         num_indexes_to_replace=manifest['num_to_forget'],
+                                                         confuse_mode=manifest['confuse_mode'], split='forget',
+                                                         only_mark=True, batch_size=1, seed=manifest['seed'],
+                                                         root=manifest['dataroot'], augment=augment, shuffle=False)
+    marked = marked_loader.dataset
+    forget_mask = np.zeros(len(marked.targets), dtype=bool)
+    forget_mask[manifest['forget_indexes']] = True
+    if len(marked.targets) != manifest['num_train'] or not np.array_equal(forget_mask, marked.targets < 0):
+        raise ValueError('The dataset does not reproduce the split manifest')
+
+    train_set, retain_set, forget_set = copy.copy(marked), copy.copy(marked), copy.copy(marked)
+    train_set.targets = np.where(forget_mask, -marked.targets - 1, marked.targets)
+    retain_set.data, retain_set.targets = marked.data[~forget_mask], marked.targets[~forget_mask]
+    forget_set.data, forget_set.targets = marked.data[forget_mask], -marked.targets[forget_mask] - 1
+    return train_set, retain_set, forget_set, test_loader.dataset
+
+
+def make_loader(dataset, batch_size, seed=1, shuffle=True):
+    # its own generator: building a loader must not reset the global RNG in the middle of a method
+    generator = torch.Generator().manual_seed(seed)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=0, pin_memory=True, shuffle=shuffle,
+                                       generator=generator)
+
+
+def l2_penalty(model, model_init, weight_decay):
+    l2_loss = 0
+    for (k, p), (k_init, p_init) in zip(model.named_parameters(), model_init.named_parameters()):
+        if p.requires_grad:
+            l2_loss += (p - p_init).pow(2).sum()
+    l2_loss *= (weight_decay / 2.)
+    return l2_loss
+
+
+def run_train_epoch(model, model_init, data_loader, loss_fn, optimizer, split, epoch, weight_decay, quiet=False, opt=None):
+    """One epoch in eval mode; forward passes run under bf16 autocast if opt.amp, losses on fp32 logits."""
+    model.eval()
+    metrics = AverageMeter()
+    device = next(model.parameters()).device
+    with torch.set_grad_enabled(split != 'test'):
+        for input, target in data_loader:
+            input, target = input.to(device), target.to(device)
+            with autocast(opt):
+                output = model(input)
+            output = output.float()
+            loss = loss_fn(output, target) + l2_penalty(model, model_init, weight_decay)
+            metrics.update(n=input.size(0), loss=loss_fn(output, target).item(), error=get_error(output, target))
+            if split != 'test':
+                model.zero_grad()
+                loss.backward()
+                optimizer.step()
+    if not quiet:
+        log_metrics(split, metrics, epoch)
+    return metrics.avg
+
+
+def run_neggrad_epoch(model, model_init, data_loader, forget_loader, alpha, loss_fn, optimizer, epoch, weight_decay,
+                      quiet=False, opt=None):
+    model.eval()
+    metrics = AverageMeter()
+    device = next(model.parameters()).device
+    for (input_r, target_r), (input_f, target_f) in zip(data_loader, cycle(forget_loader)):
+        input_r, target_r, input_f, target_f = input_r.to(device), target_r.to(device), input_f.to(device), target_f.to(device)
+        # eval mode: the retain and forget batches share one forward
+        loss, output_r = neggrad_loss(model, loss_fn, input_r, target_r, input_f, target_f, alpha, opt=opt)
+        loss = loss + alpha * l2_penalty(model, model_init, weight_decay)
+        metrics.update(n=input_r.size(0), loss=loss_fn(output_r, target_r).item(), error=get_error(output_r, target_r))
+        model.zero_grad()
+        loss.backward()
+        optimizer.step()
+    if not quiet:
+        log_metrics('train', metrics, epoch)
+    return metrics.avg
+
+
+def finetune(model, data_loader, args, lr=0.01, epochs=10, lr_schedule=False, quiet=True):
+    """Fine-tunes the trainable parameters of `model` on `data_loader`, with the L2 penalty towards the
+    starting point. With `lr_schedule`, the lr decays at args.fk_lr_decay_epochs (CF-k / EU-k)."""
+    loss_fn = nn.CrossEntropyLoss()
+    optimizer = optim.SGD([p for p in model.parameters() if p.requires_grad], lr=lr, weight_decay=0.0)
+    model_init = copy.deepcopy(model)
+    opt = copy.copy(args)
+    opt.sgda_learning_rate, opt.lr_decay_epochs = lr, args.fk_lr_decay_epochs
+    for epoch in range(epochs):
+        if lr_schedule:
+            sgda_adjust_learning_rate(epoch, opt, optimizer)
+        run_train_epoch(model, model_init, data_loader, loss_fn, optimizer, 'train', epoch, args.weight_decay, quiet=quiet,
+                        opt=args)
+    return model
+
+
+def negative_grad(model, retain_loader, forget_loader, args, quiet=True):
+    loss_fn = nn.CrossEntropyLoss()
+    optimizer = optim.SGD(model.parameters(), lr=args.ng_lr, weight_decay=0.0)
+    model_init = copy.deepcopy(model)
+    for epoch in range(args.ng_epochs):
+        run_neggrad_epoch(model, model_init, retain_loader, forget_loader, args.ng_alpha, loss_fn, optimizer, epoch,
+                          args.weight_decay, quiet=quiet, opt=args)
+    return model
+
+
+def amnesiac(model, ledger_path, forget_indexes, retain_loader, args, quiet=True):
+    """Amnesiac unlearning (Graves et al., 2021): subtract the updates of the training steps whose batch held
+    a forget sample, as recorded by main.py --ledger, then fine-tune for args.amnesiac_epochs on the retain set."""
+    steps = rollback(dict(model.named_parameters()), ledger_path, forget_indexes)
+    if not quiet:
+        print(f'Undid {steps} steps')
+    if args.amnesiac_epochs > 0:
+        finetune(model, retain_loader, args, lr=args.amnesiac_lr, epochs=args.amnesiac_epochs, quiet=quiet)
+    return model
+
+
+def final_block(model, arch):
+    """Module names (prefixes) of the last block, which CF-k fine-tunes and EU-k retrains from scratch."""
+    if arch == 'allcnn':
+        return ['features.9']
+    if arch.startswith('resnet'):
+        return ['layer4' if hasattr(model, 'layer4') else 'layer3']
+    if arch == 'mlp':
+        return [f'layers.{len(model.layers) - 1}']
+    raise NotImplementedError(f'CF-k/EU-k are not defined for {arch}')
+
+
+def _in_block(name, block):
+    return any(name == b or name.startswith(b + '.') for b in block)
+
+
+def feature_boundary(model, args):
+    """Name of the first stage (models.get_stages) that CF-k/EU-k train: args.feature_boundary, or the
+    stage of the final block."""
+    if getattr(args, 'feature_boundary', None) is not None:
+        return args.feature_boundary
+    block = final_block(model, args.model)
+    return next(stage.name for stage in get_stages(model) if any(_in_block(m, block) for m in stage.modules))
+
+
+def cache_features(fn, data_loader, device, max_memory=2 ** 30):
+    """(fn(input), target) for the whole of `data_loader`, computed once without gradients and kept on
+    CPU, in a memory-mapped temporary file beyond `max_memory` bytes."""
+    features, targets, offset = None, [], 0
+    num_samples = len(data_loader.dataset)
+    with torch.no_grad():
+        for input, target in data_loader:
+            output = fn(input.to(device)).float().cpu()
+            if features is None:
+                shape = (num_samples,) + tuple(output.shape[1:])
+                if int(np.prod(shape)) * 4 <= max_memory:
+                    features = torch.empty(shape)
+                else:
+                    features = torch.from_numpy(np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode='w+', shape=shape))
+            features[offset:offset + len(output)] = output
+            targets.append(target)
+            offset += len(output)
+    return features, torch.cat(targets)
+
+
+def finetune_cached(model, retain_loader, args, lr, epochs):
+    """`finetune` of the stages of `model` from the feature boundary on, on activations of the frozen stages
+    before it computed once over the retain set. run_train_epoch runs the model in eval mode, so this
+    matches `finetune` on the whole model up to the order of the batches."""
+    staged = StagedModel(model, feature_boundary(model, args))
+    frozen = [m for stage in staged.stages[:staged.start] for m in stage.modules]
+    if any(p.requires_grad and _in_block(k, frozen) for k, p in model.named_parameters()):
+        raise ValueError(f'Stages before {staged.stages[staged.start].name} have trainable parameters')
+    model.eval()
+    device = next(model.parameters()).device
+    loader = make_loader(retain_loader.dataset, retain_loader.batch_size, shuffle=False)
+    features, targets = cache_features(staged.prefix, loader, device)
+    dataset = torch.utils.data.TensorDataset(features, targets)
+    # whole batches are sliced from the cached tensors instead of collated sample by sample
+    generator = torch.Generator().manual_seed(args.seed)
+    sampler = torch.utils.data.BatchSampler(torch.utils.data.RandomSampler(dataset, generator=generator),
+                                            retain_loader.batch_size, drop_last=False)
+    finetune(staged, torch.utils.data.DataLoader(dataset, sampler=sampler, batch_size=None), args, lr=lr, epochs=epochs,
+             lr_schedule=True)
+    return model
+
+
+def _finetune_block(model, retain_loader, args, lr, epochs):
+    if getattr(args, 'feature_cache', False) and not getattr(args, 'augment', False):
+        return finetune_cached(model, retain_loader, args, lr, epochs)
+    return finetune(model, retain_loader, args, lr=lr, epochs=epochs, lr_schedule=True)
+
+
+def cf_k(model, retain_loader, args):
+    """Catastrophic forgetting-k: fine-tune only the last block on the retain set."""
+    block = final_block(model, args.model)
+    for k, p in model.named_parameters():
+        p.requires_grad_(_in_block(k, block))
+    return _finetune_block(model, retain_loader, args, args.cfk_lr, args.cfk_epochs)
+
+
+def eu_k(model, model_initial, retain_loader, args):
+    """Exact unlearning-k: reset the last block (and the classifier of allcnn) to its initialization,
+    then retrain the last block on the retain set."""
+    block = final_block(model, args.model)
+    reset = block + (['classifier.0'] if args.model == 'allcnn' else [])
+    initial = model_initial.state_dict()
+    with torch.no_grad():
+        for k, p in model.named_parameters():
+            if _in_block(k, reset):
+                p.copy_(initial[k])
+            p.requires_grad_(_in_block(k, block))
+    return _finetune_block(model, retain_loader, args, args.euk_lr, args.euk_epochs)
+
+
+def fisher_diagonal(model, dataset, args, batch_size=128):
+    """Diagonal of the Fisher information on `dataset`: the expectation over samples, and over labels
+    drawn from the model's predictive distribution, of the squared loss gradient."""
+    model.eval()
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    loss_fn = nn.CrossEntropyLoss()
+    fisher = {k: torch.zeros_like(p) for k, p in model.named_parameters()}
+    for data, _ in loader:
+        data = data.to(args.device)
+        with torch.no_grad():
+            prob = F.softmax(model(data), dim=-1)
+        for y in range(prob.shape[1]):
+            target = torch.full((data.shape[0],), y, dtype=torch.long, device=data.device)
+            grads, _, _ = per_sample_grads(model, loss_fn, data, target)
+            for k, g in grads.items():
+                fisher[k] += torch.einsum('b,b...->...', prob[:, y], g.pow(2))
+    return {k: f / len(dataset) for k, f in fisher.items()}
+
+
+def get_mean_var(p, fisher, args, is_base_dist=False, alpha=3e-6):
+    """Mean and variance of the Fisher forgetting noise of parameter `p` (which holds the trained weights)."""
+    var = 1. / (fisher + 1e-8)
+    var = var.clamp(max=1e3)
+    if p.size(0) == args.num_classes:
+        var = var.clamp(max=1e2)
+    var = alpha * var
+    if p.ndim > 1:
+        var = var.mean(dim=1, keepdim=True).expand_as(p).clone()
+    mu = p.data.clone()
+    if p.size(0) == args.num_classes and args.num_to_forget is None:
+        mu[args.forget_class] = 0
+        var[args.forget_class] = 0.0001
+    if p.size(0) == args.num_classes or p.ndim == 1:
+        # last layer and BatchNorm
+        var *= 10
+    return mu, var
+
+
+def kl_divergence_fisher(mu0, var0, mu1, var1):
+    return ((mu1 - mu0).pow(2) / var0 + var1 / var0 - torch.log(var1 / var0) - 1).sum()
+
+
+def fisher_kl(fisher, fisher0, args, alpha=1e-7):
+    """{parameter: KL} between the Fisher noise distributions of two models, from their Fisher artifacts
+    (fisher_store.FisherArtifact): the information the forgetting noise leaves about the forget set."""
+    kl = {}
+    for k in fisher.keys():
+        mu0, var0 = get_mean_var(fisher.param(k), fisher[k], args, alpha=alpha)
+        mu1, var1 = get_mean_var(fisher0.param(k), fisher0[k], args, is_base_dist=True, alpha=alpha)
+        kl[k] = kl_divergence_fisher(mu0, var0, mu1, var1).item()
+    return kl
+
+
+def fisher_forget(model, fisher, args, alpha=1e-6, seed=None):
+    torch.manual_seed(args.seed if seed is None else seed)
+    with torch.no_grad():
+        for k, p in model.named_parameters():
+            mu, var = get_mean_var(p, fisher[k], args, alpha=alpha)
+            p.copy_(mu + var.sqrt() * torch.empty_like(p).normal_())
+    return model
+
+
+def ntk_jacobian(model, dataset, args, batch_size=64):
+    """Jacobian block of the model outputs on `dataset`, as G [num_params, num_samples * num_classes],
+    and the cross-entropy gradient w.r.t. the outputs, [num_samples * num_classes, 1]."""
+    model.eval()
+    params = {k: p.detach() for k, p in model.named_parameters()}
+    buffers = dict(model.named_buffers())
+
+    def output_fn(params, x):
+        return functional_call(model, (params, buffers), (x.unsqueeze(0),)).squeeze(0)
+
+    jac_fn = vmap(jacrev(output_fn), in_dims=(None, 0))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    G, residuals = [], []
+    for data, target in loader:
+        data, target = data.to(args.device), target.to(args.device)
+        jac = jac_fn(params, data)
+        G.append(torch.cat([j.flatten(2) for j in jac.values()], dim=2).flatten(0, 1).cpu())
+        with torch.no_grad():
+            output = model(data)
+        residual = F.softmax(output, dim=1)
+        residual[torch.arange(len(target)), target] -= 1
+        residuals.append(residual.flatten().cpu())
+    return torch.cat(G).t().double().numpy(), torch.cat(residuals).unsqueeze(1).double().numpy()
+
+
+def vectorize_params(model):
+    return torch.cat([p.detach().view(-1) for p in model.parameters()]).cpu().double().numpy()
+
+
+def ntk_forget(model, model_init, G_r, r_r, G_f, r_f, args):
+    """NTK scrubbing: moves `model` along the difference of the linearized solutions with and without
+    the forget set, rescaled by the predicted-to-linearized norm ratio."""
+    num_retain, num_total = G_r.shape[1] // args.num_classes, (G_r.shape[1] + G_f.shape[1]) // args.num_classes
+    G, r = np.concatenate([G_r, G_f], axis=1), np.concatenate([r_r, r_f])
+    w_complete = -G.dot(np.linalg.solve(G.T.dot(G) + num_total * args.weight_decay * np.eye(G.shape[1]), r))
+    w_retain = -G_r.dot(np.linalg.solve(G_r.T.dot(G_r) + num_retain * args.weight_decay * np.eye(G_r.shape[1]), r_r))
+    delta_w = (w_retain - w_complete).squeeze()
+
+    m_pred_error = vectorize_params(model) - vectorize_params(model_init) - w_retain.squeeze()
+    inner = np.inner(delta_w / np.linalg.norm(delta_w), m_pred_error / np.linalg.norm(m_pred_error))
+    if inner < 0:
+        angle = np.arccos(inner) - np.pi / 2
+        predicted_norm = np.linalg.norm(delta_w) + 2 * np.sin(angle) * np.linalg.norm(m_pred_error)
+    else:
+        angle = np.arccos(inner)
+        predicted_norm = np.linalg.norm(delta_w) + 2 * np.cos(angle) * np.linalg.norm(m_pred_error)
+    scale = predicted_norm / np.linalg.norm(delta_w)
+
+    offset = 0
+    with torch.no_grad():
+        for p in model.parameters():
+            update = torch.from_numpy(delta_w[offset:offset + p.numel()]).view_as(p)
+            p += (scale * update).to(p)
+            offset += p.numel()
+    return model, scale
+
+
+def conjugate_gradient(A, b, iters=50, tol=1e-3):
+    """Solves A x = b for a symmetric positive definite operator A (a function of a vector). Returns x and
+    the relative residual ||b - A x|| / ||b|| after every iteration. Stops at `tol`, or early if A shows
+    non-positive curvature (the Hessian of a non-convex loss need not be positive definite)."""
+    x, r = torch.zeros_like(b), b.clone()
+    p, rs, b_norm = r.clone(), r.dot(r), b.norm()
+    residuals = []
+    for _ in range(iters):
+        Ap = A(p)
+        curvature = p.dot(Ap)
+        if curvature <= 0:
+            break
+        alpha = rs / curvature
+        x += alpha * p
+        r -= alpha * Ap
+        rs_new = r.dot(r)
+        residuals.append((rs_new.sqrt() / b_norm).item())
+        if residuals[-1] < tol:
+            break
+        p = r + (rs_new / rs) * p
+        rs = rs_new
+    return x, residuals
+
+
+def lissa(A_batch, b, batches, depth, scale):
+    """LiSSA (Agarwal et al., 2017): x_j = b + x_{j-1} - A_j x_{j-1} / scale, with A_j the operator on the
+    j-th of `batches`; A^{-1} b ~ x_depth / scale. `scale` must exceed the largest eigenvalue of A."""
+    x = b.clone()
+    for _, (data, target) in zip(range(depth), batches):
+        x = b + x - A_batch(x, data, target) / scale
+    return x / scale
+
+
+def _stream_mean(fn, data_loader, device):
+    """Mean over the samples of `data_loader` of fn(data, target), a per-batch mean."""
+    total, n = 0., 0
+    for data, target in data_loader:
+        total = total + fn(data.to(device), target.to(device)) * len(data)
+        n += len(data)
+    return total / n
+
+
+def newton_forget(model, retain_loader, forget_loader, args, quiet=True):
+    """Influence-function unlearning: the Newton step removing the forget set, (n_f / n_r) H_r^{-1} g_f, with
+    g_f the mean forget-loss gradient and H_r the Hessian of the mean retain loss plus the l2_penalty
+    damping (weight_decay, rescaled by n / n_r to the retain mean). H_r is only used through Hessian-vector
+    products streamed over (args.newton_hessian_samples of) the retain set, solved with conjugate gradients
+    or LiSSA (args.newton_solver). Returns the model and the relative residuals ||g_f - H_r x|| / ||g_f||."""
+    model.eval()
+    device = next(model.parameters()).device
+    params = {k: p.detach() for k, p in model.named_parameters() if p.requires_grad}
+    buffers = dict(model.named_buffers())
+    numels = [p.numel() for p in params.values()]
+    w = torch.cat([p.reshape(-1) for p in params.values()])
+
+    def unflatten(v):
+        return {k: x.view_as(p) for (k, p), x in zip(params.items(), v.split(numels))}
+
+    def loss(v, data, target):
+        return F.cross_entropy(functional_call(model, (unflatten(v), buffers), (data,)), target)
+
+    loss_grad = grad(loss)
+    num_retain, num_forget = len(retain_loader.dataset), len(forget_loader.dataset)
+    damping = args.weight_decay * (num_retain + num_forget) / num_retain
+
+    def hvp(v, data, target):
+        return jvp(lambda x: loss_grad(x, data, target), (w,), (v,))[1] + damping * v
+
+    hessian_set = retain_loader.dataset
+    if args.newton_hessian_samples is not None and args.newton_hessian_samples < num_retain:
+        subset = torch.randperm(num_retain, generator=torch.Generator().manual_seed(args.seed))[:args.newton_hessian_samples]
+        hessian_set = torch.utils.data.Subset(hessian_set, subset.tolist())
+    # a fixed order and subset, so that every product uses the same operator
+    hessian_loader = make_loader(hessian_set, retain_loader.batch_size, shuffle=False)
+
+    def hessian(v):
+        return _stream_mean(lambda data, target: hvp(v, data, target), hessian_loader, device)
+
+    g = _stream_mean(lambda data, target: loss_grad(w, data, target), forget_loader, device)
+    if args.newton_solver == 'cg':
+        x, residuals = conjugate_gradient(hessian, g, args.newton_iters, args.newton_tol)
+    elif args.newton_solver == 'lissa':
+        # reshuffled retain batches, without itertools.cycle keeping the first pass in memory
+        batches = ((data.to(device), target.to(device)) for _ in count() for data, target in retain_loader)
+        x = lissa(hvp, g, batches, args.newton_lissa_depth, args.newton_lissa_scale)
+        residuals = [((g - hessian(x)).norm() / g.norm()).item()]
+    else:
+        raise ValueError(f'Unknown Newton solver {args.newton_solver}')
+    if not quiet:
+        print(f'{args.newton_solver}: {len(residuals)} iterations, relative residual {residuals[-1] if residuals else 1.:.2e}')
+    with torch.no_grad():
+        for p, update in zip(params.values(), unflatten(num_forget / num_retain * x).values()):
+            p.add_(update)
+    return model, residuals
+
+
+def certified_forget(model, model_init, train_set, forget_indexes, args, engine_path=None, quiet=True):
+    """Certified removal of the forget set from the last linear layer (certified.py), as one request.
+    With `engine_path`, the engine state is loaded from it if it exists (built and saved otherwise),
+    and saved back after the request. Returns the model with the noisy head and the removal info."""
+    if engine_path is not None and os.path.isfile(engine_path):
+        engine = CertifiedRemoval.load(engine_path, device=args.device)
+    else:
+        engine = CertifiedRemoval(model, model_init, train_set, args, eps=args.certified_eps, delta=args.certified_delta)
+    info = engine.remove(forget_indexes)
+    if engine_path is not None:
+        engine.save(engine_path)
+    if not quiet:
+        print(f"Removed {info['removed']} samples in {1000 * info['seconds']:.1f} ms, residual {info['residual']:.2e}, "
+              f"sigma {info['sigma']:.2e}")
+    return engine.apply(model, seed=args.seed), info
+
+
+def scrub(model, retain_loader, forget_loader, args, quiet=True):
+    """SCRUB: the student maximizes its KL to the teacher on the forget set for the first args.msteps
+    epochs and minimizes it (plus the CE) on the retain set, with SGDA smoothing towards an EMA
+    (kept, with the student, on flat parameter buffers)."""
+    model_t, model_s = copy.deepcopy(model), copy.deepcopy(model)
+    swa_model = FlatAveragedModel(model_s, args.swa_beta)
+    module_list = nn.ModuleList([model_s, model_t])
+    criterion_list = nn.ModuleList([nn.CrossEntropyLoss(), DistillKL(args.kd_T), DistillKL(args.kd_T)])
+    if args.optim == 'sgd':
+        optimizer = optim.SGD(model_s.parameters(), lr=args.sgda_learning_rate, momentum=args.sgda_momentum,
+                              weight_decay=args.sgda_weight_decay)
+    elif args.optim == 'adam':
+        optimizer = optim.Adam(model_s.parameters(), lr=args.sgda_learning_rate, weight_decay=args.sgda_weight_decay)
+    elif args.optim == 'rmsp':
+        optimizer = optim.RMSprop(model_s.parameters(), lr=args.sgda_learning_rate, momentum=args.sgda_momentum,
+                                  weight_decay=args.sgda_weight_decay)
+    opt = copy.copy(args)
+    opt.lr_decay_epochs = args.sgda_lr_decay_epochs
+    opt.teacher_caches = TeacherCaches(getattr(args, 'teacher_cache_dir', None))
+    if getattr(args, 'teacher_cache', False):
+        # the loops key the cached teacher logits by sample index
+        retain_loader = make_loader(datasets.IndexedDataset(retain_loader.dataset), retain_loader.batch_size, seed=args.seed)
+        forget_loader = make_loader(datasets.IndexedDataset(forget_loader.dataset), forget_loader.batch_size, seed=args.seed)
+    for epoch in range(1, args.sgda_epochs + 1):
+        sgda_adjust_learning_rate(epoch, opt, optimizer)
+        if epoch <= args.msteps:
+            train_distill(epoch, forget_loader, module_list, swa_model, criterion_list, optimizer, opt, 'maximize', quiet=quiet)
+        train_distill(epoch, retain_loader, module_list, swa_model, criterion_list, optimizer, opt, 'minimize', quiet=quiet)
+        if epoch >= args.sstart:
+            swa_model.update_parameters(model_s)
+    return model_s
+
+
+def test(model, data_loader, args):
+    return run_train_epoch(model, model, data_loader, nn.CrossEntropyLoss(), None, 'test', 0, 0., quiet=True, opt=args)
+
+
+def readout_retrain(model, data_loader, test_loader, args, lr=0.1, epochs=500, threshold=0.01):
+    """Steps of fine-tuning on the full training set needed to bring the forget loss back under `threshold`."""
+    torch.manual_seed(args.seed)
+    model = copy.deepcopy(model)
+    loss_fn = nn.CrossEntropyLoss()
+    optimizer = optim.SGD(model.parameters(), lr=lr, weight_decay=0.0)
+    sampler = torch.utils.data.RandomSampler(data_loader.dataset, replacement=True, num_samples=500)
+    data_loader_small = torch.utils.data.DataLoader(data_loader.dataset, batch_size=data_loader.batch_size,
+                                                    sampler=sampler, num_workers=data_loader.num_workers)
+    metrics = []
+    model_init = copy.deepcopy(model)
+    for epoch in range(epochs):
+        metrics.append(run_train_epoch(model, model_init, test_loader, loss_fn, optimizer, 'test', epoch, args.weight_decay,
+                                       quiet=True, opt=args))
+        if metrics[-1]['loss'] <= threshold:
+            break
+        run_train_epoch(model, model_init, data_loader_small, loss_fn, optimizer, 'train', epoch, args.weight_decay,
+                        quiet=True, opt=args)
+    return epoch, metrics
+
+
+def all_readouts(model, loaders, args, thresh=0.1):
+    """Test/forget/retain errors and the re-learn time of the forget set."""
+    train_loader, retain_loader, forget_loader, test_loader = loaders
+    retrain_time, _ = readout_retrain(model, train_loader, forget_loader, args, epochs=args.readout_epochs,
+                                      lr=args.readout_lr, threshold=thresh)
+    return dict(test_error=test(model, test_loader, args)['error'], forget_error=test(model, forget_loader, args)['error'],
+                retain_error=test(model, retain_loader, args)['error'], retrain_time=retrain_time + 1)
@@ -11,12 +11,14 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 import torch.optim as optim
-from IPython import embed
 
 from io import BytesIO
 import os
 import errno
+import hashlib
 
+# not used here: the notebooks get them through `from utils import *`. Both are cheap to import, since
+# datasets_multiclass loads the dataset modules and torchvision only when a dataset is built.
 import models
 import datasets_multiclass as datasets
 
@@ -46,6 +48,42 @@ class AverageMeter(object):
             self.count[k] += n
             self.avg[k] = self.sum[k] / self.count[k]
 
+class EarlyStopping(object):
+    """Stops training when a validation metric has not improved for `patience` evaluations"""
+
+    def __init__(self, metric='loss', patience=5, min_delta=0.0):
+        self.metric = metric
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = float('inf')
+        self.best_epoch = None
+        self.num_bad_evals = 0
+        self.stop_reason = None
+
+    def step(self, metrics, epoch):
+        value = metrics.avg[self.metric]
+        if value < self.best - self.min_delta:
+            self.best = value
+            self.best_epoch = epoch
+            self.num_bad_evals = 0
+        else:
+            self.num_bad_evals += 1
+        if self.num_bad_evals >= self.patience:
+            self.stop_reason = (f'early_stop: valid {self.metric} did not improve by more than {self.min_delta} '
+                                f'for {self.patience} evaluations (best {self.best:.4f} at epoch {self.best_epoch})')
+            return True
+        return False
+
+def all_reduce_metrics(metrics):
+    """Sums an AverageMeter across the processes of the default process group."""
+    import torch.distributed as dist
+    for k in list(metrics.sum):
+        t = torch.tensor([metrics.sum[k], metrics.count[k]], dtype=torch.float64)
+        dist.all_reduce(t)
+        metrics.sum[k], metrics.count[k] = t[0].item(), t[1].item()
+        metrics.avg[k] = metrics.sum[k] / metrics.count[k]
+    return metrics
+
 def log_metrics(split, metrics, epoch, **kwargs):
     print(f'[{epoch}] {split} metrics:' + json.dumps(metrics.avg))
 
@@ -68,6 +106,106 @@ def set_batchnorm_mode(model, train=True):
     for l in model.children():
         set_batchnorm_mode(l, train=train)
         
+def bn_recalibrate(model, data_loader, num_samples=2048, device=None, seed=0, cache_dir=None, preprocess=None):
+    '''Re-estimates the BatchNorm running statistics of model on a random subsample
+    of data_loader.dataset, as a cheaper replacement for a full dry-run epoch.
+    Statistics are reset and accumulated as a cumulative average (momentum=None), so
+    they do not depend on batch order or on the previous running averages.
+    With cache_dir, the statistics are saved per checkpoint (hash of the weights and
+    of the subsample settings) and loaded instead of recomputed next time. preprocess is
+    applied to every input batch (e.g. the flattening run_epoch does for MNIST).
+    '''
+    bn_layers = [m for m in model.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)]
+    if len(bn_layers) == 0:
+        return model
+    if device is None:
+        device = next(model.parameters()).device
+    num_samples = min(num_samples, len(data_loader.dataset))
+
+    cache_file = None
+    if cache_dir is not None:
+        h = hashlib.sha1(f'{num_samples}_{seed}_{len(data_loader.dataset)}'.encode())
+        for k, v in model.state_dict().items():
+            if not k.endswith(('running_mean', 'running_var', 'num_batches_tracked')):
+                h.update(k.encode())
+                h.update(v.detach().cpu().numpy().tobytes())
+        cache_file = os.path.join(cache_dir, f'bn_{h.hexdigest()}.pt')
+        if os.path.isfile(cache_file):
+            for m, state in zip(bn_layers, torch.load(cache_file, map_location=device)):
+                m.load_state_dict(state)
+            return model
+
+    rng = np.random.RandomState(seed)
+    indexes = rng.choice(len(data_loader.dataset), num_samples, replace=False)
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(data_loader.dataset, indexes),
+                                         batch_size=data_loader.batch_size, shuffle=False, num_workers=0)
+
+    training = model.training
+    momenta = [m.momentum for m in bn_layers]
+    for m in bn_layers:
+        m.reset_running_stats()
+        m.momentum = None
+    model.eval()
+    set_batchnorm_mode(model, train=True)
+    with torch.no_grad():
+        for batch in loader:
+            data = batch[0].to(device)
+            model(preprocess(data) if preprocess is not None else data)
+    for m, momentum in zip(bn_layers, momenta):
+        m.momentum = momentum
+    model.train(training)
+
+    if cache_file is not None:
+        mkdir(cache_dir)
+        torch.save([m.state_dict() for m in bn_layers], cache_file)
+    return model
+
+class SampleRecorder(object):
+    '''Per-sample loss, margin and correctness of every training epoch, stored in preallocated
+    [epochs, num_samples] arrays indexed by position in the training set. It is filled from the
+    outputs run_epoch computes anyway, so it needs loaders built with return_index=True.
+    Margin is the true-class logit minus the largest other logit (output * target for the
+    single-output mse models); correct is -1 for samples not seen in an epoch.
+    '''
+    def __init__(self, num_samples, num_epochs):
+        self.loss = np.full((num_epochs, num_samples), np.nan, dtype=np.float32)
+        self.margin = np.full((num_epochs, num_samples), np.nan, dtype=np.float32)
+        self.correct = np.full((num_epochs, num_samples), -1, dtype=np.int8)
+
+    def record(self, epoch, index, output, target):
+        with torch.no_grad():
+            output = output.detach().float()
+            if output.shape[1] > 1:
+                loss = F.cross_entropy(output, target, reduction='none')
+                true = output.gather(1, target.view(-1, 1)).squeeze(1)
+                margin = true - output.scatter(1, target.view(-1, 1), float('-inf')).max(1)[0]
+            else:
+                output, target = output.view(-1), target.view(-1).float()
+                loss = 0.5*(output - target).pow(2)
+                margin = output*target
+        index = index.cpu().numpy()
+        self.loss[epoch, index] = loss.cpu().numpy()
+        self.margin[epoch, index] = margin.cpu().numpy()
+        self.correct[epoch, index] = (margin > 0).cpu().numpy()
+
+    def forgetting_events(self, epochs=None):
+        '''Number of correct -> incorrect transitions between consecutive epochs a sample was seen in,
+        and whether the sample was never classified correctly (Toneva et al., 2019).'''
+        correct = self.correct[:epochs]
+        events = np.zeros(correct.shape[1], dtype=np.int32)
+        last = np.full(correct.shape[1], -1, dtype=np.int8)
+        for row in correct:
+            seen = row >= 0
+            events += (seen & (last == 1) & (row == 0))
+            last[seen] = row[seen]
+        never_learned = ~(correct == 1).any(0)
+        return events, never_learned
+
+    def save(self, path, epochs=None):
+        events, never_learned = self.forgetting_events(epochs)
+        np.savez_compressed(path, loss=self.loss[:epochs], margin=self.margin[:epochs], correct=self.correct[:epochs],
+                            forgetting_events=events, never_learned=never_learned)
+
 def mkdir(directory):
     '''Make directory and all parents, if needed.
     Does not raise and error if directory already exists.